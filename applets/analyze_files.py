@@ -163,11 +163,9 @@ class Analyzer(object):
                 "type": "dqm-files",
             }
 
-            final_fp = os.path.join(self.report_directory, doc["_id"] + ".jsn")
-            body = json.dumps(doc, indent=None)
-            fff_filemonitor.atomic_create_write(final_fp, body)
+            fff_filemonitor.submit_report(doc, self.report_directory)
 
-            log.info("Made report file: %s", final_fp)
+            log.info("Made report: %s", doc["_id"])
 
     def run_greenlet(self):
         while True:
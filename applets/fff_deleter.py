@@ -329,11 +329,9 @@ class FileDeleter(object):
             "type": "dqm-diskspace",
         }
 
-        final_fp = os.path.join(self.report_directory, doc["_id"] + ".jsn")
-        body = json.dumps(doc, indent=True)
-        fff_filemonitor.atomic_create_write(final_fp, body)
+        fff_filemonitor.submit_report(doc, self.report_directory)
 
-        self.log.info("Made report file: %s", final_fp)
+        self.log.info("Made report: %s", doc["_id"])
 
     def run_greenlet(self):
         import gevent
@@ -10,17 +10,24 @@ import socket
 import struct
 import time
 import urllib.request, urllib.error, urllib.parse
+import http.client
 import json
 
 import fff_dqmtools
 
 
-def atomic_read_delete(fp):
+def atomic_claim(fp, tmp_fp=None):
+    """
+    Same as atomic_read_delete(), but the file is only renamed
+    (to tmp_fp, if given), the caller deletes it once it's done with it.
+    Returns the new name and the content.
+    """
     import os, stat, fcntl, errno
 
-    tmp_fp = fp
-    tmp_fp += ".open_pid%d" % os.getpid()
-    tmp_fp += "_tag" + os.urandom(32).hex().upper()
+    if tmp_fp is None:
+        tmp_fp = fp
+        tmp_fp += ".open_pid%d" % os.getpid()
+        tmp_fp += "_tag" + os.urandom(32).hex().upper()
 
     os.rename(fp, tmp_fp)
 
@@ -35,17 +42,16 @@ def atomic_read_delete(fp):
 
         raise
 
-    # i guess this can already be done
-    os.unlink(tmp_fp)
-
     s = os.fstat(fd)
     if not stat.S_ISREG(s.st_mode):
         os.close(fd)
+        os.unlink(tmp_fp)
         raise Exception("Not a regular file!")
 
-    # hardlink count should be zero, since we have deleted it
-    if s.st_nlink != 0:
+    # hardlink count should be one, just our (renamed) name
+    if s.st_nlink != 1:
         os.close(fd)
+        os.unlink(tmp_fp)
         raise Exception("Too many hardlinks: %d!" % s.st_nlink)
 
     flags = fcntl.fcntl(fd, fcntl.F_GETFL, 0)
@@ -57,6 +63,13 @@ def atomic_read_delete(fp):
     b = f.read()
     f.close()
 
+    return tmp_fp, b
+
+
+def atomic_read_delete(fp):
+    tmp_fp, b = atomic_claim(fp)
+    os.unlink(tmp_fp)
+
     return b
 
 
@@ -84,6 +97,148 @@ def atomic_create_write(fp, body, mode=0o600):
         raise
 
 
+# fff_web listens for the reports on "\0" + fff_dqmtools.get_lock_key(REPORT_SOCKET)
+REPORT_SOCKET = "fff_web.reports"
+
+
+class ReportClient(object):
+    """
+    Hands the reports straight to fff_web, over a (abstract) unix socket:
+    one json document per line, fff_web answers "ok" once it's committed.
+
+    If fff_web can't be reached (or doesn't answer "ok"), the report is
+    written into the monitoring directory (and uploaded by the file
+    monitor), the socket is retried after retry_delay seconds.
+    """
+
+    def __init__(self, timeout=5, retry_delay=10):
+        import gevent.lock
+
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+
+        self.sock = None
+        self.reader = None
+        self.retry_at = 0
+        self.lock = gevent.lock.Semaphore()
+        self.stats = {"direct": 0, "fallback": 0}
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+            self.reader = None
+
+    def connect(self):
+        import gevent.socket as socket
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect("\0" + fff_dqmtools.get_lock_key(REPORT_SOCKET))
+        except:
+            sock.close()
+            raise
+
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+
+    def send(self, line):
+        with self.lock:
+            if self.sock is None:
+                if time.time() < self.retry_at:
+                    return False
+
+                self.connect()
+
+            try:
+                self.sock.sendall(line + b"\n")
+                answer = self.reader.readline()
+            except:
+                self.close()
+                raise
+
+            if not answer:
+                self.close()
+                raise EOFError("fff_web closed the report socket.")
+
+            return answer.strip() == b"ok"
+
+    def submit(self, doc, fallback_fp):
+        """Returns True if fff_web got the report, False if it was written to fallback_fp."""
+        if "timestamp" not in doc and "report_timestamp" not in doc:
+            # fff_web keeps the newest version by this timestamp, the fallback
+            # file can be uploaded after a newer report was sent directly
+            doc = dict(doc, report_timestamp=time.time())
+
+        body = json.dumps(doc)
+
+        try:
+            if self.send(body.encode("utf-8")):
+                self.stats["direct"] += 1
+                return True
+        except Exception:
+            self.retry_at = time.time() + self.retry_delay
+
+        atomic_create_write(fallback_fp, body)
+        self.stats["fallback"] += 1
+        return False
+
+
+# one per process, see submit_report()
+_report_client = None
+
+
+def submit_report(doc, report_directory):
+    """
+    Submits a report (a document with an _id) to DQM^2, directly if
+    fff_web is running, otherwise as report_directory/<_id>.jsn.
+    Returns True if it was delivered directly.
+    """
+    global _report_client
+    if _report_client is None:
+        _report_client = ReportClient()
+
+    fallback_fp = os.path.join(report_directory, doc["_id"] + ".jsn")
+    return _report_client.submit(doc, fallback_fp)
+
+
+def coalesce_documents(items, get_doc=lambda x: x):
+    """
+    Keeps only the latest version of every _id in items: the last one,
+    unless an earlier version has a newer "timestamp".
+    Returns the kept items (in their order) and the number of dropped ones.
+    """
+    latest = {}
+    for i, item in enumerate(items):
+        doc = get_doc(item)
+        if not isinstance(doc, dict) or doc.get("_id", None) is None:
+            continue
+
+        prev = latest.get(doc["_id"], None)
+        if prev is not None:
+            ts = doc.get("timestamp", None)
+            prev_ts = get_doc(items[prev]).get("timestamp", None)
+
+            numbers = (int, float)
+            if isinstance(ts, numbers) and isinstance(prev_ts, numbers):
+                if ts < prev_ts:
+                    continue
+
+        latest[doc["_id"]] = i
+
+    superseded = set(range(len(items)))
+    for i, item in enumerate(items):
+        doc = get_doc(item)
+        if not isinstance(doc, dict) or doc.get("_id", None) is None:
+            superseded.discard(i)
+
+    superseded.difference_update(latest.values())
+    kept = [item for i, item in enumerate(items) if i not in superseded]
+    return kept, len(superseded)
+
+
 def http_upload(lst_gen, port, log=None, test_webserver=False):
     url = "http://127.0.0.1:%d/_upload/" % port
     docs = list(filter(lambda x: x is not None, lst_gen))
@@ -113,12 +268,139 @@ def http_upload(lst_gen, port, log=None, test_webserver=False):
     return len(docs)
 
 
+class UploadRejected(Exception):
+    """fff_web is up, but it didn't accept the documents (a 4xx answer)."""
+
+
+class UploadFailed(Exception):
+    """fff_web couldn't take the documents this time (ie. a 5xx answer), to be retried."""
+
+
+class UploadChannel(object):
+    """
+    A persistent (keep-alive) connection to fff_web's /_upload/.
+
+    The documents are streamed as newline delimited json (chunked),
+    fff_web answers once they are committed, with the number of
+    accepted documents (the acknowledgement).
+    """
+
+    def __init__(self, port, timeout=60, log=None):
+        self.port = port
+        self.timeout = timeout
+        self.log = log
+
+        self.conn = None
+        self.stats = {"connects": 0, "batches": 0, "docs": 0}
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def upload(self, docs):
+        """Streams the docs (an iterable of json lines), returns the number of acknowledged ones."""
+        import http.client
+
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(
+                "127.0.0.1", self.port, timeout=self.timeout
+            )
+            self.stats["connects"] += 1
+
+        sent = [0]
+
+        def lines():
+            for line in docs:
+                sent[0] += 1
+                yield line + b"\n"
+
+        try:
+            self.conn.request(
+                "POST",
+                "/_upload/",
+                body=lines(),
+                headers={"Content-Type": "application/x-ndjson"},
+                encode_chunked=True,
+            )
+
+            r = self.conn.getresponse()
+            resp = r.read()
+        except:
+            self.close()
+            raise
+
+        if r.status != 200:
+            self.close()
+
+            # only the client errors are about the documents themselves,
+            # a locked database or a restarting fff_web is not
+            msg = "HTTP %d: %s" % (r.status, resp[:1024])
+            if 400 <= r.status < 500:
+                raise UploadRejected(msg)
+            raise UploadFailed(msg)
+
+        accepted = json.loads(resp)["accepted"]
+        if accepted != sent[0]:
+            raise UploadFailed(
+                "Sent %d documents, %d acknowledged." % (sent[0], accepted)
+            )
+
+        self.stats["batches"] += 1
+        self.stats["docs"] += accepted
+        return accepted
+
+
 class FileMonitor(object):
-    def __init__(self, path, port, log):
+    """
+    Uploads the .jsn reports dropped into path to the local fff_web.
+
+    The file names come from inotify (IN_CLOSE_WRITE/IN_MOVED_TO) and are
+    queued, the queue is uploaded in batches - when batch_size files are
+    waiting or the oldest one waited batch_delay seconds.
+    A full directory listing is done only on start, on an inotify
+    queue overflow and every rescan_interval seconds (as a safety net).
+
+    The reports are delivered at least once: a batch is claimed by
+    renaming the files into the (private) in-flight directory and they
+    are deleted only once fff_web has acknowledged them. Failed uploads
+    are retried with a backoff, the files claimed by a previous
+    (crashed) instance are uploaded first.
+    """
+
+    MAX_RETRY_DELAY = 30
+
+    def __init__(
+        self, path, port, log, batch_size=100, batch_delay=0.05, rescan_interval=60
+    ):
         self.path = path
         self.port = port
         self.log = log
+
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.rescan_interval = rescan_interval
+
+        # fname -> time queued, insertion ordered
+        self.pending = {}
         self.last_scan = 0
+        self.channel = UploadChannel(port, log=log)
+        self.stats = {
+            "queued": 0,
+            "uploaded": 0,
+            "batches": 0,
+            "rescans": 0,
+            "failures": 0,
+            "rejected": 0,
+            "collapsed": 0,
+        }
+
+        # claimed file -> None, insertion (ie. claim) ordered
+        self.inflight = {}
+        self.inflight_path = os.path.join(self.path, ".inflight")
+        self.claims = 0
+        self.retry_at = None
+        self.retry_delay = 0
 
         try:
             os.makedirs(self.path)
@@ -138,6 +420,21 @@ class FileMonitor(object):
         except OSError:
             pass
 
+        self.recover_inflight()
+
+    def recover_inflight(self):
+        """Queues the files claimed, but not acknowledged, by a previous instance."""
+        try:
+            os.mkdir(self.inflight_path, 0o700)
+        except FileExistsError:
+            pass
+
+        for name in sorted(os.listdir(self.inflight_path)):
+            self.inflight[os.path.join(self.inflight_path, name)] = None
+
+        if self.inflight:
+            self.log.info("Recovered %d in-flight reports.", len(self.inflight))
+
     def try_create_ramdisk(self):
         path = self.path
 
@@ -168,145 +465,230 @@ class FileMonitor(object):
         else:
             self.log.info("Mountpoint not found and we can't mount.")
 
-    def file_reader_gen(self, lst):
-        for fp in lst:
-            # self.log.info("Uploading: %s", fp)
-            try:
-                # output a None to let the uploader know that we are serious
-                # (i am actually serious, it is used for synchronization)
-                yield None
+    def queue_file(self, fname):
+        if fname.startswith("."):
+            return
+        if not fname.endswith(".jsn"):
+            return
+        if fname in self.pending:
+            return
+
+        self.pending[fname] = time.time()
+        self.stats["queued"] += 1
+
+    def scan_dir(self):
+        """Queues all the reports in the directory (the safety net)."""
+        before = len(self.pending)
+        for fname in os.listdir(self.path):
+            self.queue_file(fname)
+
+        self.last_scan = time.time()
+        self.stats["rescans"] += 1
+
+        found = len(self.pending) - before
+        if found:
+            self.log.info("Directory scan found %d unseen reports.", found)
+
+    def next_flush(self):
+        """Seconds until the next upload, None if there is nothing to upload."""
+        if not self.pending and not self.inflight:
+            return None
+
+        if self.retry_at is not None:
+            return max(0, self.retry_at - time.time())
+
+        if self.inflight or len(self.pending) >= self.batch_size:
+            return 0
+
+        oldest = next(iter(self.pending.values()))
+        return max(0, oldest + self.batch_delay - time.time())
+
+    def claim(self):
+        """Moves the pending files into the in-flight directory, up to a batch."""
+        while self.pending and len(self.inflight) < self.batch_size:
+            fname = next(iter(self.pending))
+            del self.pending[fname]
+
+            # the names keep the claim order (and the original name)
+            self.claims += 1
+            claimed_fp = os.path.join(
+                self.inflight_path,
+                "%019d-%06d-%s" % (time.time_ns(), self.claims % 1000000, fname),
+            )
 
-                body = atomic_read_delete(fp)
-                yield json.loads(body)
+            try:
+                atomic_claim(os.path.join(self.path, fname), claimed_fp)
+            except FileNotFoundError:
+                continue
             except:
-                self.log.warning("Failure to read the document: %s", fp, exc_info=True)
-                # raise Exception("Please restart.")
+                self.log.warning(
+                    "Failure to claim the document: %s", fname, exc_info=True
+                )
+                continue
 
-    def scan_dir(self, max_count=None):
-        lst = os.listdir(self.path)
-        to_upload = []
-        for f in lst:
-            fp = os.path.join(self.path, f)
+            self.inflight[claimed_fp] = None
 
-            fname = os.path.basename(fp)
-            if fname.startswith("."):
+    def flush(self):
+        """Uploads (at most) one batch, the in-flight files first."""
+        self.claim()
+
+        try:
+            try:
+                self.upload_batch(list(self.inflight))
+            except UploadRejected as e:
+                # fff_web is fine, so it's (most likely) one of the documents
+                # only a document rejected on its own is dropped,
+                # any other failure keeps the rest in flight (and backs off)
+                self.log.warning("Batch rejected (%s), uploading one by one.", e)
+                for claimed_fp in list(self.inflight):
+                    try:
+                        self.upload_batch([claimed_fp])
+                    except UploadRejected as e:
+                        self.reject(claimed_fp, e)
+        except Exception as e:
+            self.retry_delay = min(max(self.retry_delay * 2, 0.5), self.MAX_RETRY_DELAY)
+            self.retry_at = time.time() + self.retry_delay
+            self.stats["failures"] += 1
+
+            self.log.warning(
+                "Upload of %d reports failed (%r), retrying in %.1f seconds.",
+                len(self.inflight),
+                e,
+                self.retry_delay,
+            )
+            return
+
+        self.retry_at = None
+        self.retry_delay = 0
+
+    def reject(self, claimed_fp, e):
+        self.log.error("Report rejected by fff_web, dropped: %s (%s)", claimed_fp, e)
+        self.stats["rejected"] += 1
+        self.drop(claimed_fp)
+
+    def drop(self, claimed_fp):
+        del self.inflight[claimed_fp]
+        os.unlink(claimed_fp)
+
+    def read_batch(self, claimed_fps):
+        """Reads and validates the in-flight files, returns (claimed_fp, doc, line) tuples."""
+        batch = []
+        for claimed_fp in claimed_fps:
+            if claimed_fp not in self.inflight:
                 continue
-            if not fname.endswith(".jsn"):
+
+            with open(claimed_fp, "rb") as f:
+                body = f.read()
+
+            try:
+                doc = json.loads(body)
+                if not isinstance(doc, dict):
+                    raise ValueError("Not a json object.")
+            except:
+                self.log.warning(
+                    "Failure to read the document: %s", claimed_fp, exc_info=True
+                )
+                self.drop(claimed_fp)
                 continue
 
-            to_upload.append(fp)
+            line = json.dumps(doc).encode("utf-8") if b"\n" in body else body
+            batch.append((claimed_fp, doc, line))
+
+        return batch
 
-        restart_needed = False
-        if max_count is not None:
-            if len(to_upload) > max_count:
-                to_upload = to_upload[:max_count]
-                restart_needed = True
+    def upload_batch(self, claimed_fps):
+        """Uploads the in-flight files and deletes them once fff_web has acknowledged them."""
+        batch = self.read_batch(claimed_fps)
 
-        return self.file_reader_gen(to_upload), restart_needed
+        # the producers rewrite the same reports, only the latest is uploaded
+        # (the superseded files are deleted with the batch)
+        kept, collapsed = coalesce_documents(batch, get_doc=lambda x: x[1])
 
-    def process_dir(self):
-        if ((time.time() - self.last_scan) >= 0) and (
-            (time.time() - self.last_scan) < 5
-        ):
-            # we don't want to update too often
-            # returning True means we will be called again in one second
+        # a keep-alive connection could have been closed in the meantime,
+        # in that case the batch is retried once on a new connection
+        reconnect = self.channel.conn is not None
+        while True:
+            try:
+                uploaded = self.channel.upload(line for _, _, line in kept)
+                break
+            except (OSError, http.client.HTTPException) as e:
+                if not reconnect:
+                    raise
 
-            # if time is less than zero, well, it's bad
-            return True
+                self.log.info("Upload channel broken (%r), reconnecting.", e)
+                reconnect = False
 
-        bodydoc_generator, restart_needed = self.scan_dir(max_count=150)
-        http_upload(bodydoc_generator, port=self.port, log=self.log)
+        for claimed_fp, _, _ in batch:
+            self.drop(claimed_fp)
 
-        # return true if we need to call this again
-        if restart_needed:
-            self.last_scan = 0
-            return True
-        else:
-            self.last_scan = time.time()
-            return False
+        self.stats["uploaded"] += uploaded
+        self.stats["collapsed"] += collapsed
+        self.stats["batches"] += 1
+
+    def process_pending(self):
+        while self.next_flush() == 0:
+            self.flush()
+
+    def wait_time(self, max_wait):
+        wait = self.last_scan + self.rescan_interval - time.time()
+
+        flush = self.next_flush()
+        if flush is not None:
+            wait = min(wait, flush)
 
-    # watch the directory using inotify 0.2.10
+        return max(0, min(wait, max_wait))
+
+    # watch the directory using inotify,
+    # only the syscall wrappers of the inotify module are used
     def run_inotify(self):
         from gevent import select
-        import inotify
-        from inotify import adapters
-        from inotify import constants
+        import inotify.calls
+        import inotify.constants as c
+
+        mask = c.IN_CLOSE_WRITE | c.IN_MOVED_TO
+        fd = inotify.calls.inotify_init()
+        inotify.calls.inotify_add_watch(fd, os.fsencode(self.path), mask)
+
+        header = struct.Struct("iIII")
+        buf = b""
 
-        mask = inotify.constants.IN_CLOSE_WRITE | inotify.constants.IN_MOVED_TO
-        watcher = inotify.adapters.Inotify()
-        watcher.add_watch(self.path, mask)
-        fd = watcher._Inotify__inotify_fd
+        # the files already there
+        self.scan_dir()
 
         while True:
-            c = self.process_dir()
-
-            # if process_dir return true, we restart this loop
-            # but we still need to flush watcher (or it will go out of buf)
-            wait_time = 30
-            if c:
-                wait_time = 1
-
-            r = select.select([fd], [], [], wait_time)
-
-            if len(r[0]) == 0:
-                # timeout
-                pass
-            elif r[0][0] == fd:
-                # clear the events
-                for event in watcher.event_gen(0.01, yield_nones=False):
-                    pass
-                pass
-            else:
-                self.log.warning("bad return from select: %s", str(r))
-
-    # old version of "watcher" and "inotify" python modules is used here
-    def run_inotify_old(self):
-        from gevent import select
-        import _inotify as inotify
-        import watcher
+            self.process_pending()
 
-        mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
-        w = watcher.Watcher()
+            r, w, x = select.select([fd], [], [], self.wait_time(30))
+            if fd in r:
+                buf += os.read(fd, 64 * 1024)
 
-        w.add(self.path, mask)
+                while len(buf) >= header.size:
+                    wd, ev_mask, cookie, length = header.unpack_from(buf)
+                    if len(buf) < header.size + length:
+                        break
 
-        fd = w.fileno()
+                    name = buf[header.size : header.size + length].rstrip(b"\0")
+                    buf = buf[header.size + length :]
 
-        while True:
-            c = self.process_dir()
-
-            # if process_dir return true, we restart it
-            # but we still need to flush watcher (or it will go out of buf)
-            wait_time = 30
-            if c:
-                wait_time = 1
-
-            r = select.select([fd], [], [], wait_time)
-
-            if len(r[0]) == 0:
-                # timeout
-                pass
-            elif r[0][0] == fd:
-                # clear the events
-                # this sometimes fails due to a bug in inotify
-                for event in w.read(bufsize=0):
-                    # self.log.info("got event %s", repr(event))
-                    pass
-
-                pass
-            else:
-                self.log.warning("bad return from select: %s", str(r))
+                    if ev_mask & c.IN_Q_OVERFLOW:
+                        self.log.warning("Inotify queue overflow, rescanning.")
+                        self.last_scan = 0
+                    elif name:
+                        self.queue_file(os.fsdecode(name))
+
+            if time.time() - self.last_scan >= self.rescan_interval:
+                self.scan_dir()
 
     def run_slow(self):
         import gevent
 
         while True:
-            c = self.process_dir()
-            wait_time = 30
-            if c:
-                wait_time = 1
+            if time.time() - self.last_scan >= 5:
+                self.scan_dir()
 
-            gevent.sleep(wait_time)
+            self.process_pending()
+            next_scan = self.last_scan + 5 - time.time()
+            gevent.sleep(max(0, min(self.wait_time(5), next_scan)))
 
     def run_greenlet(self):
         # check if web server running
@@ -66,12 +66,9 @@ class FFFMonitoringTest(object):
         doc["memory_free"] = meminfo["MemFree"] * 1024
         doc["memory_total"] = meminfo["MemTotal"] * 1024
 
-        body = json.dumps(doc, indent=True)
+        fff_filemonitor.submit_report(doc, self.path)
 
-        final_fp = os.path.join(self.path, doc["_id"] + ".jsn")
-        fff_filemonitor.atomic_create_write(final_fp, body)
-
-        return final_fp
+        return doc["_id"]
 
     def run_greenlet(self):
         import gevent
@@ -17,7 +17,7 @@ import shutil
 import socket
 import logging
 
-from applets.fff_filemonitor import atomic_create_write
+from applets.fff_filemonitor import atomic_create_write, submit_report
 
 
 # usually atomic_create_write writes files with 0600 mask.
@@ -103,11 +103,9 @@ class SimulatorRun(object):
                 status["run"],
             )
 
-            final_fp = os.path.join(self.report_directory, status["_id"] + ".jsn")
-            body = json.dumps(status, indent=None)
-            atomic_create_write(final_fp, body)
+            submit_report(status, self.report_directory)
 
-            log.info("Made report file: %s", final_fp)
+            log.info("Made report: %s", status["_id"])
 
     def run_unsafe(self):
         """
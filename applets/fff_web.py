@@ -15,30 +15,647 @@ import bottle
 import zlib
 import itertools
 import requests
+import gevent
+import gevent.event
+import gevent.queue
+import gevent.threadpool
+import bisect
+import array
+import uuid
+import shlex
+import threading
+import collections
+import mimetypes
+import email.utils
+import stat
 
 log = logging.getLogger(__name__)
 
 from ws4py.websocket import WebSocket
-from ws4py.client.threadedclient import WebSocketClient
+
+
+class HeaderIndex(object):
+    """
+    Rev-ordered, in-memory copy of the Headers table.
+
+    Headers are kept as tuples (in the HEADER_COLUMNS order) in a list
+    parallel to a sorted array of revs, so a sync from any rev
+    is a bisect and a slice.
+    Deleted (or replaced) entries are left as None and compacted later.
+    """
+
+    HEADER_COLUMNS = ("id", "rev", "timestamp", "type", "hostname", "tag", "run")
+
+    # entries are also grouped into fixed-size blocks (by position),
+    # every change to an existing block bumps its version,
+    # moving entries around bumps the generation
+    BLOCK_SIZE = 1000
+
+    def __init__(self):
+        self.generation = 0
+        self.clear()
+
+    def clear(self):
+        self.revs = array.array("q")
+        self.entries = []
+        self.positions = {}  # id -> rev
+        self.dead = 0
+
+        self.generation += 1
+        self.block_versions = {}
+
+    def _touch(self, i):
+        b = i // self.BLOCK_SIZE
+        self.block_versions[b] = self.block_versions.get(b, 0) + 1
+
+    def __len__(self):
+        return len(self.entries) - self.dead
+
+    def _kill(self, id):
+        rev = self.positions.pop(id, None)
+        if rev is None:
+            return
+
+        i = bisect.bisect_left(self.revs, rev)
+        if i < len(self.revs) and self.revs[i] == rev:
+            self.entries[i] = None
+            self.dead += 1
+            self._touch(i)
+
+    def _compact(self):
+        alive = [i for i, e in enumerate(self.entries) if e is not None]
+        self.revs = array.array("q", (self.revs[i] for i in alive))
+        self.entries = [self.entries[i] for i in alive]
+        self.dead = 0
+
+        self.generation += 1
+        self.block_versions = {}
+
+    def _maybe_compact(self):
+        if self.dead > 1024 and self.dead * 2 > len(self.entries):
+            self._compact()
+
+    def _trim(self):
+        # drop deleted entries from the tail
+        # revs of deleted headers can be re-used by the next upload
+        while self.entries and self.entries[-1] is None:
+            self.entries.pop()
+            self.revs.pop()
+            self.dead -= 1
+
+    def add(self, entry):
+        id, rev = entry[0], entry[1]
+        self._kill(id)
+
+        if self.revs and rev <= self.revs[-1]:
+            self._trim()
+
+        if self.revs and rev <= self.revs[-1]:
+            # should not happen, revs only increase
+            i = bisect.bisect_left(self.revs, rev)
+            self.revs.insert(i, rev)
+            self.entries.insert(i, entry)
+
+            self.generation += 1
+            self.block_versions = {}
+        else:
+            self.revs.append(rev)
+            self.entries.append(entry)
+
+        self.positions[id] = rev
+
+        # replacing a document leaves its old slot behind
+        self._maybe_compact()
+
+    def update(self, headers):
+        for h in headers:
+            self.add(
+                (
+                    h["_id"],
+                    h["_rev"],
+                    h["timestamp"],
+                    h["type"],
+                    h["hostname"],
+                    h["tag"],
+                    h["run"],
+                )
+            )
+
+    def remove(self, ids):
+        for id in ids:
+            self._kill(id)
+
+        self._trim()
+        self._maybe_compact()
+
+    def last_rev(self):
+        self._trim()
+        return self.revs[-1] if self.revs else None
+
+    def find(self, from_rev=None):
+        # position of the first entry with rev > from_rev
+        if from_rev is None:
+            return 0
+
+        return bisect.bisect_right(self.revs, int(from_rev))
+
+    def get(self, from_rev=None):
+        i = self.find(from_rev)
+        return [e for e in self.entries[i:] if e is not None]
+
+    @staticmethod
+    def make_header(entry):
+        # same layout as Database.make_header_from_entry()
+        id, rev, timestamp, type, hostname, tag, run = entry
+        return {
+            "timestamp": timestamp,
+            "type": type,
+            "hostname": hostname,
+            "tag": tag,
+            "run": run,
+            "_id": id,
+            "_rev": rev,
+        }
+
+
+class HeaderFrameCache(object):
+    """
+    Pre-encoded "headers" json for the HeaderIndex blocks.
+
+    Most clients ask for the same full snapshot, so the json for every
+    full block is kept until the block changes; a sync only encodes
+    the (partial) first block and whatever is not cached yet.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.generation = None
+        self.blocks = {}
+
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+        }
+
+    def encode(self, entries):
+        make_header = self.index.make_header
+        headers = [make_header(e) for e in entries if e is not None]
+        if not headers:
+            return None
+
+        return (
+            headers[0]["_rev"],
+            headers[-1]["_rev"],
+            len(headers),
+            json.dumps(headers),
+        )
+
+    def get_chunks(self, from_rev=None):
+        """
+        Returns a list of (first_rev, last_rev, count, headers_json)
+        covering all the headers newer than from_rev.
+        """
+        index = self.index
+        entries = index.entries
+        bs = index.BLOCK_SIZE
+
+        if self.generation != index.generation:
+            self.generation = index.generation
+            self.blocks = {}
+
+        chunks = []
+        i = index.find(from_rev)
+        while i < len(entries):
+            b = i // bs
+            end = min((b + 1) * bs, len(entries))
+
+            if i != b * bs:
+                chunk = self.encode(entries[i:end])
+            else:
+                key = (index.block_versions.get(b, 0), end - i)
+                cached = self.blocks.get(b, None)
+                if cached is not None and cached[0] == key:
+                    self.stats["hits"] += 1
+                else:
+                    self.stats["misses"] += 1
+                    cached = (key, self.encode(entries[i:end]))
+                    self.blocks[b] = cached
+
+                chunk = cached[1]
+
+            if chunk is not None:
+                chunks.append(chunk)
+
+            i = end
+
+        return chunks
+
+
+class HeaderFilter(object):
+    """
+    Restricts a sync to the matching headers, from the sync_request:
+        {"event": "sync_request", "known_rev": ..., "filter": {
+            "since": ts, "until": ts, "max_age": seconds,
+            "type": ..., "tag": ..., "hostname": ..., "run": ...}}
+
+    The type, tag, hostname and run can be a value or a list of values.
+    The initial sync is an sql query (see Database.get_filtered_headers),
+    the live updates are matched in memory.
+    """
+
+    FIELDS = ("type", "tag", "hostname", "run")
+
+    def __init__(
+        self,
+        since=None,
+        until=None,
+        max_age=None,
+        type=None,
+        tag=None,
+        hostname=None,
+        run=None,
+    ):
+        self.since = since
+        self.until = until
+        self.max_age = max_age
+
+        self.values = {}
+        for k, v in zip(self.FIELDS, (type, tag, hostname, run)):
+            if v is None:
+                continue
+
+            if not isinstance(v, list):
+                v = [v]
+
+            self.values[k] = v
+
+    @classmethod
+    def from_json(cls, jsn):
+        if not jsn:
+            return None
+
+        if not isinstance(jsn, dict):
+            raise ValueError("Invalid filter: %s" % repr(jsn))
+
+        unknown = set(jsn.keys()) - set(("since", "until", "max_age") + cls.FIELDS)
+        if unknown:
+            raise ValueError("Invalid filter keys: %s" % ", ".join(sorted(unknown)))
+
+        return cls(**jsn)
+
+    def get_since(self):
+        since = self.since
+        if self.max_age is not None:
+            x = time.time() - self.max_age
+            if since is None or x > since:
+                since = x
+
+        return since
+
+    def match(self, header):
+        since = self.get_since()
+        ts = header.get("timestamp")
+
+        if since is not None and (ts is None or ts < since):
+            return False
+
+        if self.until is not None and (ts is None or ts > self.until):
+            return False
+
+        for k, v in self.values.items():
+            if header.get(k) not in v:
+                return False
+
+        return True
+
+    def where(self):
+        """Returns the sql condition and its parameters."""
+        conds = []
+        params = []
+
+        since = self.get_since()
+        if since is not None:
+            conds.append("timestamp >= ?")
+            params.append(since)
+
+        if self.until is not None:
+            conds.append("timestamp <= ?")
+            params.append(self.until)
+
+        for k, v in sorted(self.values.items()):
+            conds.append("%s IN (%s)" % (k, ",".join("?" * len(v))))
+            params.extend(v)
+
+        return " AND ".join(conds), params
+
+    def __repr__(self):
+        d = dict(self.values)
+        for k in ("since", "until", "max_age"):
+            if getattr(self, k) is not None:
+                d[k] = getattr(self, k)
+
+        return "HeaderFilter(%s)" % json.dumps(d, sort_keys=True)
+
+
+class DocumentCodec(object):
+    """
+    Compresses the document bodies, optionally with a per-type
+    preset dictionary (zlib zdict), see utils/compress_db.py.
+
+    Dictionaries are never modified, a retrained one gets a new
+    version. Every row keeps the version it was compressed with
+    (NULL for plain zlib), so rows of all versions can be read.
+    """
+
+    # zlib only looks this far back
+    MAX_DICTIONARY_SIZE = 32 * 1024
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+
+        self.dictionaries = {}  # version -> zdict
+        self.current = {}  # type -> latest version
+
+    def load(self, conn):
+        c = conn.cursor()
+        c.execute("SELECT version, type, body FROM Dictionaries ORDER BY version ASC")
+        for version, type, body in c.fetchall():
+            self.dictionaries[version] = bytes(body)
+            self.current[type] = version
+        c.close()
+
+    def get_dictionary(self, conn, version):
+        zdict = self.dictionaries.get(version, None)
+        if zdict is not None:
+            return zdict
+
+        # trained after we have started
+        c = conn.cursor()
+        c.execute("SELECT body FROM Dictionaries WHERE version = ?", (version,))
+        r = c.fetchone()
+        c.close()
+
+        if r is None:
+            raise KeyError("Unknown compression dictionary: %s" % version)
+
+        zdict = self.dictionaries[version] = bytes(r[0])
+        return zdict
+
+    def compress(self, body, type=None):
+        """Returns a tuple (compressed body, dictionary version or None)."""
+        version = None
+        if self.enabled:
+            version = self.current.get(type, None)
+
+        if version is None:
+            return zlib.compress(body), None
+
+        c = zlib.compressobj(zdict=self.dictionaries[version])
+        return c.compress(body) + c.flush(), version
+
+    def decompress(self, conn, body, version):
+        if version is None:
+            return zlib.decompress(body)
+
+        d = zlib.decompressobj(zdict=self.get_dictionary(conn, version))
+        return d.decompress(body) + d.flush()
+
+    def add_dictionary(self, db, type, zdict):
+        # this runs inside a write transaction
+        c = db.cursor()
+        c.execute(
+            "INSERT INTO Dictionaries (type, body, timestamp) VALUES (?, ?, ?)",
+            (type, sqlite3.Binary(zdict), time.time()),
+        )
+        version = c.lastrowid
+        c.close()
+
+        self.dictionaries[version] = zdict
+        self.current[type] = version
+        return version
+
+    @classmethod
+    def train(cls, samples, size=None):
+        """
+        Builds a dictionary from sample bodies (json bytes, oldest first).
+
+        Documents of the same type mostly differ in values, so the
+        samples themselves make a good dictionary. zlib prefers
+        the matches closer to the end, so the newest samples go last.
+        """
+        size = size or cls.MAX_DICTIONARY_SIZE
+
+        seen = set()
+        zdict = b""
+        for sample in samples:
+            if sample in seen:
+                continue
+
+            seen.add(sample)
+            zdict = (zdict + sample)[-size:]
+
+        return zdict
+
+
+class DatabaseReadPool(object):
+    """
+    A small pool of read-only connections (WAL mode only).
+    Queries run in the database's threadpool, so readers don't stall
+    the event loop (or each other) behind the writer's fsyncs.
+    """
+
+    def __init__(self, db_str, threadpool, size=4):
+        import urllib.request
+
+        uri = "file:%s?mode=ro" % urllib.request.pathname2url(os.path.abspath(db_str))
+
+        self.size = size
+        self.threadpool = threadpool
+        self.conns = gevent.queue.Queue()
+        for i in range(size):
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self.conns.put(conn)
+
+    def apply(self, fn, *args):
+        conn = self.conns.get()
+        try:
+            return self.threadpool.apply(fn, (conn,) + args)
+        finally:
+            self.conns.put(conn)
+
+
+class DatabaseWriter(object):
+    """
+    Single writer for the WAL mode.
+    All the write operations are queued (the queue is bounded, so uploaders
+    block instead of piling up) and everything queued at the time is
+    committed in a single transaction (group commit).
+    """
+
+    def __init__(self, db, max_queue=64, max_batch=256):
+        self.db = db
+        self.max_batch = max_batch
+        self.queue = gevent.queue.Queue(maxsize=max_queue)
+
+        self.stats = {
+            "transactions": 0,
+            "operations": 0,
+            "max_batch": 0,
+        }
+
+        self.greenlet = gevent.spawn(self.run)
+
+    def submit(self, fn, *args, **kwargs):
+        # after_commit is called (in order) from the writer greenlet
+        after_commit = kwargs.get("after_commit", None)
+
+        result = gevent.event.AsyncResult()
+        self.queue.put((fn, args, after_commit, result))
+        return result.get()
+
+    def execute_batch(self, conn, batch):
+        # runs in a threadpool thread
+        # returns a list of (is_ok, value)
+        results = []
+        try:
+            with conn:
+                for fn, args, after_commit, result in batch:
+                    results.append((True, fn(conn, *args)))
+
+            return results
+        except Exception:
+            if len(batch) == 1:
+                raise
+
+        # one of the operations failed, so the transaction was rolled back
+        # retry everything separately, so only the faulty one fails
+        results = []
+        for fn, args, after_commit, result in batch:
+            try:
+                with conn:
+                    results.append((True, fn(conn, *args)))
+            except Exception as e:
+                results.append((False, e))
+
+        return results
+
+    def run(self):
+        threadpool = self.db.threadpool
+
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                results = threadpool.apply(self.execute_batch, (self.db.conn, batch))
+            except Exception as e:
+                log.warning("Database write failed.", exc_info=True)
+                results = [(False, e)] * len(batch)
+
+            self.stats["transactions"] += 1
+            self.stats["operations"] += len(batch)
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+
+            for (fn, args, after_commit, result), (ok, value) in zip(batch, results):
+                if not ok:
+                    result.set_exception(value)
+                    continue
+
+                if after_commit is not None:
+                    try:
+                        after_commit(value)
+                    except:
+                        log.warning("Post-commit hook failed.", exc_info=True)
+
+                result.set(value)
 
 
 class Database(object):
-    def __init__(self, db=None):
+    # sqlite versions before 3.32 allow at most 999 variables per query
+    MAX_VARIABLES = 500
+
+    # see create_tables()
+    SCHEMA_VERSION = 2
+
+    def __init__(self, db=None, wal=False, readers=4, zdict=False):
         self.db_str = db
 
         if not self.db_str:
             self.db_str = ":memory:"
 
+        # in-memory databases can't be shared between connections
+        self.wal = wal and self.db_str != ":memory:"
+
         self.listeners = []
-        self.conn = sqlite3.connect(self.db_str)
+        self.conn = sqlite3.connect(self.db_str, check_same_thread=not self.wal)
+
+        # lets the retention give the free pages back, see DatabaseRetention
+        # only applies to new databases (existing ones need a VACUUM)
+        # and has to come before switching to WAL
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+        if self.wal:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
 
         # create tables if none
         self.create_tables()
 
+        self.codec = DocumentCodec(enabled=zdict)
+        self.codec.load(self.conn)
+
+        self.read_pool = None
+        self.writer = None
+        self.threadpool = None
+        if self.wal:
+            # not the hub's threadpool, which is shared with the http
+            # client (and the dns resolver), slow nodes would stall the syncs
+            self.threadpool = gevent.threadpool.ThreadPool(readers + 1)
+            self.read_pool = DatabaseReadPool(
+                self.db_str, self.threadpool, size=readers
+            )
+            self.writer = DatabaseWriter(self)
+
+        self.index = HeaderIndex()
+        self.frame_cache = HeaderFrameCache(self.index)
+        self.load_index()
+
+        # set by the web applet
+        self.retention = None
+        self.upload_stats = {"documents": 0, "collapsed": 0, "stale": 0}
+
+    def execute_read(self, fn, *args):
+        """Runs fn(conn, *args) on a (possibly pooled) read connection."""
+        if self.read_pool is None:
+            return fn(self.conn, *args)
+
+        return self.read_pool.apply(fn, *args)
+
+    def execute_write(self, fn, *args, **kwargs):
+        """
+        Runs fn(conn, *args) inside a write transaction
+        and returns its result. The after_commit(result) hook is called
+        once the transaction is commited.
+        """
+        after_commit = kwargs.get("after_commit", None)
+
+        if self.writer is not None:
+            return self.writer.submit(fn, *args, after_commit=after_commit)
+
+        with self.conn as db:
+            r = fn(db, *args)
+
+        if after_commit is not None:
+            after_commit(r)
+
+        return r
+
     def drop_tables(self):
         cur = self.conn.cursor()
         cur.execute("DROP TABLE IF EXISTS Headers")
         cur.execute("DROP TABLE IF EXISTS Documents")
+        cur.execute("DROP TABLE IF EXISTS Dictionaries")
 
         self.conn.commit()
         cur.close()
@@ -66,18 +683,62 @@ class Database(object):
         CREATE TABLE IF NOT EXISTS Documents (
             id TEXT PRIMARY KEY NOT NULL,
             rev INT,
-            body BLOB
+            body BLOB,
+            dict_version INT
+        )"""
+        )
+
+        cur.execute(
+            """
+        CREATE TABLE IF NOT EXISTS Dictionaries (
+            version INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            body BLOB NOT NULL,
+            timestamp TIMESTAMP
         )"""
         )
 
+        # databases created before the compression dictionaries
+        cur.execute("PRAGMA table_info(Documents)")
+        if "dict_version" not in [x[1] for x in cur.fetchall()]:
+            cur.execute("ALTER TABLE Documents ADD COLUMN dict_version INT")
+
         cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS M_rev_index ON Headers (rev)")
         cur.execute(
             "CREATE INDEX IF NOT EXISTS M_timestamp_index ON Headers (timestamp)"
         )
 
+        # PRAGMA user_version is the schema version
+        cur.execute("PRAGMA user_version")
+        if cur.fetchone()[0] < self.SCHEMA_VERSION:
+            self.migrate_indexes(cur)
+            cur.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
         self.conn.commit()
         cur.close()
 
+    def migrate_indexes(self, cur):
+        """
+        (field, rev) indexes for the lookups by run, type, hostname
+        and tag: "WHERE field IN (...) AND rev > ? ORDER BY rev" is
+        a range search, the rows are then read by their rowid.
+
+        Indexes covering all the columns (schema version 1) saved those
+        reads, but were a copy of the table each, for every upload
+        (see utils/benchmark_db.py runs).
+        """
+        log.info("Creating the Headers indexes, this can take a while.")
+
+        for column in HeaderFilter.FIELDS:
+            # single column (version 0) and covering (version 1) indexes
+            cur.execute("DROP INDEX IF EXISTS M_%s_index" % column)
+            cur.execute("DROP INDEX IF EXISTS M_%s_rev_index" % column)
+
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS M_%s_rev_index ON Headers (%s, rev)"
+                % (column, column)
+            )
+
     def make_header(self, doc, rev=None, write_back=False):
         header = {
             "_id": doc.get("_id"),
@@ -95,6 +756,115 @@ class Database(object):
 
         return header
 
+    @classmethod
+    def splice_header(cls, body, header):
+        """
+        Sets the header fields in the json object in body (bytes),
+        so the stored document is the same as with write_back=True,
+        but the original json is never re-encoded: the top level fields
+        are copied as they are, except for the ones in the header,
+        which are replaced (json parsers differ on duplicate keys).
+        """
+        text = body.decode("utf-8") if isinstance(body, bytes) else body
+        decode = cls._json_decoder.raw_decode
+        space = cls._json_space.match
+
+        i = space(text, 0).end()
+        if text[i : i + 1] != "{":
+            raise ValueError("Document is not a json object.")
+
+        fields = []
+        c, i = "{", i + 1
+        while c != "}":
+            i = space(text, i).end()
+            if c == "{" and text[i : i + 1] == "}":
+                i += 1
+                break
+
+            start = i
+            key, i = decode(text, i)
+            i = space(text, i).end()
+            if not isinstance(key, str) or text[i : i + 1] != ":":
+                raise ValueError("Expecting a key at %d." % start)
+
+            _, i = decode(text, space(text, i + 1).end())
+            if key not in header:
+                fields.append(text[start:i])
+
+            i = space(text, i).end()
+            c = text[i : i + 1]
+            if c not in (",", "}"):
+                raise ValueError("Expecting one of ',}' at %d." % i)
+            i += 1
+
+        if space(text, i).end() != len(text):
+            raise ValueError("Extra data at %d." % i)
+
+        for k, v in header.items():
+            fields.append(json.dumps(k) + ": " + json.dumps(v))
+
+        return ("{" + ", ".join(fields) + "}").encode("utf-8")
+
+    _json_decoder = json.JSONDecoder()
+    _json_space = re.compile(r"[ \t\n\r]*")
+
+    @classmethod
+    def split_upload(cls, body):
+        """
+        Parses an upload ({"docs": [...]}) into a list of (doc, raw)
+        tuples, raw being the exact bytes of every document,
+        which can be stored with splice_header() as they are.
+        """
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+
+        decode = cls._json_decoder.raw_decode
+        space = cls._json_space.match
+
+        def expect(i, chars):
+            i = space(body, i).end()
+            if i >= len(body) or body[i] not in chars:
+                raise ValueError("Expecting one of %r at %d." % (chars, i))
+            return body[i], i + 1
+
+        documents = None
+        c, i = expect(0, "{")
+        i = space(body, i).end()
+        if i < len(body) and body[i] == "}":
+            c = "}"
+
+        while c != "}":
+            key, i = decode(body, space(body, i).end())
+            _, i = expect(i, ":")
+            i = space(body, i).end()
+
+            if key != "docs" or body[i : i + 1] != "[":
+                _, i = decode(body, i)
+                c, i = expect(i, ",}")
+                continue
+
+            documents = []
+            c, i = expect(i, "[")
+            i = space(body, i).end()
+            if body[i : i + 1] == "]":
+                c, i = expect(i, "]")
+
+            while c != "]":
+                start = space(body, i).end()
+                doc, i = decode(body, start)
+                documents.append((doc, body[start:i].encode("utf-8")))
+                c, i = expect(i, ",]")
+
+            c, i = expect(i, ",}")
+
+        if space(body, i).end() != len(body):
+            raise ValueError("Extra data at %d." % i)
+
+        if documents is None:
+            raise KeyError("docs")
+
+        return documents
+
     def make_header_from_entry(self, dct):
         header = dict(dct)
         header["_id"] = header["id"]
@@ -105,15 +875,28 @@ class Database(object):
 
         return header
 
-    def prepare_docs(self, c, decode=True):
+    def prepare_docs(self, c, decode=True, decompress=None):
+        # decompress=True, decode=False gives the stored json bytes
+        if decompress is None:
+            decompress = decode
+
         columns = list(map(lambda x: x[0], c.description))
         body_column = columns.index("body")
+        version_column = None
+        if "dict_version" in columns:
+            version_column = columns.index("dict_version")
 
         for x in c.fetchall():
             body = x[body_column]
 
+            if decompress:
+                version = None
+                if version_column is not None:
+                    version = x[version_column]
+
+                body = self.codec.decompress(c.connection, body, version)
+
             if decode:
-                body = zlib.decompress(body)
                 body = json.loads(body)
 
             yield body
@@ -127,30 +910,161 @@ class Database(object):
 
             yield hit
 
+    def load_index(self):
+        def read(db):
+            c = db.cursor()
+            c.execute(
+                "SELECT id, rev, timestamp, type, hostname, tag, run FROM Headers ORDER BY rev ASC"
+            )
+            entries = c.fetchall()
+            c.close()
+            return entries
+
+        entries = self.execute_read(read)
+
+        self.index.clear()
+        for entry in entries:
+            self.index.add(tuple(entry))
+
+        log.info("Loaded %d headers into the index.", len(self.index))
+
     def get_headers(self, reload=False, from_rev=None):
-        with self.conn as db:
+        # served from the in-memory index, no sql here
+        if reload:
+            self.load_index()
+
+        make_header = self.index.make_header
+        return [make_header(e) for e in self.index.get(from_rev=from_rev)]
+
+    def make_filtered_query(self, flt, from_rev=None):
+        where, params = flt.where()
+        if from_rev is not None:
+            where = " AND ".join(filter(None, ["rev > ?", where]))
+            params = [from_rev] + params
+
+        sql = "SELECT id, rev, timestamp, type, hostname, tag, run FROM Headers"
+        if where:
+            sql += " WHERE " + where
+        sql += " ORDER BY rev ASC"
+
+        return sql, params
+
+    def get_filtered_headers(self, flt, from_rev=None):
+        # filtered syncs are rare, so they go to the database (and its indexes)
+        sql, params = self.make_filtered_query(flt, from_rev=from_rev)
+
+        def read(db):
             c = db.cursor()
-            if from_rev is None:
-                c.execute(
-                    "SELECT id, rev, timestamp, type, hostname, tag, run FROM Headers ORDER BY rev ASC"
-                )
-            else:
-                from_rev = int(from_rev)
-                c.execute(
-                    "SELECT id, rev, timestamp, type, hostname, tag, run FROM Headers WHERE rev > ? ORDER BY rev ASC",
-                    (from_rev,),
-                )
+            c.execute(sql, params)
+            entries = c.fetchall()
+            c.close()
+            return entries
+
+        make_header = self.index.make_header
+        return [make_header(e) for e in self.execute_read(read)]
+
+    def check_query_plans(self):
+        """
+        Runs EXPLAIN QUERY PLAN for the typical header lookups,
+        a lookup is "ok" if it doesn't scan the whole table.
+        """
+        queries = {
+            "run": HeaderFilter(run=1),
+            "type": HeaderFilter(type="dqm-stats"),
+            "hostname": HeaderFilter(hostname="localhost"),
+            "tag": HeaderFilter(tag="tag"),
+            "timestamp": HeaderFilter(since=0, until=1),
+            "type_since_rev": HeaderFilter(type="dqm-stats", max_age=3600),
+        }
 
-            headers = list(self.prepare_headers(c))
+        def read(db):
+            c = db.cursor()
+            plans = {}
+            for name, flt in sorted(queries.items()):
+                from_rev = 1 if name.endswith("_rev") else None
+                sql, params = self.make_filtered_query(flt, from_rev=from_rev)
+
+                c.execute("EXPLAIN QUERY PLAN " + sql, params)
+                details = [x[-1] for x in c.fetchall()]
+                plans[name] = {
+                    "ok": not any(d.startswith("SCAN") for d in details),
+                    "plan": details,
+                }
             c.close()
+            return plans
 
-        # self.find_first_rev(3600*24*16)
+        return self.execute_read(read)
 
-        return headers
+    def get_header_chunks(self, from_rev=None):
+        # same as get_headers(), but pre-encoded, see HeaderFrameCache
+        return self.frame_cache.get_chunks(from_rev=from_rev)
+
+    def iter_document_batches(self, ids, decode=True, decompress=None):
+        """
+        Yields lists of documents, one query per MAX_VARIABLES ids,
+        so neither sqlite's variable limit nor the memory
+        depend on the number of requested ids.
+        """
+        ids = list(ids)
+
+        def read(db, batch):
+            c = db.cursor()
+
+            IN = "(" + ",".join("?" * len(batch)) + ")"
+            c.execute(
+                "SELECT id, body, dict_version FROM Documents WHERE id IN " + IN, batch
+            )
+
+            docs = list(self.prepare_docs(c, decode=decode, decompress=decompress))
+            c.close()
+            return docs
+
+        for i in range(0, len(ids), self.MAX_VARIABLES):
+            yield self.execute_read(read, ids[i : i + self.MAX_VARIABLES])
+
+    def get_documents(self, ids, decode=True):
+        return list(itertools.chain(*self.iter_document_batches(ids, decode=decode)))
+
+    def get_stored_document(self, id):
+        """
+        Returns (body, compressed) for the document or None.
+        The body is the stored zlib stream if it can be used as is,
+        dictionary compressed documents are decompressed.
+        """
+
+        def read(db):
+            c = db.cursor()
+            c.execute("SELECT body, dict_version FROM Documents WHERE id = ?", (id,))
+            r = c.fetchone()
+            c.close()
+
+            if r is None:
+                return None
+
+            body, version = r
+            if version is None:
+                return bytes(body), True
+
+            return self.codec.decompress(db, body, version), False
+
+        return self.execute_read(read)
+
+    def get_size(self):
+        def read(db):
+            c = db.cursor()
+            c.execute("PRAGMA page_size")
+            ps = c.fetchone()[0]
+            c.execute("PRAGMA page_count")
+            pc = c.fetchone()[0]
+            c.close()
+            return ps * pc
+
+        return self.execute_read(read)
 
     def find_first_rev(self, seconds):
         x = time.time() - seconds
-        with self.conn as db:
+
+        def read(db):
             c = db.cursor()
             c.execute(
                 "SELECT rev, timestamp FROM Headers WHERE timestamp >= ? ORDER BY rev ASC LIMIT 1",
@@ -160,265 +1074,1711 @@ class Database(object):
 
             c.close()
 
-    def direct_transactional_upload(self, bodydoc_generator):
-        headers = []  # this is used to notify websockets
-        with self.conn as db:
-            rev = None
+            if r is None:
+                return None
+
+            return r[0]
 
-            def get_last_rev():
-                cur = db.cursor()
-                x = cur.execute("SELECT MAX(rev) FROM Headers")
-                r = x.fetchone()[0] or 0
-                cur.close()
-                return r
+        return self.execute_read(read)
 
-            for body in bodydoc_generator:
-                if rev is None:
-                    rev = get_last_rev()
+    def drop_stale_documents(self, db, docs):
+        """
+        Drops the (doc, body) items older (by their header timestamp)
+        than the stored version of the same _id.
+        Returns the kept items and the number of dropped ones.
+        """
+        ids = [doc.get("_id") for doc, body in docs]
 
-                # get the document
+        stored = {}
+        for i in range(0, len(ids), self.MAX_VARIABLES):
+            batch = ids[i : i + self.MAX_VARIABLES]
+            IN = "(" + ",".join("?" * len(batch)) + ")"
+            c = db.execute("SELECT id, timestamp FROM Headers WHERE id IN " + IN, batch)
+            stored.update(c.fetchall())
+            c.close()
+
+        numbers = (int, float)
+        kept = []
+        for doc, body in docs:
+            prev_ts = stored.get(doc.get("_id"), None)
+            ts = self.make_header(doc)["timestamp"]
+
+            if isinstance(ts, numbers) and isinstance(prev_ts, numbers):
+                if ts < prev_ts:
+                    continue
+
+            kept.append((doc, body))
+
+        return kept, len(docs) - len(kept)
+
+    def insert_documents(self, db, bodydoc_generator):
+        # this runs inside a write transaction (and might be retried, so
+        # it doesn't touch anything else), returns (headers, stats)
+        headers = []  # this is used to notify websockets
+        rev = None
+
+        def get_last_rev():
+            cur = db.cursor()
+            x = cur.execute("SELECT MAX(rev) FROM Headers")
+            r = x.fetchone()[0] or 0
+            cur.close()
+            return r
+
+        # (doc, raw body or None)
+        docs = []
+        for body in bodydoc_generator:
+            if isinstance(body, tuple):
+                # already parsed, see split_upload()
+                docs.append(body)
+            elif isinstance(body, (str, bytes)):
                 if isinstance(body, str):
-                    doc = json.loads(body)
-                else:
-                    doc = body
+                    body = body.encode("utf-8")
+
+                docs.append((json.loads(body), body))
+            else:
+                docs.append((body, None))
+
+        # only the latest version of each _id gets a rev (and a push)
+        docs, collapsed = fff_filemonitor.coalesce_documents(
+            docs, get_doc=lambda x: x[0]
+        )
+
+        # reports can arrive out of order (ie. a fallback file uploaded after
+        # a newer report was sent directly), older ones don't replace the
+        # stored version
+        docs, stale = self.drop_stale_documents(db, docs)
+        stats = {"documents": len(docs), "collapsed": collapsed, "stale": stale}
+
+        for doc, body in docs:
+            if rev is None:
+                rev = get_last_rev()
+
+            # not that we ever overflow it ...
+            rev = (rev + 1) & ((2**63) - 1)
+
+            if body is not None:
+                # raw json is stored as received, only the header is encoded
+                header = self.make_header(doc, rev=rev)
+                body = self.splice_header(body, header)
+            else:
+                # create the header and update the body
+                header = self.make_header(doc=doc, rev=rev, write_back=True)
+                body = json.dumps(doc).encode("utf-8")
+
+            body, version = self.codec.compress(body, type=header.get("type"))
+
+            db.execute(
+                "INSERT OR REPLACE INTO Headers (id, rev, timestamp, type, hostname, tag, run) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    header.get("_id"),
+                    header.get("_rev"),
+                    header.get("timestamp"),
+                    header.get("type"),
+                    header.get("hostname"),
+                    header.get("tag"),
+                    header.get("run"),
+                ),
+            )
+
+            db.execute(
+                "INSERT OR REPLACE INTO Documents (id, rev, body, dict_version) VALUES (?, ?, ?, ?)",
+                (
+                    header.get("_id"),
+                    header.get("_rev"),
+                    sqlite3.Binary(body),
+                    version,
+                ),
+            )
+
+            headers.append(header)
+
+        return headers, stats
+
+    def direct_transactional_upload(self, bodydoc_generator):
+        if self.writer is not None:
+            # the writer runs in a different thread, don't pass generators there
+            bodydoc_generator = list(bodydoc_generator)
+
+        headers, stats = self.execute_write(
+            self.insert_documents,
+            bodydoc_generator,
+            after_commit=self.documents_inserted,
+        )
+        return headers
+
+    def documents_inserted(self, result):
+        # called after the commit (not from the writer thread),
+        # only the committed documents are counted
+        headers, stats = result
+        for k, v in stats.items():
+            self.upload_stats[k] += v
+
+        self.headers_added(headers)
+
+    def headers_added(self, headers):
+        # called after the commit, in the commit order
+        self.index.update(headers)
+        self.update_headers(headers)
+
+    def delete_documents(self, db, ids):
+        # this runs inside a write transaction
+        for id in ids:
+            db.execute("DELETE FROM Headers WHERE id= ?", (id,))
+            db.execute("DELETE FROM Documents WHERE id= ?", (id,))
+
+        return ids
+
+    def drop_ids(self, ids):
+        return self.execute_write(
+            self.delete_documents, list(ids), after_commit=self.headers_removed
+        )
+
+    def headers_removed(self, ids):
+        self.index.remove(ids)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def update_headers(self, headers):
+        # it is possible that listeners list will change
+        # in a different greenlet (ie, exit or something)
+
+        # we don't care, since client should handle
+        # the websocket errors.
+        if len(headers) == 0:
+            return
+
+        copy = list(self.listeners)
+        for client in copy:
+            client.updateHeaders(headers)
+
+
+class DatabaseRetention(object):
+    """
+    Deletes the old documents according to the per-type policies
+    and gives the free pages back to the filesystem.
+
+    Policies are parsed from a string like:
+        "dqm-stats:age=30d,count=5000; dqm-files:bytes=512M; *:age=365d"
+    where "*" applies to every type without its own policy.
+    Each type is limited separately:
+        age: the documents older than this (in seconds, or with an s/m/h/d suffix),
+        count: keeps this many newest documents,
+        bytes: keeps the newest documents up to this (compressed) size.
+
+    The documents are scanned and deleted in small batches (short
+    read and write transactions), so neither the uploads nor the
+    event loop are blocked for long.
+
+    The free pages are only given back with auto_vacuum=INCREMENTAL,
+    which needs a VACUUM for the databases created before it
+    (see utils/compress_db.py vacuum).
+    """
+
+    UNITS = {
+        "s": 1,
+        "m": 60,
+        "h": 60 * 60,
+        "d": 24 * 60 * 60,
+        "k": 1024,
+        "M": 1024**2,
+        "G": 1024**3,
+    }
+
+    def __init__(
+        self,
+        db,
+        policies,
+        batch_size=500,
+        scan_batch_size=2000,
+        interval=600,
+        vacuum_pages=4096,
+    ):
+        self.db = db
+        self.batch_size = batch_size
+        self.scan_batch_size = scan_batch_size
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+
+        if isinstance(policies, str):
+            policies = self.parse_policies(policies)
+        self.policies = policies
+
+        self.stats = {
+            "runs": 0,
+            "deleted": 0,
+            "reclaimed_bytes": 0,
+            "incremental_vacuum": self.check_auto_vacuum(),
+            "last_run": None,
+            "last_duration": None,
+        }
+
+    def check_auto_vacuum(self):
+        def read(db):
+            c = db.cursor()
+            c.execute("PRAGMA auto_vacuum")
+            mode = c.fetchone()[0]
+            c.close()
+            return mode
+
+        # 2 is INCREMENTAL, the pragma in Database() only applies to new files
+        if self.db.execute_read(read) == 2:
+            return True
+
+        log.warning(
+            "The database was created without auto_vacuum=INCREMENTAL, "
+            "the retention can't shrink it: run 'utils/compress_db.py vacuum %s'.",
+            self.db.db_str,
+        )
+        return False
+
+    @classmethod
+    def parse_value(cls, value):
+        if value[-1:] in cls.UNITS:
+            return int(float(value[:-1]) * cls.UNITS[value[-1]])
+
+        return int(value)
+
+    @classmethod
+    def parse_policies(cls, spec):
+        policies = {}
+        for entry in spec.split(";"):
+            entry = entry.strip()
+            if not entry:
+                continue
+
+            type, _, limits = entry.rpartition(":")
+            policy = {}
+            for limit in limits.split(","):
+                key, _, value = limit.strip().partition("=")
+                if key not in ["age", "count", "bytes"]:
+                    raise ValueError("Invalid retention limit: %s" % limit)
+
+                policy["max_" + key] = cls.parse_value(value.strip())
+
+            policies[type.strip() or "*"] = policy
+
+        return policies
+
+    def read_types(self, conn):
+        # the distinct types, by skipping through the (type, rev) index
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM Headers WHERE type IS NULL LIMIT 1")
+        types = [None] if c.fetchone() else []
+
+        last = ""
+        while True:
+            c.execute(
+                "SELECT type FROM Headers WHERE type > ? ORDER BY type LIMIT 1",
+                (last,),
+            )
+            r = c.fetchone()
+            if r is None:
+                break
+
+            last = r[0]
+            types.append(last)
+
+        c.close()
+        return types
+
+    def read_batch(self, conn, type, before_rev, with_sizes):
+        # the next (newest first) headers of a type
+        c = conn.cursor()
+        if with_sizes:
+            c.execute(
+                "SELECT h.id, h.rev, h.timestamp, LENGTH(d.body) FROM Headers h LEFT JOIN Documents d ON d.id = h.id WHERE h.type IS ? AND h.rev < ? ORDER BY h.rev DESC LIMIT ?",
+                (type, before_rev, self.scan_batch_size),
+            )
+        else:
+            c.execute(
+                "SELECT id, rev, timestamp, NULL FROM Headers WHERE type IS ? AND rev < ? ORDER BY rev DESC LIMIT ?",
+                (type, before_rev, self.scan_batch_size),
+            )
+
+        rows = c.fetchall()
+        c.close()
+        return rows
+
+    def find_expired(self):
+        """
+        Walks every type with a policy from the newest document,
+        in batches of scan_batch_size. Without WAL the reads run
+        on the event loop, so it is given back between the batches.
+
+        Yields the expired ids in lists of at most batch_size, they can be
+        deleted right away (the walk continues below the deleted revs).
+        """
+        types = self.db.execute_read(self.read_types)
+
+        expired = []
+        now = time.time()
+        for type in types:
+            policy = self.policies.get(type, self.policies.get("*", None))
+            if not policy:
+                continue
+
+            max_age = policy.get("max_age")
+            max_count = policy.get("max_count")
+            max_bytes = policy.get("max_bytes")
+
+            count, total = 0, 0
+            before_rev = 2**63 - 1
+            while True:
+                rows = self.db.execute_read(
+                    self.read_batch, type, before_rev, max_bytes is not None
+                )
+                if not rows:
+                    break
+
+                for id, rev, timestamp, size in rows:
+                    count += 1
+                    total += size or 0
+
+                    if (
+                        (max_age is not None and (timestamp or now) < now - max_age)
+                        or (max_count is not None and count > max_count)
+                        or (max_bytes is not None and total > max_bytes)
+                    ):
+                        expired.append(id)
+
+                    if len(expired) >= self.batch_size:
+                        yield expired
+                        expired = []
+
+                # sleep(0) would not let the loop poll the sockets
+                before_rev = rows[-1][1]
+                gevent.sleep(0.001)
+
+        if expired:
+            yield expired
+
+    def get_page_count(self):
+        def read(db):
+            c = db.cursor()
+            c.execute("PRAGMA page_size")
+            ps = c.fetchone()[0]
+            c.execute("PRAGMA page_count")
+            pc = c.fetchone()[0]
+            c.close()
+            return ps, pc
+
+        return self.db.execute_read(read)
+
+    def vacuum(self, db):
+        # this runs inside a write transaction
+        # python only steps the pragma once (one page), so it is repeated
+        # in an explicit transaction, otherwise every step is a commit
+        c = db.cursor()
+        if not db.in_transaction:
+            c.execute("BEGIN")
+
+        c.execute("PRAGMA freelist_count")
+        free = c.fetchone()[0]
+        for i in range(min(free, self.vacuum_pages)):
+            c.execute("PRAGMA incremental_vacuum(1)")
+
+        c.close()
+
+    def run_once(self):
+        start = time.time()
+
+        deleted = 0
+        for ids in self.find_expired():
+            self.db.drop_ids(ids)
+            deleted += len(ids)
+            gevent.sleep(0.1)
+
+        page_size, before = self.get_page_count()
+        self.db.execute_write(self.vacuum)
+        page_size, after = self.get_page_count()
+
+        self.stats["runs"] += 1
+        self.stats["deleted"] += deleted
+        self.stats["reclaimed_bytes"] += (before - after) * page_size
+        self.stats["last_run"] = start
+        self.stats["last_duration"] = time.time() - start
+
+        if deleted:
+            log.info(
+                "Retention: deleted %d document(s), reclaimed %d bytes, took %.03fs.",
+                deleted,
+                (before - after) * page_size,
+                self.stats["last_duration"],
+            )
+
+    def run_greenlet(self):
+        while True:
+            try:
+                self.run_once()
+            except:
+                log.warning("Retention run failed.", exc_info=True)
+
+            gevent.sleep(self.interval)
+
+
+class SyncSocket(WebSocket):
+    STATE_NONE = 1
+    STATE_INSYNC = 2
+    STATE_LISTEN = 3
+    STATE_CLOSED = -1
+
+    # limits for a single "update_documents" message
+    DOCUMENTS_PER_MESSAGE = 100
+    DOCUMENTS_BYTES_PER_MESSAGE = 4 * 1024 * 1024
+
+    def opened(self):
+        self.backlog = []
+        self.state = self.STATE_NONE
+        self.close_reason = None
+        self.filter = None
+
+        self.db.add_listener(self)
+
+        log.info("WebSocket connected: %s", self.peer_address)
+
+    def closed(self, code, reason=None, output_log=True):
+        self.db.remove_listener(self)
+
+        if output_log:
+            log.info(
+                "WebSocket disconnected: %s code=%s reason=%s",
+                self.peer_address,
+                code,
+                reason,
+            )
+
+    def received_message(self, msg):
+        # print "recv:", self, msg, type(msg)
+        # sys.stdout.flush()
+
+        jsn = json.loads(msg.data)
+        if jsn["event"] == "sync_request":
+            known_rev = jsn.get("known_rev", None)
+            self.filter = HeaderFilter.from_json(jsn.get("filter", None))
+            self.state = self.STATE_INSYNC
+
+            log.info(
+                "WebSocket client (%s) requested sync from rev %s, filter: %s",
+                self.peer_address,
+                known_rev,
+                self.filter,
+            )
+
+            # if know_rev is not zero, we have to send at least a single header
+            # to let the web interface to know it is synchronized
+            if known_rev is not None:
+                known_rev = int(known_rev) - 1
+
+            # send the current state
+            # if any changes happen during this time
+            # they go into backlog
+            if self.filter is None:
+                self.sendHeaderChunks(self.db.get_header_chunks(from_rev=known_rev))
+            else:
+                headers = self.db.get_filtered_headers(self.filter, from_rev=known_rev)
+                if headers:
+                    self.sendHeaders(headers)
+                else:
+                    self.sendSynced()
+
+            while len(self.backlog):
+                h = self.backlog.pop(0)
+                self.sendHeaders(h)
+
+            self.state = self.STATE_LISTEN
+
+        if jsn["event"] == "request_documents":
+            ids = set(jsn["ids"])
+
+            sent = self.sendDocuments(ids)
+
+            log.info(
+                "WebSocket client (%s) requested %d documents (%d bytes)",
+                self.peer_address,
+                len(ids),
+                sent,
+            )
+
+    def sendDocuments(self, ids):
+        # documents are streamed in bounded messages
+        # the stored json is spliced in as is, without decoding it
+        max_count = self.DOCUMENTS_PER_MESSAGE
+        max_size = self.DOCUMENTS_BYTES_PER_MESSAGE
+
+        sent = [0, 0]  # bytes, messages
+        buf = []
+        buf_size = [0]
+
+        def flush():
+            msg = (
+                b'{"event": "update_documents", "documents": ['
+                + b", ".join(buf)
+                + b"]}"
+            )
+            self.send(msg, False)
+
+            sent[0] += len(msg)
+            sent[1] += 1
+            del buf[:]
+            buf_size[0] = 0
+
+        batches = self.db.iter_document_batches(ids, decode=False, decompress=True)
+        for body in itertools.chain.from_iterable(batches):
+            buf.append(body)
+            buf_size[0] += len(body)
+
+            if len(buf) >= max_count or buf_size[0] >= max_size:
+                flush()
+
+        # always reply, the client waits for it
+        if buf or sent[1] == 0:
+            flush()
+
+        return sent[0]
+
+    def sendHeaders(self, headers):
+        if not headers:
+            return
+
+        # split sending into multiple messages
+        # this should be extremely helpful with users on bad connections
+        cp = list(headers)
+
+        total_avail = len(cp)
+        total_sent = 0
+
+        max_size = 1000
+        last_rev = cp[-1]["_rev"]
+
+        while cp:
+            to_send, cp = cp[:max_size], cp[max_size:]
+            total_sent += len(to_send)
+
+            self.send(
+                json.dumps(
+                    {
+                        "event": "update_headers",
+                        "rev": [to_send[0]["_rev"], to_send[-1]["_rev"]],
+                        "sync_to_rev": last_rev,
+                        "headers": to_send,
+                        "total_sent": total_sent,
+                        "total_avail": total_avail,
+                    }
+                ),
+                False,
+            )
+
+    def sendSynced(self):
+        # nothing matched the filter, the client still has to know
+        # it is synchronized (and up to which rev)
+        last_rev = self.db.index.last_rev()
+        self.send(
+            json.dumps(
+                {
+                    "event": "update_headers",
+                    "rev": [last_rev, last_rev],
+                    "sync_to_rev": last_rev,
+                    "headers": [],
+                    "total_sent": 0,
+                    "total_avail": 0,
+                }
+            ),
+            False,
+        )
+
+    def sendHeaderChunks(self, chunks):
+        # same messages as sendHeaders(), but the headers are already encoded
+        # the layout must match json.dumps() output in sendHeaders()
+        if not chunks:
+            return
+
+        total_avail = sum(map(lambda x: x[2], chunks))
+        total_sent = 0
+        last_rev = chunks[-1][1]
+
+        for first_rev, chunk_last_rev, count, headers_json in chunks:
+            total_sent += count
+
+            self.send(
+                '{"event": "update_headers", "rev": [%s, %s], "sync_to_rev": %s, '
+                '"headers": %s, "total_sent": %d, "total_avail": %d}'
+                % (
+                    json.dumps(first_rev),
+                    json.dumps(chunk_last_rev),
+                    json.dumps(last_rev),
+                    headers_json,
+                    total_sent,
+                    total_avail,
+                ),
+                False,
+            )
+
+    def updateHeaders(self, headers):
+        # this cannot throw
+        # or it will kill the input server
+
+        try:
+            if self.filter is not None:
+                headers = [h for h in headers if self.filter.match(h)]
+                if not headers:
+                    return
+
+            if self.state == self.STATE_INSYNC:
+                self.backlog.append(headers)
+            elif self.state == self.STATE_LISTEN:
+                self.sendHeaders(headers)
+            else:
+                pass
+        except:
+            log.warning("WebSocket error.", exc_info=True)
+
+    @staticmethod
+    def proxy_mode(input_messages: list, peer_address: str) -> list:
+        # emulate a websocket
+        # create it, parse messages and capture everything we send to it
+        # we don't need to suppress self.db.add_listener as it has no effect
+        # there should be no IO inside here
+
+        # both input and output messages are strings (not json objects)
+        output_messages = []
+
+        class Proxy(SyncSocket):
+            def __init__(self, peer_address):
+                self._peer_address = peer_address
+
+            def send(self, msg, binary=False):
+                if binary and isinstance(msg, str):
+                    msg = msg.encode("utf-8")
+                elif not binary and isinstance(msg, bytes):
+                    msg = msg.decode("utf-8")
+                output_messages.append(msg)
+
+            @property
+            def peer_address(self):
+                return self._peer_address
+
+        c = Proxy(peer_address)
+        c.opened()
+        for msg in input_messages:
+            log.info("Proxy mode insert msg: %s", msg)
+            c.received_message(ProxyMessage(msg))
+        c.closed(code=1006, reason="Proxy mode end.", output_log=False)
+
+        return output_messages
+
+
+class ProxyMessage(object):
+    def __init__(self, str):
+        self.data = str
+
+
+class ProxySession(SyncSocket):
+    """
+    A server side "websocket" for a /sync_proxy client.
+
+    Unlike proxy_mode() it stays subscribed between the polls and
+    keeps the outgoing messages (header deltas) until the client
+    picks them up, so a poll doesn't replay the headers from known_rev.
+    """
+
+    # a client this much behind (messages pushed since its last poll)
+    # has to resync from a new session, the replies to its own requests
+    # (ie. a full sync of a large database) don't count, they are
+    # picked up by the same poll
+    MAX_PENDING = 1000
+
+    def __init__(self, id, peer_address):
+        self.id = id
+        self._peer_address = peer_address
+
+        self.pending = []
+        self.pushed = 0
+        self.replying = False
+        self.event = gevent.event.Event()
+        self.last_seen = time.time()
+        self.expired = False
+
+        self.opened()
+
+    @property
+    def peer_address(self):
+        return self._peer_address
+
+    def send(self, msg, binary=False):
+        if isinstance(msg, bytes):
+            msg = msg.decode("utf-8")
+
+        self.pending.append(msg)
+        self.event.set()
+
+        if self.replying:
+            return
+
+        self.pushed += 1
+        if self.pushed > self.MAX_PENDING:
+            log.warning("Proxy session %s has too many pending messages.", self.id)
+            self.expire()
+
+    def expire(self):
+        if self.expired:
+            return
+
+        self.expired = True
+        self.pending = []
+        self.event.set()
+        self.closed(code=1006, reason="Proxy session expired.", output_log=False)
+
+    def poll(self, messages, wait=0):
+        """Handles the messages and returns the pending output."""
+        self.last_seen = time.time()
+
+        self.replying = True
+        try:
+            for msg in messages:
+                self.received_message(ProxyMessage(msg))
+        finally:
+            self.replying = False
+
+        if not self.pending and wait > 0:
+            self.event.clear()
+            self.event.wait(timeout=wait)
+
+        output, self.pending = self.pending, []
+        self.pushed = 0
+        self.last_seen = time.time()
+        return output
+
+
+class ProxySessions(object):
+    """The /sync_proxy sessions, idle ones are expired after timeout seconds."""
+
+    def __init__(self, timeout=120, max_sessions=512, max_wait=30):
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self.max_wait = max_wait
+
+        self.sessions = {}
+        self.stats = {
+            "created": 0,
+            "expired": 0,
+            "polls": 0,
+        }
+
+    def get(self, id, peer_address):
+        """Returns (session, created), unknown ids get a new session."""
+        session = self.sessions.get(id, None)
+        if session is not None and not session.expired:
+            return session, False
+
+        if len(self.sessions) >= self.max_sessions:
+            self.expire_idle(force=True)
+
+        session = ProxySession(uuid.uuid4().hex, peer_address)
+        self.sessions[session.id] = session
+        self.stats["created"] += 1
+
+        log.info("Created proxy session %s for %s.", session.id, peer_address)
+        return session, True
+
+    def poll(self, id, messages, peer_address, wait=0):
+        session, created = self.get(id, peer_address)
+        self.stats["polls"] += 1
+
+        wait = max(0, min(float(wait or 0), self.max_wait))
+        return session, created, session.poll(messages, wait=wait)
+
+    def expire_idle(self, force=False):
+        now = time.time()
+        sessions = sorted(self.sessions.values(), key=lambda x: x.last_seen)
+
+        for session in sessions:
+            idle = now - session.last_seen > self.timeout
+            if force and not idle:
+                # make space for a single new session
+                idle, force = True, False
+
+            if idle or session.expired:
+                del self.sessions[session.id]
+                session.expire()
+                self.stats["expired"] += 1
+
+    def run_greenlet(self):
+        while True:
+            gevent.sleep(self.timeout / 4.0)
+
+            try:
+                self.expire_idle()
+            except:
+                log.warning("Failed to expire proxy sessions.", exc_info=True)
+
+
+class HttpClient(object):
+    """
+    Keep-alive HTTP connections (a requests.Session) for the calls
+    to the other nodes. We don't monkey patch, so the blocking calls
+    run in a threadpool of their own, at most `concurrency` at a time.
+    """
+
+    # not forwarded by the proxies (rfc2616 section 13.5.1)
+    HOP_BY_HOP = set(
+        [
+            "connection",
+            "keep-alive",
+            "proxy-authenticate",
+            "proxy-authorization",
+            "te",
+            "trailers",
+            "transfer-encoding",
+            "upgrade",
+            "host",
+            "content-length",
+        ]
+    )
+
+    def __init__(self, concurrency=16, pool_maxsize=4, timeout=5):
+        import requests.adapters
+        import gevent.lock
+
+        self.timeout = timeout
+        self.session = requests.Session()
+
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=64, pool_maxsize=pool_maxsize
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.semaphore = gevent.lock.BoundedSemaphore(concurrency)
+        self.threadpool = gevent.threadpool.ThreadPool(concurrency)
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "max_in_flight": 0,
+        }
+        self.in_flight = 0
+
+    @classmethod
+    def forward_headers(cls, headers):
+        return dict(
+            (k, v) for k, v in headers.items() if k.lower() not in cls.HOP_BY_HOP
+        )
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+
+        with self.semaphore:
+            self.in_flight += 1
+            self.stats["requests"] += 1
+            self.stats["max_in_flight"] = max(
+                self.stats["max_in_flight"], self.in_flight
+            )
+
+            try:
+                ok, r = self.threadpool.apply(self.call, (method, url), kwargs)
+            finally:
+                self.in_flight -= 1
+
+            if not ok:
+                self.stats["errors"] += 1
+                raise r
+
+            return r
+
+    def call(self, method, url, **kwargs):
+        # runs in the threadpool, which would print the exceptions
+        try:
+            return True, self.session.request(method, url, **kwargs)
+        except Exception as e:
+            return False, e
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def map(self, calls):
+        """
+        Runs the (method, url, kwargs) calls in parallel, returns
+        a list of (True, response) or (False, exception) in the same order.
+        """
+
+        def call(method, url, kwargs):
+            try:
+                return True, self.request(method, url, **kwargs)
+            except Exception as e:
+                return False, e
+
+        greenlets = [gevent.spawn(call, *c) for c in calls]
+        gevent.joinall(greenlets)
+        return [g.value for g in greenlets]
+
+
+class QueryCache(object):
+    """
+    Results of the expensive control room queries (/cr/exe),
+    keyed by (what, args...) and kept for a per-query TTL.
+
+    Concurrent identical queries share a single computation,
+    the failed ones are not cached.
+    """
+
+    def __init__(self, ttls, max_entries=256):
+        self.ttls = ttls
+        self.max_entries = max_entries
+
+        self.entries = {}  # key -> (timestamp, AsyncResult)
+        self.stats = {}
+
+    def count(self, what, name):
+        stats = self.stats.get(what, None)
+        if stats is None:
+            stats = {"hits": 0, "misses": 0, "waits": 0, "invalidations": 0}
+            self.stats[what] = stats
+
+        stats[name] += 1
+
+    def get(self, key, fn, *args):
+        what = key[0]
+
+        cached = self.entries.get(key, None)
+        if cached is not None:
+            ts, ar = cached
+            if not ar.ready():
+                self.count(what, "waits")
+                return ar.get()
+
+            if time.time() - ts < self.ttls.get(what, 0):
+                self.count(what, "hits")
+                return ar.get()
+
+        self.count(what, "misses")
+
+        ar = gevent.event.AsyncResult()
+        self.entries[key] = (None, ar)
+        try:
+            value = fn(*args)
+        except Exception as e:
+            if self.entries.get(key, (None, None))[1] is ar:
+                del self.entries[key]
+
+            ar.set_exception(e)
+            raise
+
+        ar.set(value)
+        if self.entries.get(key, (None, None))[1] is ar:
+            self.entries[key] = (time.time(), ar)
+
+        if len(self.entries) > self.max_entries:
+            self.purge()
+
+        return value
+
+    def invalidate(self, what, *args):
+        """Drops the cached results of what, only those starting with args if given."""
+        for key in list(self.entries.keys()):
+            if key[0] == what and key[1 : len(args) + 1] == args:
+                del self.entries[key]
+                self.count(what, "invalidations")
+
+    def purge(self):
+        now = time.time()
+        for key, (ts, ar) in list(self.entries.items()):
+            if ts is not None and now - ts >= self.ttls.get(key[0], 0):
+                del self.entries[key]
+
+
+class LogFile(object):
+    """
+    Random access to a (plain or gzip-ed) log file, for the log viewer.
+
+    Gzip streams can't seek, so the file is decompressed once and a copy
+    of the decompressor is kept every CHECKPOINT bytes of input (or
+    CHECKPOINT_OUTPUT bytes of output, the logs compress very well),
+    together with the decompressed offset and the line count at that point.
+    Reads start at the nearest checkpoint, ie. the tail of a large log
+    costs one segment. The index is extended when the file grows
+    (the logs are written while the job runs).
+
+    Plain files get the same index (without decompressors), but only
+    for the line ranges - tails and byte ranges just seek.
+    """
+
+    CHECKPOINT = 1024 * 1024
+    CHECKPOINT_OUTPUT = 8 * 1024 * 1024
+    BLOCK = 256 * 1024
+
+    def __init__(self, fn, gzip=False):
+        self.fn = fn
+        self.gzip = gzip
+        self.lock = threading.Lock()
+        self.reset(None)
+
+    def reset(self, st):
+        self.st = st
+        self.eof = False
+        self.unused_data = 0
+        # (compressed offset, offset, lines before, decompressor)
+        self.checkpoints = [(0, 0, 0, self.decompressor())]
+
+    def decompressor(self):
+        if not self.gzip:
+            return None
+
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, d, data):
+        if d is None:
+            return data
+
+        if d.eof:
+            return b""
+
+        return d.decompress(data)
+
+    def update(self, f):
+        """Extends the index up to the current end of the file."""
+        st = os.fstat(f.fileno())
+        if (
+            self.st is None
+            or st.st_ino != self.st.st_ino
+            or st.st_size < self.checkpoints[-1][0]
+        ):
+            self.reset(st)
+
+        self.st = st
+        if self.eof or st.st_size == self.checkpoints[-1][0]:
+            return
+
+        def is_short(a, b):
+            return (
+                b[0] - a[0] < self.CHECKPOINT and b[1] - a[1] < self.CHECKPOINT_OUTPUT
+            )
+
+        # the last checkpoint is often a short one (the previous end of file)
+        if len(self.checkpoints) > 1:
+            if is_short(self.checkpoints[-2], self.checkpoints[-1]):
+                self.checkpoints.pop()
+
+        c_off, u_off, lines, d = self.checkpoints[-1]
+        d = d.copy() if d is not None else None
+        f.seek(c_off)
+
+        while True:
+            data = f.read(self.BLOCK)
+            if not data:
+                break
+
+            out = self.decompress(d, data)
+            c_off += len(data)
+            u_off += len(out)
+            lines += out.count(b"\n")
+
+            eof = d is not None and d.eof
+            if eof:
+                self.eof = True
+                self.unused_data = len(d.unused_data) + st.st_size - c_off
+
+            checkpoint = (c_off, u_off, lines, d)
+            if eof or not is_short(self.checkpoints[-1], checkpoint):
+                self.checkpoints.append(checkpoint)
+                d = d.copy() if d is not None else None
+
+            if eof:
+                break
+
+        # the end of file is always a checkpoint
+        if self.checkpoints[-1][0] != c_off:
+            self.checkpoints.append((c_off, u_off, lines, d))
+
+    def size(self):
+        return self.checkpoints[-1][1]
+
+    def lines(self):
+        return self.checkpoints[-1][2]
+
+    def read_segment(self, f, i):
+        """Decompressed data between the checkpoints i and i + 1."""
+        c_off, u_off, lines, d = self.checkpoints[i]
+        c_end = self.checkpoints[i + 1][0]
+
+        f.seek(c_off)
+        data = f.read(c_end - c_off)
+        return self.decompress(d.copy() if d is not None else None, data)
+
+    def forward(self, f, offset):
+        """Yields the (decompressed) data starting at offset."""
+        if not self.gzip:
+            f.seek(offset)
+            while True:
+                data = f.read(self.BLOCK)
+                if not data:
+                    return
+                yield data
+
+        i = bisect.bisect_right([cp[1] for cp in self.checkpoints], offset) - 1
+        i = max(0, min(i, len(self.checkpoints) - 2))
+        skip = offset - self.checkpoints[i][1]
+
+        for i in range(i, len(self.checkpoints) - 1):
+            data = self.read_segment(f, i)
+            if skip:
+                data, skip = data[skip:], max(0, skip - len(data))
+            if data:
+                yield data
+
+    def backward(self, f):
+        """Yields the (decompressed) data from the end, one segment at a time."""
+        if not self.gzip:
+            end = self.st.st_size
+            while end > 0:
+                start = max(0, end - self.BLOCK)
+                f.seek(start)
+                yield f.read(end - start)
+                end = start
+
+            return
+
+        for i in range(len(self.checkpoints) - 2, -1, -1):
+            yield self.read_segment(f, i)
+
+    def forward_from_line(self, f, line):
+        """Yields the data starting at the line (0-based)."""
+        i = bisect.bisect_right([cp[2] for cp in self.checkpoints], line) - 1
+        i = max(0, min(i, len(self.checkpoints) - 2))
+        skip = line - self.checkpoints[i][2]
+
+        for data in self.forward(f, self.checkpoints[i][1]):
+            pos = 0
+            while skip and pos >= 0:
+                pos = data.find(b"\n", pos)
+                if pos >= 0:
+                    pos += 1
+                    skip -= 1
+
+            if not skip and 0 <= pos < len(data):
+                yield data[pos:]
+
+
+def split_lines(chunks):
+    """Joins the chunks and yields the lines (without the newlines)."""
+    carry = b""
+    for data in chunks:
+        parts = (carry + data).split(b"\n")
+        carry = parts.pop()
+        yield from parts
+
+    if carry:
+        yield carry
+
+
+def split_lines_reversed(chunks):
+    """Same as split_lines(), for chunks read backward, yields the last line first."""
+    carry = None
+    for data in chunks:
+        parts = (data + carry if carry is not None else data).split(b"\n")
+        if carry is None and parts[-1] == b"":
+            # the newline at the end of file
+            parts.pop()
+
+        carry = parts[0]
+        yield from reversed(parts[1:])
+
+    if carry:
+        yield carry
+
+
+class LogView(object):
+    """
+    The part of a log to show, from the request arguments:
+      tail=N                 the last N lines,
+      lines=A:B              the lines from A (0-based) to B (exclusive),
+      offset=N&length=M      a byte range (of the decompressed log),
+      grep=TEXT              only the lines containing TEXT (before tail/lines).
+    Without arguments it's the whole log.
+    """
+
+    MAX_LINES = 100000
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self, tail=None, lines=None, offset=None, length=None, grep=None):
+        self.tail = tail
+        self.lines = lines
+        self.offset = offset
+        self.length = length
+        self.grep = grep
+
+    @classmethod
+    def from_query(cls, query):
+        """Raises ValueError for invalid or conflicting arguments."""
+
+        def number(key):
+            v = query.get(key, None)
+            if v is None or v == "":
+                return None
+
+            v = int(v)
+            if v < 0:
+                raise ValueError("%s must not be negative" % key)
+            return v
+
+        view = cls(tail=number("tail"), offset=number("offset"))
+        view.length = number("length")
+        view.grep = query.get("grep", None) or None
+
+        lines = query.get("lines", None)
+        if lines:
+            a, sep, b = lines.partition(":")
+            if not sep:
+                raise ValueError("lines must be A:B")
+
+            a = int(a) if a else 0
+            b = int(b) if b else None
+            if a < 0 or (b is not None and b < a):
+                raise ValueError("invalid line range: %s" % lines)
+
+            view.lines = (a, b)
+
+        modes = [view.tail is not None, view.lines is not None]
+        modes.append(view.offset is not None or view.length is not None)
+        if sum(modes) > 1:
+            raise ValueError("tail, lines and offset/length are exclusive")
+
+        if view.tail is not None and view.tail > cls.MAX_LINES:
+            raise ValueError("tail is limited to %d lines" % cls.MAX_LINES)
+
+        if view.lines is not None:
+            a, b = view.lines
+            if b is None or b - a > cls.MAX_LINES:
+                view.lines = (a, a + cls.MAX_LINES)
+
+        if view.offset is not None or view.length is not None:
+            view.offset = view.offset or 0
+            if view.length is None or view.length > cls.MAX_LENGTH:
+                view.length = cls.MAX_LENGTH
+
+        return view
+
+    def is_full(self):
+        return (
+            self.tail is None
+            and self.lines is None
+            and self.offset is None
+            and self.grep is None
+        )
+
+    def match(self, lines):
+        if self.grep is None:
+            return lines
+
+        pattern = self.grep.encode("utf-8")
+        return (line for line in lines if pattern in line)
 
-                # not that we ever overflow it ...
-                rev = (rev + 1) & ((2**63) - 1)
+    def read(self, logfile):
+        """The selected part of the LogFile (bytes), blocking."""
+        with logfile.lock, open(logfile.fn, "rb") as f:
+            if logfile.gzip or self.lines is not None:
+                logfile.update(f)
+            else:
+                logfile.st = os.fstat(f.fileno())
+
+            if self.tail is not None:
+                selected = []
+                if self.tail:
+                    lines = split_lines_reversed(logfile.backward(f))
+                    selected = list(itertools.islice(self.match(lines), self.tail))
+                    selected.reverse()
+
+            elif self.lines is not None:
+                a, b = self.lines
+                if self.grep is None:
+                    lines = split_lines(logfile.forward_from_line(f, a))
+                    selected = list(itertools.islice(lines, b - a))
+                else:
+                    lines = self.match(split_lines(logfile.forward(f, 0)))
+                    selected = list(itertools.islice(lines, a, b))
 
-                # create the header and update the body
-                header = self.make_header(doc, rev=rev, write_back=True)
-                body = zlib.compress(json.dumps(doc).encode("utf-8"))
+            else:
+                chunks, left = [], self.length
+                if self.length is None:
+                    left = LogView.MAX_LENGTH
+
+                for data in logfile.forward(f, self.offset or 0):
+                    chunks.append(data[:left])
+                    left -= len(chunks[-1])
+                    if left <= 0:
+                        break
 
-                db.execute(
-                    "INSERT OR REPLACE INTO Headers (id, rev, timestamp, type, hostname, tag, run) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (
-                        header.get("_id"),
-                        header.get("_rev"),
-                        header.get("timestamp"),
-                        header.get("type"),
-                        header.get("hostname"),
-                        header.get("tag"),
-                        header.get("run"),
-                    ),
-                )
+                if self.grep is None:
+                    return b"".join(chunks)
 
-                db.execute(
-                    "INSERT OR REPLACE INTO Documents (id, rev, body) VALUES (?, ?, ?)",
-                    (
-                        header.get("_id"),
-                        header.get("_rev"),
-                        sqlite3.Binary(body),
-                    ),
-                )
+                selected = list(self.match(split_lines(chunks)))
 
-                headers.append(header)
+        if not selected:
+            return b""
 
-        self.update_headers(headers)
+        return b"\n".join(selected) + b"\n"
 
-    def add_listener(self, listener):
-        self.listeners.append(listener)
+    def shell_command(self, path):
+        """The same selection as a shell command, for the logs on the other hosts."""
+        cat = "zcat" if path.endswith(".gz") else "cat"
+        path = shlex.quote(path)
+        grep = ""
+        if self.grep is not None:
+            grep = "grep -F -e %s" % shlex.quote(self.grep)
 
-    def remove_listener(self, listener):
-        self.listeners.remove(listener)
+        if self.tail is not None:
+            if grep:
+                return "%s %s | tail -n %d" % (grep, path, self.tail)
+            return "tail -n %d %s" % (self.tail, path)
 
-    def update_headers(self, headers):
-        # it is possible that listeners list will change
-        # in a different greenlet (ie, exit or something)
+        if self.lines is not None:
+            a, b = self.lines
+            select = "tail -n +%d | head -n %d" % (a + 1, b - a)
+            if grep:
+                return "%s %s | %s" % (grep, path, select)
+            return "%s %s | %s" % (cat, path, select)
 
-        # we don't care, since client should handle
-        # the websocket errors.
-        if len(headers) == 0:
-            return
+        if self.offset is not None:
+            select = "tail -c +%d | head -c %d" % (self.offset + 1, self.length)
+            cmd = "%s %s | %s" % (cat, path, select)
+            if grep:
+                return "%s | %s" % (cmd, grep)
+            return cmd
 
-        copy = list(self.listeners)
-        for client in copy:
-            client.updateHeaders(headers)
+        if grep:
+            return "%s %s" % (grep, path)
 
+        return "%s %s" % (cat, path)
 
-class SyncSocket(WebSocket):
-    STATE_NONE = 1
-    STATE_INSYNC = 2
-    STATE_LISTEN = 3
-    STATE_CLOSED = -1
 
-    def opened(self):
-        self.backlog = []
-        self.state = self.STATE_NONE
-        self.close_reason = None
+class LogFiles(object):
+    """The LogFile (and their indexes) of the recently viewed logs."""
 
-        self.db.add_listener(self)
+    def __init__(self, max_files=16):
+        self.max_files = max_files
+        self.files = collections.OrderedDict()
 
-        log.info("WebSocket connected: %s", self.peer_address)
+    def get(self, fn, gzip=False):
+        key = (fn, gzip)
+        logfile = self.files.pop(key, None)
+        if logfile is None:
+            logfile = LogFile(fn, gzip=gzip)
 
-    def closed(self, code, reason=None, output_log=True):
-        self.db.remove_listener(self)
+        self.files[key] = logfile
+        while len(self.files) > self.max_files:
+            self.files.popitem(last=False)
 
-        if output_log:
-            log.info(
-                "WebSocket disconnected: %s code=%s reason=%s",
-                self.peer_address,
-                code,
-                reason,
-            )
+        return logfile
 
-    def received_message(self, msg):
-        # print "recv:", self, msg, type(msg)
-        # sys.stdout.flush()
 
-        jsn = json.loads(msg.data)
-        if jsn["event"] == "sync_request":
-            known_rev = jsn.get("known_rev", None)
-            self.state = self.STATE_INSYNC
+class StaticFiles(object):
+    """
+    Serves web.static with validators and cache headers.
 
-            log.info(
-                "WebSocket client (%s) requested sync from rev %s",
-                self.peer_address,
-                known_rev,
-            )
+    The precompressed .gz variants (utils/compress_static.py) are sent
+    to the clients accepting gzip, the ETags are derived from the stat
+    of the served file, and the small files are kept in memory (LRU,
+    revalidated with a stat on every request).
+    """
 
-            # if know_rev is not zero, we have to send at least a single header
-            # to let the web interface to know it is synchronized
-            if known_rev is not None:
-                known_rev = int(known_rev) - 1
+    # vendored libraries only change with a release
+    EXTERNAL_MAX_AGE = 7 * 24 * 3600
+    # ... or never, if the version is in the name (or in the query string)
+    VERSIONED_RE = re.compile(r"-\d+(\.\d+)+[.-]")
 
-            # send the current state
-            # if any changes happen during this time
-            # they go into backlog
-            self.backlog.insert(0, self.db.get_headers(from_rev=known_rev))
-            while len(self.backlog):
-                h = self.backlog.pop(0)
-                self.sendHeaders(h)
+    def __init__(self, root, max_file_size=256 * 1024, max_bytes=16 * 1024 * 1024):
+        self.root = os.path.abspath(root) + os.sep
+        self.max_file_size = max_file_size
+        self.max_bytes = max_bytes
 
-            self.state = self.STATE_LISTEN
+        self.cache = collections.OrderedDict()  # fn -> (stamp, body)
+        self.cached_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0, "gzip": 0}
 
-        if jsn["event"] == "request_documents":
-            ids = set(jsn["ids"])
+    def cache_control(self, filepath, versioned=False):
+        if filepath.startswith("external/"):
+            if versioned or self.VERSIONED_RE.search(os.path.basename(filepath)):
+                return "public, max-age=31536000, immutable"
 
-            with self.db.conn as db:
-                c = db.cursor()
+            return "public, max-age=%d" % self.EXTERNAL_MAX_AGE
 
-                IN = "(" + ",".join("?" * len(ids)) + ")"
-                c.execute("SELECT * FROM Documents WHERE id IN " + IN, list(ids))
+        # our own code has to be revalidated (ETag), it changes with deployments
+        return "no-cache"
 
-                docs = list(self.db.prepare_docs(c))
-                c.close()
+    def read(self, fn, st):
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = self.cache.get(fn, None)
+        if cached is not None and cached[0] == stamp:
+            self.cache.move_to_end(fn)
+            self.stats["hits"] += 1
+            return cached[1]
 
-            jsn = json.dumps(
-                {
-                    "event": "update_documents",
-                    "documents": docs,
-                }
-            ).encode("utf8")
+        self.stats["misses"] += 1
+        if st.st_size > self.max_file_size:
+            return open(fn, "rb")
+
+        with open(fn, "rb") as f:
+            body = f.read()
+
+        if cached is not None:
+            self.cached_bytes -= len(cached[1])
 
-            log.info(
-                "WebSocket client (%s) requested %d documents (%d bytes)",
-                self.peer_address,
-                len(ids),
-                len(jsn),
-            )
-            self.send(jsn, False)
+        self.cache[fn] = (stamp, body)
+        self.cached_bytes += len(body)
+        while self.cached_bytes > self.max_bytes:
+            _, (_, dropped) = self.cache.popitem(last=False)
+            self.cached_bytes -= len(dropped)
 
-    def sendHeaders(self, headers):
-        if not headers:
-            return
+        return body
 
-        # split sending into multiple messages
-        # this should be extremely helpful with users on bad connections
-        cp = list(headers)
+    def serve(self, filepath, request):
+        fn = os.path.abspath(os.path.join(self.root, filepath.strip("/\\")))
+        if not fn.startswith(self.root):
+            return bottle.HTTPError(403, "Access denied.")
 
-        total_avail = len(cp)
-        total_sent = 0
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return bottle.HTTPError(404, "File does not exist.")
 
-        max_size = 1000
-        last_rev = cp[-1]["_rev"]
+        if not stat.S_ISREG(st.st_mode):
+            return bottle.HTTPError(404, "File does not exist.")
 
-        while cp:
-            to_send, cp = cp[:max_size], cp[max_size:]
-            total_sent += len(to_send)
+        headers = {"Vary": "Accept-Encoding"}
+        mimetype, encoding = mimetypes.guess_type(fn)
+        mimetype = mimetype or "application/octet-stream"
+        if mimetype.startswith("text/") or mimetype == "application/javascript":
+            mimetype += "; charset=UTF-8"
+        headers["Content-Type"] = mimetype
 
-            self.send(
-                json.dumps(
-                    {
-                        "event": "update_headers",
-                        "rev": [to_send[0]["_rev"], to_send[-1]["_rev"]],
-                        "sync_to_rev": last_rev,
-                        "headers": to_send,
-                        "total_sent": total_sent,
-                        "total_avail": total_avail,
-                    }
-                ),
-                False,
-            )
+        versioned = "v" in request.query
+        headers["Cache-Control"] = self.cache_control(filepath, versioned)
 
-    def updateHeaders(self, headers):
-        # this cannot throw
-        # or it will kill the input server
+        # .gz is used only if it's up to date
+        if "gzip" in request.get_header("Accept-Encoding", ""):
+            try:
+                gz_st = os.stat(fn + ".gz")
+                if gz_st.st_mtime_ns >= st.st_mtime_ns:
+                    fn, st = fn + ".gz", gz_st
+                    headers["Content-Encoding"] = "gzip"
+                    self.stats["gzip"] += 1
+            except OSError:
+                pass
 
+        etag = '"%x-%x%s"' % (
+            st.st_mtime_ns,
+            st.st_size,
+            "-gz" if "Content-Encoding" in headers else "",
+        )
+        headers["ETag"] = etag
+        headers["Last-Modified"] = email.utils.formatdate(st.st_mtime, usegmt=True)
+
+        inm = request.get_header("If-None-Match", None)
+        ims = request.get_header("If-Modified-Since", None)
+        if inm is not None:
+            not_modified = etag in [t.strip() for t in inm.split(",")] or inm == "*"
+        elif ims is not None:
+            ims = bottle.parse_date(ims.split(";")[0].strip())
+            not_modified = ims is not None and ims >= int(st.st_mtime)
+        else:
+            not_modified = False
+
+        if not_modified:
+            self.stats["not_modified"] += 1
+            return bottle.HTTPResponse(status=304, **headers)
+
+        headers["Content-Length"] = str(st.st_size)
+        body = b"" if request.method == "HEAD" else self.read(fn, st)
+        return bottle.HTTPResponse(body, **headers)
+
+
+class ReportServer(object):
+    """
+    The direct report submission socket (see fff_filemonitor.ReportClient),
+    each line is a document and is answered after the commit:
+    "ok" or "error <reason>".
+
+    The reports of all the connections are queued and everything queued
+    at the time is committed together (see run()), without the WAL mode
+    every commit (and its fsync) would stall the event loop.
+    """
+
+    def __init__(self, db, key=None, max_batch=256):
+        self.db = db
+        self.key = key or fff_dqmtools.get_lock_key(fff_filemonitor.REPORT_SOCKET)
+        self.max_batch = max_batch
+        self.queue = gevent.queue.Queue()
+        self.server = None
+        self.greenlet = None
+        self.stats = {"connections": 0, "documents": 0, "errors": 0, "commits": 0}
+
+    def start(self):
+        import gevent.server
+        import gevent.socket
+
+        listener = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind("\0" + self.key)
+        listener.listen(64)
+
+        self.greenlet = gevent.spawn(self.run)
+        self.server = gevent.server.StreamServer(listener, self.handle)
+        self.server.start()
+
+    def submit(self, line):
+        result = gevent.event.AsyncResult()
+        self.queue.put((line, result))
+        return result.get()
+
+    def upload(self, lines):
+        # returns the error (or None) of every line
         try:
-            if self.state == self.STATE_INSYNC:
-                self.backlog.append(headers)
-            elif self.state == self.STATE_LISTEN:
-                self.sendHeaders(headers)
-            else:
-                pass
-        except:
-            log.warning("WebSocket error.", exc_info=True)
+            self.db.direct_transactional_upload(lines)
+            self.stats["commits"] += 1
+            return [None] * len(lines)
+        except Exception as e:
+            if len(lines) == 1:
+                return [e]
+
+        # retry everything separately, so only the faulty ones fail
+        return [self.upload([line])[0] for line in lines]
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            errors = self.upload([line for line, result in batch])
+            for (line, result), e in zip(batch, errors):
+                if e is None:
+                    result.set(True)
+                else:
+                    result.set_exception(e)
 
-    @staticmethod
-    def proxy_mode(input_messages: list, peer_address: str) -> list:
-        # emulate a websocket
-        # create it, parse messages and capture everything we send to it
-        # we don't need to suppress self.db.add_listener as it has no effect
-        # there should be no IO inside here
+    def handle(self, sock, address):
+        self.stats["connections"] += 1
 
-        # both input and output messages are strings (not json objects)
-        output_messages = []
+        reader = sock.makefile("rb")
+        try:
+            for line in reader:
+                if not line.strip():
+                    continue
 
-        class Proxy(SyncSocket):
-            def __init__(self, peer_address):
-                self._peer_address = peer_address
+                try:
+                    self.submit(line.rstrip(b"\n"))
+                    self.stats["documents"] += 1
+                    answer = b"ok\n"
+                except Exception as e:
+                    log.warning("Report rejected: %r", e)
+                    self.stats["errors"] += 1
+                    answer = ("error %r\n" % e).encode("utf-8")
+
+                sock.sendall(answer)
+        except OSError:
+            pass
+        finally:
+            reader.close()
+            sock.close()
 
-            def send(self, msg, binary=False):
-                if binary and isinstance(msg, str):
-                    msg = msg.encode("utf-8")
-                elif not binary and isinstance(msg, bytes):
-                    msg = msg.decode("utf-8")
-                output_messages.append(msg)
 
-            @property
-            def peer_address(self):
-                return self._peer_address
+_blocking_pool = None
 
-        class ProxyMessage(object):
-            def __init__(self, str):
-                self.data = str
 
-        c = Proxy(peer_address)
-        c.opened()
-        for msg in input_messages:
-            log.info("Proxy mode insert msg: %s", msg)
-            c.received_message(ProxyMessage(msg))
-        c.closed(code=1006, reason="Proxy mode end.", output_log=False)
+def run_blocking(fn, *args):
+    # we don't monkey patch, so subprocesses, ssh and friends
+    # would stop the event loop (ie. all the websockets)
+    # the pool is separate from the database and http ones, so slow ssh
+    # calls can't starve them (created here, after the fork)
+    global _blocking_pool
+    if _blocking_pool is None:
+        _blocking_pool = gevent.threadpool.ThreadPool(8)
 
-        return output_messages
+    return _blocking_pool.apply(fn, args)
 
 
 class WebServer(bottle.Bottle):
-    def __init__(self, db=None, opts={}):
+    def __init__(self, db=None, opts={}, reports=None):
         bottle.Bottle.__init__(self)
 
         self.db = db
         self.opts = opts
         self.secret = opts["web.secret"]
         self.secret_name = opts["web.secret_name"]
+        self.proxy_sessions = ProxySessions()
+        self.http = HttpClient()
+        self.log_files = LogFiles()
+        self.reports = reports
+        self.static_files = StaticFiles(
+            os.path.join(os.path.dirname(__file__), "../web.static/")
+        )
+
+        self.cluster_probe_timeout = 2
+
+        # the control room panels refresh these constantly
+        self.queries = QueryCache(
+            ttls={
+                "get_cluster_status": 10,
+                "get_dqm_clients": 30,
+                "get_cmssw_info": 60,
+                "get_dqm_machines": 300,
+                "get_hltd_versions": 300,
+                "get_fff_versions": 300,
+            }
+        )
         self.setup_routes()
 
+    def probe_cluster(self, cluster):
+        """Probes /health of every host in the cluster, in parallel."""
+        port = self.opts.get("web.port", 9215)
+        hosts = list(fff_cluster.clusters[cluster])
+
+        result = {}
+        calls = []
+        for host in hosts:
+            if fff_cluster.get_host() == host.split(".")[0]:
+                result[host] = {"up": True, "msg": None}
+                continue
+
+            url = "http://%s:%d/health" % (host, port)
+            calls.append(("GET", url, {"timeout": self.cluster_probe_timeout}))
+
+        probed = [h for h in hosts if h not in result]
+        for host, (ok, r) in zip(probed, self.http.map(calls)):
+            if not ok:
+                log.error(f"Error when probing {host}: {repr(r)}")
+                result[host] = {"up": False, "msg": repr(r)}
+            elif r.status_code != 200:
+                # the service is there, but older (no /health)
+                result[host] = {"up": True, "msg": "HTTP %d" % r.status_code}
+            else:
+                result[host] = {"up": True, "msg": None}
+
+        return result
+
+    def get_cluster_status(self, cluster):
+        # many control room tabs poll this, they share the probes
+        key = ("get_cluster_status", cluster)
+        return self.queries.get(key, self.probe_cluster, cluster)
+
+    def get_cmssw_info(self):
+        answer_1 = fff_cluster.get_cmssw_info(self.opts["cmssw_path_playback"])
+        answer_2 = fff_cluster.get_cmssw_info(self.opts["cmssw_path_production"])
+
+        return (
+            "\n<strong>Playback:</strong>\n"
+            + answer_1
+            + "\n<strong>Production:</strong>\n"
+            + answer_2
+        )
+
     def setup_routes(self):
         app = self
 
-        static_path = os.path.dirname(__file__)
-        static_path = os.path.join(static_path, "../web.static/")
-
         # from wsgiproxy.app import WSGIProxyApp
         # proxy_app = WSGIProxyApp("https://dqmrubu-c2a06-03-01.cms:9215/sync_proxy")
         # root.mount(proxy_app,"/dqm/dqm-square-origin/redirect/dqmrubu-c2a06-03-01.cms:9215/sync")
@@ -429,21 +2789,48 @@ class WebServer(bottle.Bottle):
         def enable_cors(fn):
             from bottle import request, response
 
-            def _enable_cors(*args, **kwargs):
-                # set CORS headers
-                response.headers["Access-Control-Allow-Origin"] = "*"
-                response.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS"
-                response.headers["Access-Control-Allow-Headers"] = (
-                    "Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token"
-                )
-                response.headers["Access-Control-Allow-Credentials"] = "true"
+            cors_headers = {
+                "Access-Control-Allow-Origin": "*",
+                "Access-Control-Allow-Methods": "POST, OPTIONS",
+                "Access-Control-Allow-Headers": "Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token",
+                "Access-Control-Allow-Credentials": "true",
+            }
 
-                if bottle.request.method != "OPTIONS":
+            def _enable_cors(*args, **kwargs):
+                out = None
+                if request.method != "OPTIONS":
                     # actual request; reply with the actual response
-                    return fn(*args, **kwargs)
+                    try:
+                        out = fn(*args, **kwargs)
+                    except bottle.HTTPResponse as e:
+                        e.headers.update(cors_headers)
+                        raise
+
+                # set CORS headers, handlers which can yield (and so lose
+                # the shared bottle.response) return a HTTPResponse instead
+                if isinstance(out, bottle.HTTPResponse):
+                    out.headers.update(cors_headers)
+                else:
+                    response.headers.update(cors_headers)
+
+                return out
 
             return _enable_cors
 
+        def json_response(body, status=200):
+            # bottle's response is shared by the greenlets (we don't monkey patch),
+            # after a yield it might belong to a different request
+            return bottle.HTTPResponse(
+                body, status, headers={"Content-Type": "application/json"}
+            )
+
+        def own_request():
+            # bottle.request is shared by the greenlets as well, and reading
+            # the body can yield: its lazy state (ie. the body read so far)
+            # would end up in the environ of a different request,
+            # so it has to be bound to this request's environ first
+            return bottle.BaseRequest(bottle.request.environ)
+
         def get_cookie(key, raw_cookies):
             """
             Helper method which replaces bottle.request.get_cookie which
@@ -477,13 +2864,14 @@ class WebServer(bottle.Bottle):
             def check_auth_(**kwargs):
                 host = bottle.request.get_header("host")
                 log.info("check_auth(): host=%s", host)
-                log.debug(bottle.request.url)
-                log.debug(str(bottle.request.auth))
-                log.debug(str(bottle.request.remote_route))
-                log.debug(str(bottle.request.remote_addr))
-                log.debug(str(bottle.request.json))
-                log.debug(str(bottle.request.path))
-                log.debug(str(bottle.request.cookies.items()))
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(bottle.request.url)
+                    log.debug(str(bottle.request.auth))
+                    log.debug(str(bottle.request.remote_route))
+                    log.debug(str(bottle.request.remote_addr))
+                    log.debug(str(bottle.request.json))
+                    log.debug(str(bottle.request.path))
+                    log.debug(str(bottle.request.cookies.items()))
 
                 if "cmsweb" in bottle.request.url:
                     secret = get_cookie(
@@ -506,7 +2894,7 @@ class WebServer(bottle.Bottle):
         @app.route("/static/<filepath:path>")
         @check_auth
         def static(filepath):
-            return bottle.static_file(filepath, root=static_path)
+            return self.static_files.serve(filepath, bottle.request)
 
         @app.route("/")
         @check_auth
@@ -519,57 +2907,125 @@ class WebServer(bottle.Bottle):
         @app.get("/info")
         @check_auth
         def info():
-            c = self.db.conn.cursor()
-            c.execute("PRAGMA page_size")
-            ps = c.fetchone()[0]
-            c.execute("PRAGMA page_count")
-            pc = c.fetchone()[0]
-            c.close()
-
-            return {
+            info = {
                 "hostname": fff_cluster.get_host(),
                 "timestamp": time.time(),
                 "cluster": fff_cluster.get_node(),
-                "db_size": ps * pc,
+                "db_size": self.db.get_size(),
+                "db_wal": self.db.wal,
+            }
+
+            if self.db.writer is not None:
+                info["db_writer"] = dict(self.db.writer.stats)
+
+            info["db_uploads"] = dict(self.db.upload_stats)
+            if self.reports is not None:
+                info["direct_reports"] = dict(self.reports.stats)
+
+            info["header_frame_cache"] = dict(self.db.frame_cache.stats)
+            if self.db.retention is not None:
+                info["db_retention"] = dict(self.db.retention.stats)
+
+            info["cr_cache"] = dict(self.queries.stats)
+            info["http_client"] = dict(self.http.stats)
+            info["static_files"] = dict(self.static_files.stats)
+            info["static_files"]["cached_bytes"] = self.static_files.cached_bytes
+            info["proxy_sessions"] = dict(self.proxy_sessions.stats)
+            info["proxy_sessions"]["active"] = len(self.proxy_sessions.sessions)
+            info["db_query_plans"] = self.db.check_query_plans()
+            info["db_zdict"] = {
+                "enabled": self.db.codec.enabled,
+                "versions": dict(self.db.codec.current),
             }
 
+            return info
+
+        @app.get("/health")
+        def health():
+            # cheap enough to be polled by every node, no database access
+            from bottle import response
+
+            response.content_type = "application/json"
+            return json.dumps(
+                {
+                    "hostname": fff_cluster.get_host(),
+                    "timestamp": time.time(),
+                    "pid": os.getpid(),
+                    "last_rev": self.db.index.last_rev(),
+                    "headers": len(self.db.index),
+                }
+            )
+
         @app.post("/_upload/")
         # @check_auth
         def upload():
             if "cmsweb" in bottle.request.url:
                 return
-            from bottle import request
+            request = own_request()
+
+            remote_addr = request.remote_addr
+            ndjson = request.content_type == "application/x-ndjson"
+
+            if ndjson:
+                # streamed by fff_filemonitor (keep-alive, possibly chunked),
+                # wsgi.input is already de-chunked by the server
+                # lines are stored as received, see splice_header()
+                documents = []
+                stream = request.environ["wsgi.input"]
+                for i, line in enumerate(iter(stream.readline, b"")):
+                    line = line.rstrip(b"\r\n")
+                    if not line.strip():
+                        continue
+
+                    try:
+                        doc = json.loads(line)
+                        if not isinstance(doc, dict) or doc.get("_id") is None:
+                            raise ValueError("Not a document with an _id.")
+                    except ValueError as e:
+                        # the sender won't retry a 4xx
+                        raise json_response(
+                            json.dumps({"error": str(e), "line": i}), status=400
+                        )
 
-            j = json.loads(request.body.read())
-            documents = j["docs"]
+                    documents.append((doc, line))
+            else:
+                # documents are stored as received, see splice_header()
+                documents = Database.split_upload(request.body.read())
 
             self.db.direct_transactional_upload(documents)
             log.info(
                 "Accepted %d document(s) from input connection: %s",
                 len(documents),
-                request.remote_addr,
+                remote_addr,
             )
 
-        ### @app.route("/get/<id>", method=['GET', 'POST'])
-        ### def get_id(id):
-        ###     from bottle import request, response
-        ###     # check if id known to us
-        ###     with self.db.conn as db:
-        ###         c = db.cursor()
-        ###         c.execute("SELECT * FROM Documents WHERE id = ?", (id, ))
-        ###         docs = list(self.db.prepare_docs(c, decode=False))
-        ###         c.close()
+            if ndjson:
+                # the acknowledgement, sent after the commit
+                # (bottle.response could belong to another request by now)
+                return json_response(json.dumps({"accepted": len(documents)}))
 
-        ###         if len(docs) == 0:
-        ###             raise bottle.HTTPResponse("Doc id not found.", status=404)
+            return bottle.HTTPResponse()
 
-        ###         response.content_type = 'application/json'
-        ###         if 'deflate' in request.headers.get('Accept-Encoding', []):
-        ###             response.add_header("Content-Encoding", "deflate")
+        @app.route("/get/<id>", method=["GET", "POST"])
+        @check_auth
+        def get_id(id):
+            # the read can yield (read pool), so the request is read first
+            # and the headers are sent with a HTTPResponse (see json_response)
+            deflate = "deflate" in bottle.request.headers.get("Accept-Encoding", "")
+
+            # the stored (zlib) bytes are served as they are
+            doc = self.db.get_stored_document(id)
+            if doc is None:
+                raise bottle.HTTPResponse("Doc id not found.", status=404)
+
+            body, compressed = doc
+            headers = {"Content-Type": "application/json"}
+            if compressed and deflate:
+                headers["Content-Encoding"] = "deflate"
+            elif compressed:
+                body = zlib.decompress(body)
 
-        ###             return docs[0]
-        ###         else:
-        ###             return zlib.decompress(docs[0])
+            return bottle.HTTPResponse(body, headers=headers)
 
         ### @app.get("/headers/cached/")
         ### def headers():
@@ -595,10 +3051,7 @@ class WebServer(bottle.Bottle):
             data = json.loads(request.body.read())
 
             # check if id known to us
-            c = self.db.conn.cursor()
-            c.execute("SELECT body FROM Documents WHERE id = ?", (id,))
-            doc = list(self.db.prepare_docs(c))
-            c.close()
+            doc = self.db.get_documents([id])
 
             if not doc:
                 raise bottle.HTTPResponse("Process not found.", status=404)
@@ -633,12 +3086,7 @@ class WebServer(bottle.Bottle):
             data = json.loads(request.body.read())
             ids = data["ids"]
 
-            with self.db.conn as db:
-                for id in ids:
-                    db.execute("DELETE FROM Headers WHERE id= ?", (id,))
-                    db.execute("DELETE FROM Documents WHERE id= ?", (id,))
-
-            self.db.get_headers(reload=True)
+            self.db.drop_ids(ids)
             return "Deleted %s rows!" % len(ids)
 
         def verify_logfile(fn):
@@ -692,15 +3140,33 @@ class WebServer(bottle.Bottle):
         @app.route("/utils/show_log/<id>", method=["GET", "POST"])
         @check_auth
         def show_log(id):
-            from bottle import response
+            # bottle.request and bottle.response are shared by the greenlets,
+            # the reads can yield, so the query is taken first and the headers
+            # are sent with a HTTPResponse
+            query = bottle.request.query
+            headers = {"Content-Type": "text/plain; charset=UTF-8"}
 
-            c = self.db.conn.cursor()
-            c.execute("SELECT body FROM Documents WHERE id = ?", (id,))
-            doc = list(self.db.prepare_docs(c))
-            c.close()
+            try:
+                view = LogView.from_query(query)
+            except ValueError as e:
+                raise bottle.HTTPResponse("Invalid log view: %s" % e, status=400)
+
+            doc = self.db.get_documents([id])
 
             b = doc[0]
 
+            if not view.is_full():
+                # only the job log (gzip-ed, if available) is viewed in parts
+                fn = b.get("stdlog_gzip", None)
+                gzip = fn is not None
+                if query.get("file", None) == "stdout" or not gzip:
+                    fn, gzip = b.get("stdout_fn", None), False
+
+                logfile = self.log_files.get(verify_logfile(fn), gzip=gzip)
+                body = run_blocking(view.read, logfile)
+
+                return bottle.HTTPResponse(body, headers=headers)
+
             startup_fn = b.get("stdout_fn", None)
             startup_iter = []
             if startup_fn:
@@ -711,11 +3177,10 @@ class WebServer(bottle.Bottle):
             if gzip_fn:
                 gzip_iter = decode_zlog(verify_logfile(gzip_fn))
 
-            response.add_header("Content-Type", "text/plain; charset=UTF-8")
             chain = itertools.chain(startup_iter, gzip_iter)
 
             # return "".join(chain)
-            return chain
+            return bottle.HTTPResponse(chain, headers=headers)
 
         @app.route("/utils/control_command/<name>/<cmd>", method=["OPTIONS", "POST"])
         @check_auth
@@ -761,23 +3226,53 @@ class WebServer(bottle.Bottle):
         # @check_auth
         @enable_cors
         def sync_proxy():
-            from bottle import request, response
+            request = own_request()
 
             data = json.loads(request.body.read())
             lst = data.get("messages", [])
+            remote_addr = request.remote_addr
+
+            if "session" not in data:
+                # stateless, every poll is a new sync
+                output = SyncSocket.proxy_mode(lst, peer_address=remote_addr)
+                log.info(str(remote_addr))
+
+                return json_response(json.dumps({"messages": output}))
+
+            # an empty or unknown session id starts a new session,
+            # the client has to (re)send sync_request when "new_session" is set
+            session, created, output = self.proxy_sessions.poll(
+                data["session"],
+                lst,
+                peer_address=remote_addr,
+                wait=data.get("wait", 0),
+            )
 
-            output = SyncSocket.proxy_mode(lst, peer_address=request.remote_addr)
-            log.info(str(request.remote_addr))
+            return json_response(
+                json.dumps(
+                    {
+                        "messages": output,
+                        "session": session.id,
+                        "new_session": created,
+                    }
+                )
+            )
 
-            response.content_type = "application/json"
-            return json.dumps({"messages": output})
+        def proxy_timeout(body):
+            # long-polls (see ProxySessions) need more than the default timeout
+            try:
+                wait = float(json.loads(body).get("wait", 0) or 0)
+            except (ValueError, TypeError, AttributeError):
+                wait = 0
+
+            return self.http.timeout + max(0, min(wait, self.proxy_sessions.max_wait))
 
         ### API for DQM^2 Mirror
         @app.route("/redirect", method=["OPTIONS", "POST"])
         # @check_auth
         @enable_cors
         def redirect():
-            from bottle import request, response
+            request = own_request()
 
             url = (
                 "http://"
@@ -786,10 +3281,67 @@ class WebServer(bottle.Bottle):
                 + request.query.port
                 + "/sync_proxy"
             )
-            r = requests.post(
-                url, data=request.body, headers=request.headers, timeout=5
+            body = request.body.read()
+            r = self.http.post(
+                url,
+                data=body,
+                headers=self.http.forward_headers(request.headers),
+                timeout=proxy_timeout(body),
+            )
+
+            return bottle.HTTPResponse(
+                r.content,
+                r.status_code,
+                headers={
+                    "Content-Type": r.headers.get("Content-Type", "application/json")
+                },
             )
-            return r.content
+
+        @app.route("/redirect_batch", method=["OPTIONS", "POST"])
+        # @check_auth
+        @enable_cors
+        def redirect_batch():
+            """
+            Same as /redirect, but for many nodes at once:
+                {"targets": [{"path": host, "port": port, "body": {...}}, ...]}
+            the bodies are forwarded to the /sync_proxy of each node in parallel,
+            the reply is {"responses": [...]} in the same order,
+            with null for the failed targets and the error in "errors".
+            """
+            request = own_request()
+
+            data = json.loads(request.body.read())
+            targets = data.get("targets", [])
+            if len(targets) > 64:
+                raise bottle.HTTPResponse("Too many targets.", status=400)
+
+            calls = []
+            for t in targets:
+                url = "http://%s:%d/sync_proxy" % (t["path"], int(t["port"]))
+                body = json.dumps(t.get("body", {}))
+                calls.append(
+                    (
+                        "POST",
+                        url,
+                        {
+                            "data": body,
+                            "headers": {"Content-Type": "application/json"},
+                            "timeout": proxy_timeout(body),
+                        },
+                    )
+                )
+
+            responses = []
+            errors = {}
+            for i, (ok, r) in enumerate(self.http.map(calls)):
+                if ok and r.status_code == 200:
+                    responses.append(r.json())
+                    continue
+
+                responses.append(None)
+                errors[i] = repr(r) if not ok else "HTTP %d" % r.status_code
+
+            return json_response(json.dumps({"responses": responses, "errors": errors}))
 
         ### API for DQM^2 Control Room
         @app.route("/cr/exe")
@@ -797,12 +3349,26 @@ class WebServer(bottle.Bottle):
         def cr_api():
             log.info(bottle.request.urlparts)
             log.info(bottle.request.urlparts.query)
-            what = bottle.request.query.get("what")
+
+            # bottle.request and bottle.response are shared by the greenlets
+            # and the queries can yield: only this request's own object
+            # (see own_request) is used, and the answer (with its headers)
+            # is a HTTPResponse, otherwise the leftovers of another request
+            # (ie. its Content-Length) end up in this one
+            out = cr_exe(own_request())
+            if isinstance(out, bottle.HTTPResponse):
+                return out
+
+            return bottle.HTTPResponse(out)
+
+        def cr_exe(request):
+            query = request.query
+            what = query.get("what")
 
             try:
                 if what == "get_dqm_clients":
-                    host = bottle.request.query.get("host", default=None)
-                    playback = bottle.request.query.get("playback", default=True)
+                    host = query.get("host", default=None)
+                    playback = query.get("playback", default=True)
                     cmssw_path = (
                         self.opts["cmssw_path_playback"]
                         if playback == "1"
@@ -810,14 +3376,19 @@ class WebServer(bottle.Bottle):
                     )
                     cmssw_path += self.opts["dqm_clients_subdir"]
                     clients_path = self.opts["hltd_clients_path"]
-                    bottle.response.body = json.dumps(
-                        fff_cluster.get_dqm_clients(host, cmssw_path, clients_path)
+                    answer = self.queries.get(
+                        ("get_dqm_clients", host, cmssw_path),
+                        run_blocking,
+                        fff_cluster.get_dqm_clients,
+                        host,
+                        cmssw_path,
+                        clients_path,
                     )
-                    return bottle.response
+                    return json.dumps(answer)
 
                 elif what == "change_dqm_client":
-                    host = bottle.request.query.get("host", default=None)
-                    playback = bottle.request.query.get("playback", default=True)
+                    host = query.get("host", default=None)
+                    playback = query.get("playback", default=True)
                     cmssw_path = (
                         self.opts["cmssw_path_playback"]
                         if playback == "1"
@@ -825,121 +3396,123 @@ class WebServer(bottle.Bottle):
                     )
                     cmssw_path += self.opts["dqm_clients_subdir"]
                     clients_path = self.opts["hltd_clients_path"]
-                    client = bottle.request.query.get("client", default=None)
-                    state = bottle.request.query.get("state", default=0)
-                    bottle.response.body = fff_cluster.change_dqm_client(
+                    client = query.get("client", default=None)
+                    state = query.get("state", default=0)
+                    answer = fff_cluster.change_dqm_client(
                         host, cmssw_path, clients_path, client, state
                     )
-                    return bottle.response
+                    self.queries.invalidate("get_dqm_clients", host)
+                    return answer
 
                 elif what == "get_cmssw_info":
-                    answer_1 = fff_cluster.get_cmssw_info(
-                        self.opts["cmssw_path_playback"]
-                    )
-                    answer_2 = fff_cluster.get_cmssw_info(
-                        self.opts["cmssw_path_production"]
+                    answer = self.queries.get(
+                        ("get_cmssw_info",), run_blocking, self.get_cmssw_info
                     )
-                    bottle.response.body = (
-                        "\n<strong>Playback:</strong>\n"
-                        + answer_1
-                        + "\n<strong>Production:</strong>\n"
-                        + answer_2
-                    )
-
-                    return bottle.response.body
+                    return answer
 
                 elif what == "get_dqm_machines":
-                    nodes = fff_cluster.get_node()["_all"]
-                    if bottle.request.query.get("kind"):
-                        type_ = bottle.request.query.get("kind")  # answer
+                    nodes = self.queries.get(
+                        ("get_dqm_machines",), lambda: fff_cluster.get_node()["_all"]
+                    )
+                    if query.get("kind"):
+                        type_ = query.get("kind")  # answer
                         for key, lst in nodes.items():
                             if type_ in key:
-                                bottle.response.body = json.dumps(lst)
-                                return bottle.response
-                        bottle.response.body = json.dumps([])
-                        return bottle.response
-                    bottle.response.body = json.dumps(nodes)
-                    return bottle.response
+                                return json.dumps(lst)
+                        return json.dumps([])
+                    return json.dumps(nodes)
 
                 elif what == "get_hltd_versions":
-                    bottle.response.body = json.dumps(
-                        fff_cluster.get_rpm_version_all("/opt/hltd")
+                    answer = self.queries.get(
+                        ("get_hltd_versions",),
+                        run_blocking,
+                        fff_cluster.get_rpm_version_all,
+                        "/opt/hltd",
                     )
-                    return bottle.response
+                    return json.dumps(answer)
 
                 elif what == "get_fff_versions":
-                    bottle.response.body = json.dumps(
-                        fff_cluster.get_rpm_version_all("/opt/fff_dqmtools")
+                    answer = self.queries.get(
+                        ("get_fff_versions",),
+                        run_blocking,
+                        fff_cluster.get_rpm_version_all,
+                        "/opt/fff_dqmtools",
                     )
-                    return bottle.response
+                    return json.dumps(answer)
 
                 elif what == "get_simulator_config":
-                    host = bottle.request.query.get(
-                        "host", default="dqmrubu-c2a06-03-01"
-                    )
-                    bottle.response.body = fff_cluster.get_simulator_config(
+                    host = query.get("host", default="dqmrubu-c2a06-03-01")
+                    return fff_cluster.get_simulator_config(
                         self.opts, fff_cluster.get_host(), host
                     )
-                    return bottle.response
 
                 elif what == "get_simulator_runs":
-                    host = bottle.request.query.get(
-                        "host", default="dqmrubu-c2a06-03-01"
-                    )
-                    bottle.response.body = json.dumps(
+                    host = query.get("host", default="dqmrubu-c2a06-03-01")
+                    return json.dumps(
                         fff_cluster.get_simulator_runs(
                             self.opts, fff_cluster.get_host(), host
                         )
                     )
-                    return bottle.response
 
                 elif what == "restart_hltd":
-                    host = bottle.request.query.get("host", default=None)
-                    bottle.response.body = "Specify host to restart HLTD"
-                    bottle.status.status = 400
-                    if host:
-                        bottle.response.body = fff_cluster.restart_hltd(host)
-                        bottle.status.status = 200
-                    return bottle.response
+                    host = query.get("host", default=None)
+                    if not host:
+                        return bottle.HTTPResponse(
+                            "Specify host to restart HLTD", status=400
+                        )
+
+                    answer = fff_cluster.restart_hltd(host)
+                    self.queries.invalidate("get_hltd_versions")
+                    return answer
 
                 elif what == "restart_fff":
-                    host = bottle.request.query.get("host", default=None)
-                    bottle.status.body = "Specify host to restart FFF"
-                    bottle.status.status = 400
-                    if host:
-                        bottle.status.body = fff_cluster.restart_fff(host)
-                        bottle.response.status = 200
-                    return bottle.response
+                    host = query.get("host", default=None)
+                    if not host:
+                        return bottle.HTTPResponse(
+                            "Specify host to restart FFF", status=400
+                        )
+
+                    answer = fff_cluster.restart_fff(host)
+                    self.queries.invalidate("get_fff_versions")
+                    return answer
 
                 elif what == "get_hltd_logs":
-                    host = bottle.request.query.get("host", default=None)
+                    host = query.get("host", default=None)
+                    view = LogView.from_query(query)
                     answer = ["Specify host HLTD", "Specify host HLTD"]
                     if host:
-                        answer_hltd = fff_cluster.get_txt_file(
-                            host, self.opts["hltd_logfile"], 30
-                        )
-                        answer_anelastic = fff_cluster.get_txt_file(
-                            host, self.opts["anelastic_logfile"], 30
+                        # both over the same (multiplexed) ssh connection
+                        results = run_blocking(
+                            fff_cluster.ssh_run_all,
+                            [
+                                (host, view.shell_command(self.opts["hltd_logfile"])),
+                                (
+                                    host,
+                                    view.shell_command(self.opts["anelastic_logfile"]),
+                                ),
+                            ],
+                            30,
                         )
 
-                        answer = [answer_hltd, answer_anelastic]
-                    bottle.response.body = json.dumps(answer)
-                    return bottle.response
+                        answer = list(map(fff_cluster.ssh_answer, results))
+                    return json.dumps(answer)
 
                 elif what == "get_fff_logs":
-                    host = bottle.request.query.get("host", default=None)
+                    host = query.get("host", default=None)
+                    view = LogView.from_query(query)
                     answer = "Specify host FFF"
                     if host:
-                        answer = fff_cluster.get_txt_file(
-                            host, self.opts["logfile"], 30
+                        result = run_blocking(
+                            fff_cluster.ssh_run,
+                            host,
+                            view.shell_command(self.opts["logfile"]),
+                            30,
                         )
-                    bottle.response.body = json.dumps([answer])
-                    return bottle.response
+                        answer = fff_cluster.ssh_answer(result)
+                    return json.dumps([answer])
 
                 elif what == "get_cluster_status":
-                    requested_cluster = bottle.request.query.get(
-                        "cluster", default="playback"
-                    )
+                    requested_cluster = query.get("cluster", default="playback")
 
                     # Check if any of the clusters matches the cluster name supplied.
                     # clusters' keys are expected to be in the form "<cluster name>_".
@@ -949,43 +3522,22 @@ class WebServer(bottle.Bottle):
                             for cluster_name in fff_cluster.clusters.keys()
                         ]
                     ):
-                        bottle.response.body = json.dumps(
-                            f"Cluster {requested_cluster} does not exist. Possible values: {list(map(lambda cluster_name: cluster_name.split('_')[0], fff_cluster.clusters.keys()))}"
+                        return bottle.HTTPResponse(
+                            json.dumps(
+                                f"Cluster {requested_cluster} does not exist. Possible values: {list(map(lambda cluster_name: cluster_name.split('_')[0], fff_cluster.clusters.keys()))}"
+                            ),
+                            status=404,
                         )
-                        bottle.response.status = 404
-                        return bottle.response
 
                     # Find the actual cluster name in the dictionary
                     for cluster_name in fff_cluster.clusters.keys():
                         if cluster_name.split("_")[0] == requested_cluster:
                             requested_cluster = cluster_name
                             break
-                    result = {}
-
-                    for host in fff_cluster.clusters[requested_cluster]:
-                        # Skip opening a ws to ourselves, gets stuck
-                        if fff_cluster.get_host() == host.split(".")[0]:
-                            result[host] = {"up": True, "msg": None}
-                            continue
-                        try:
-                            ws = WebSocketClient(
-                                f"ws://{host}:9215/sync", protocols=["http-only"]
-                            )
-                            ws.connect()
-                            ws.send(
-                                json.dumps({"event": "sync_request", "known_rev": None})
-                            )
-                            ws.close()
-                            result[host] = {"up": True, "msg": None}
-                        except Exception as e:
-                            log.error(f"Error when opening socket to {host}: {repr(e)}")
-                            result[host] = {"up": False, "msg": repr(e)}
-
+                    result = self.get_cluster_status(requested_cluster)
                     return json.dumps(result)
                 elif what == "start_playback_run":
-                    host = bottle.request.query.get(
-                        "host", default="dqmrubu-c2a06-03-01"
-                    )
+                    host = query.get("host", default="dqmrubu-c2a06-03-01")
                     if fff_cluster.get_host() != host:
                         url = (
                             "http://"
@@ -993,19 +3545,19 @@ class WebServer(bottle.Bottle):
                             + ":"
                             + str(self.opts["web.port"])
                             + "/cr/exe?"
-                            + bottle.request.urlparts.query
+                            + request.urlparts.query
                         )
-                        r = requests.get(
+                        r = self.http.get(
                             url,
-                            data=bottle.request.body,
-                            headers=bottle.request.headers,
+                            data=request.body.read(),
+                            headers=self.http.forward_headers(request.headers),
                             timeout=60,
                         )
                         return r.content
 
-                    run_number = bottle.request.query.get("run_number", default=None)
-                    run_class = bottle.request.query.get("run_key", default=None)
-                    number_of_ls = bottle.request.query.get("number_of_ls", default=0)
+                    run_number = query.get("run_number", default=None)
+                    run_class = query.get("run_key", default=None)
+                    number_of_ls = query.get("number_of_ls", default=0)
 
                     cfg = fff_cluster.get_simulator_config(
                         self.opts, fff_cluster.get_host(), host
@@ -1033,9 +3585,11 @@ class WebServer(bottle.Bottle):
             except Exception as error_log:
                 msg = f"cr_api@{what}: error: {error_log}"
                 log.warning(msg)
-                return msg, 400
+                return bottle.HTTPResponse(msg, status=400)
             log.warning(f"cr_api@{what} : No actions defined for that request")
-            return f"No actions defined for request {what}", 400
+            return bottle.HTTPResponse(
+                f"No actions defined for request {what}", status=400
+            )
 
 
 def run_web_greenlet(db, host="0.0.0.0", port=9215, opts={}, **kwargs):
@@ -1049,8 +3603,37 @@ def run_web_greenlet(db, host="0.0.0.0", port=9215, opts={}, **kwargs):
 
     SyncSocket.db = db
 
-    static_app = WebServer(db, opts)
-    static_app.mount("/sync", WebSocketWSGIApplication(handler_cls=SyncSocket))
+    # the applets on this host hand their reports here directly
+    reports = ReportServer(db)
+    try:
+        reports.start()
+    except OSError:
+        log.warning("Could not open the report socket %s.", reports.key, exc_info=True)
+
+    static_app = WebServer(db, opts, reports=reports)
+    gevent.spawn(static_app.proxy_sessions.run_greenlet)
+
+    # permessage-deflate shrinks the header floods by an order of magnitude
+    extensions = []
+    deflate_options = {
+        "server_no_context_takeover": opts.get(
+            "web.ws_deflate_no_context_takeover", False
+        ),
+        # the clients only send small requests, but a tiny deflate stream
+        # can inflate to gigabytes
+        "max_message_size": opts.get("web.ws_max_message_size", 16 * 1024 * 1024),
+    }
+    if opts.get("web.ws_deflate", True):
+        extensions.append("permessage-deflate")
+
+    static_app.mount(
+        "/sync",
+        WebSocketWSGIApplication(
+            handler_cls=SyncSocket,
+            extensions=extensions,
+            deflate_options=deflate_options,
+        ),
+    )
 
     server = WSGIServer(listener, static_app)
 
@@ -1061,9 +3644,6 @@ def run_web_greenlet(db, host="0.0.0.0", port=9215, opts={}, **kwargs):
     server.serve_forever()
 
 
-import gevent
-
-
 @fff_dqmtools.fork_wrapper(__name__, uid="dqmpro", gid="dqmpro")
 @fff_dqmtools.lock_wrapper
 def __run__(opts, **kwargs):
@@ -1073,7 +3653,21 @@ def __run__(opts, **kwargs):
     db_string = opts["web.db"]
     port = opts["web.port"]
 
-    db = Database(db=db_string)
+    db = Database(
+        db=db_string,
+        wal=opts.get("web.db_wal", False),
+        zdict=opts.get("web.db_zdict", False),
+    )
+
+    for name, plan in sorted(db.check_query_plans().items()):
+        if not plan["ok"]:
+            log.warning("Header lookup by %s is a full scan: %s", name, plan["plan"])
+
+    greenlets = [gevent.spawn(run_web_greenlet, db, port=port, opts=opts)]
+
+    retention = opts.get("web.db_retention", "")
+    if retention:
+        db.retention = DatabaseRetention(db, retention)
+        greenlets.append(gevent.spawn(db.retention.run_greenlet))
 
-    fwt = gevent.spawn(run_web_greenlet, db, port=port, opts=opts)
-    gevent.joinall([fwt], raise_error=True)
+    gevent.joinall(greenlets, raise_error=True)
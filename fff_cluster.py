@@ -5,7 +5,14 @@
 import socket
 import subprocess
 import os
+import fnmatch
+import time
+import stat
+import tempfile
+import threading
 from threading import Timer
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import json
 
 clusters = {
@@ -51,77 +58,334 @@ def popen_timeout(cmd: str, seconds: int = 10):
     return answer
 
 
+# the ssh binary, FFF_SSH can point to a fake one for testing
+SSH = os.environ.get("FFF_SSH", "ssh")
+
+# one persistent (multiplexed) connection per host,
+# the commands after the first one skip the handshake
+# (ControlPath is added by ssh_options(), see ssh_control_dir())
+SSH_OPTIONS = [
+    "-o",
+    "BatchMode=yes",
+    "-o",
+    "ConnectTimeout=5",
+]
+
+# idle seconds before a master connection exits
+SSH_PERSIST = 300
+
+SshResult = namedtuple(
+    "SshResult",
+    ["host", "command", "returncode", "stdout", "stderr", "elapsed"],
+)
+
+_ssh_masters = {}  # host -> last use of its master connection
+_ssh_locks = {}
+_ssh_locks_lock = threading.Lock()
+_ssh_control_dir = None
+
+
+def ssh_control_dir() -> str:
+    """
+    The directory of the master connection sockets, only accessible
+    by us: anyone able to create (or replace) a socket there could run
+    (sudo) commands through our connections.
+
+    It is /tmp/fff_dqmtools-ssh-<uid>, so the masters outlive restarts,
+    unless someone else got there first, then a fresh private one.
+    """
+    global _ssh_control_dir
+
+    with _ssh_locks_lock:
+        if _ssh_control_dir is not None:
+            return _ssh_control_dir
+
+        path = os.path.join(tempfile.gettempdir(), "fff_dqmtools-ssh-%d" % os.getuid())
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+
+        # lstat, a symlink is not good enough
+        st = os.lstat(path)
+        if (
+            not stat.S_ISDIR(st.st_mode)
+            or st.st_uid != os.getuid()
+            or stat.S_IMODE(st.st_mode) != 0o700
+        ):
+            path = tempfile.mkdtemp(prefix="fff_dqmtools-ssh-")
+
+        _ssh_control_dir = path
+        return path
+
+
+def ssh_options() -> list:
+    return ["-o", "ControlPath=%s/%%C" % ssh_control_dir()] + SSH_OPTIONS
+
+
+def ssh_master(host: str, timeout: int = 15):
+    """
+    Starts the master connection to the host, unless it is running.
+    Returns None, or (returncode, stderr) if the connection failed.
+
+    The master is a separate "ssh -MNf" invocation: a master forked
+    by an ordinary "ControlMaster=auto" command inherits its stdout and
+    stderr, and older OpenSSH versions keep them open in the background,
+    so capturing the output blocked until the timeout.
+    """
+    with _ssh_locks_lock:
+        lock = _ssh_locks.setdefault(host, threading.Lock())
+
+    with lock:
+        last = _ssh_masters.get(host, None)
+        if last is not None and time.time() - last < SSH_PERSIST / 2:
+            return None
+
+        check = subprocess.run(
+            [SSH] + ssh_options() + ["-O", "check", host],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=timeout,
+        )
+
+        if check.returncode != 0:
+            # a file (not a pipe), the master keeps it open
+            with tempfile.TemporaryFile() as stderr:
+                p = subprocess.run(
+                    [SSH]
+                    + ssh_options()
+                    + ["-o", "ControlPersist=%d" % SSH_PERSIST, "-MNf", host],
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=stderr,
+                    timeout=timeout,
+                )
+
+                if p.returncode:
+                    stderr.seek(0)
+                    return p.returncode, stderr.read().decode("utf-8", errors="ignore")
+
+        _ssh_masters[host] = time.time()
+        return None
+
+
+def ssh_run(host: str, command: str, timeout: int = 15) -> SshResult:
+    """Runs the (remote shell) command on the host, never raises."""
+    start = time.time()
+    try:
+        failed = ssh_master(host, timeout)
+        if failed is not None:
+            returncode, stdout, stderr = failed[0], "", failed[1]
+        else:
+            p = subprocess.run(
+                [SSH] + ssh_options() + [host, command],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=max(1, timeout - (time.time() - start)),
+            )
+            returncode = p.returncode
+            stdout = p.stdout.decode("utf-8", errors="ignore")
+            stderr = p.stderr.decode("utf-8", errors="ignore")
+
+            # every use restarts the idle (ControlPersist) timer
+            _ssh_masters[host] = time.time()
+    except subprocess.TimeoutExpired:
+        returncode, stdout, stderr = -1, "", "Timeout after %ds." % timeout
+    except Exception as error_log:
+        returncode, stdout, stderr = -1, "", str(error_log)
+
+    return SshResult(host, command, returncode, stdout, stderr, time.time() - start)
+
+
+def ssh_run_all(tasks: list, timeout: int = 15, max_parallel: int = 16) -> list:
+    """
+    Runs the (host, command) tasks concurrently, at most max_parallel
+    at a time. Returns the SshResults in the same order.
+    """
+    if not tasks:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_parallel, len(tasks))) as executor:
+        futures = [executor.submit(ssh_run, host, cmd, timeout) for host, cmd in tasks]
+        return [f.result() for f in futures]
+
+
+def ssh_answer(result: SshResult) -> str:
+    # same as popen_timeout(): the output, or the error output on failure
+    if result.returncode:
+        return result.stderr
+    return result.stdout
+
+
 def get_rpm_version(host, soft_path):
     if not host:
         return "host argument not defined"
     if not soft_path:
         return "soft_path argument not defined"
-    return popen_timeout(["ssh " + host + ' "rpm -qf ' + soft_path + '"'], 5)
+    return ssh_answer(ssh_run(host, "rpm -qf " + soft_path, 5))
 
 
 def get_rpm_version_all(soft_path: str):
+    tasks = []
+    for key, lst in clusters.items():
+        for host in lst:
+            tasks.append((host, "rpm -qf " + soft_path))
+
+    results = iter(ssh_run_all(tasks, 5))
+
     answer = {}
     for key, lst in clusters.items():
         subanswer = {}
         for host in lst:
-            version = get_rpm_version(host, soft_path)
-            subanswer[host] = version
+            subanswer[host] = ssh_answer(next(results))
         answer[key] = subanswer
 
     return answer
 
 
+# memoized scans of the release areas, see get_cmssw_info()
+# (path, matcher) -> ((mtime, size), result)
+_file_cache = {}
+# (top directory, pattern) -> ({directory: mtime}, [files])
+_tree_cache = {}
+
+
+def _scan_file(path: str, matcher, pattern: bytes):
+    """matcher(path, pattern), recomputed only if the file has changed."""
+    st = os.stat(path)
+    key = (path, matcher.__name__, pattern)
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    cached = _file_cache.get(key, None)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    result = matcher(path, pattern)
+    _file_cache[key] = (stamp, result)
+    return result
+
+
+def _grep_lines(path: str, pattern: bytes) -> list:
+    with open(path, "rb") as f:
+        return [line.decode("utf-8", errors="ignore") for line in f if pattern in line]
+
+
+def _grep_any(path: str, pattern: bytes) -> bool:
+    # stops at the first match
+    with open(path, "rb") as f:
+        return any(pattern in line for line in f)
+
+
+def _find_files(top: str, pattern: str) -> list:
+    """
+    Same as 'find top -type f -name pattern', but the listing is
+    kept until one of the directories changes (a stat per directory).
+    """
+    cached = _tree_cache.get((top, pattern), None)
+    if cached is not None:
+        dirs, files = cached
+        try:
+            if all(os.stat(d).st_mtime_ns == m for d, m in dirs.items()):
+                return files
+        except OSError:
+            pass
+
+    dirs, files = {}, []
+    stack = [top]
+    while stack:
+        d = stack.pop()
+        try:
+            dirs[d] = os.stat(d).st_mtime_ns
+            with os.scandir(d) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and fnmatch.fnmatch(
+                        entry.name, pattern
+                    ):
+                        files.append(entry.path)
+        except OSError:
+            continue
+
+    files.sort()
+    _tree_cache[(top, pattern)] = (dirs, files)
+    return files
+
+
+def _list_files(path: str, pattern: str = "*") -> list:
+    # the regular files directly in path, like the shell glob path/pattern
+    try:
+        with os.scandir(path) as it:
+            return sorted(
+                e.path
+                for e in it
+                if e.is_file()
+                and not e.name.startswith(".")
+                and fnmatch.fnmatch(e.name, pattern)
+            )
+    except OSError:
+        return []
+
+
 def get_cmssw_info(cmssw_path: str) -> str:
     if not cmssw_path:
         return "cmssw_path argument not defined"
     if cmssw_path[-1] != "/":
         cmssw_path += "/"
 
+    # no subprocesses here: the files are scanned in-process
+    # and the results are kept until the files change
+
     # 1. read CMSSW logs
-    versions_raw = popen_timeout(
-        [
-            'grep "Selected release:" --exclude-dir="*" --include=*.log '
-            + cmssw_path
-            + "*"
-        ],
-        15,
-    )
-    if not "Selected release:" in versions_raw:
-        return versions_raw
-    answer = versions_raw.split("Selected release: ")[-1]
+    if not os.path.isdir(cmssw_path):
+        return "No such directory: %s" % cmssw_path
+
+    versions = []
+    for fname in _list_files(cmssw_path, "*.log"):
+        versions += _scan_file(fname, _grep_lines, b"Selected release:")
+
+    versions = [v for v in versions if "Selected release: " in v]
+    if not versions:
+        return "No 'Selected release:' in %s*.log" % cmssw_path
+    answer = versions[-1].split("Selected release: ")[-1]
 
     # 2. get PRs
-    prs_raw = popen_timeout(["find " + cmssw_path + ' -type f -name "merge*log"'], 15)
     answer += "PRs :"
 
     # 3. get PRs merge status
-    for fname in prs_raw.split("\n"):
+    for fname in _find_files(cmssw_path, "merge*log"):
         try:
             pr_id = os.path.basename(fname).split(".")[1]
-            status = popen_timeout(['grep "Merge successful" ' + fname], 15)
+            status = _scan_file(fname, _grep_any, b"Merge successful")
             answer += "\n " + pr_id
             answer += " ok" if status else " "
         except:
             continue
 
     # 4. get GTs
-    gts_raw = popen_timeout(
-        [
-            'grep -r "GlobalTag.globaltag = " '
-            + cmssw_path
-            + "src/DQM/Integration/python/config/*"
-        ],
-        15,
-    )
-    if not "GlobalTag.globaltag" in gts_raw:
+    # like 'grep -r ... config/*': the subdirectories too,
+    # but not the hidden entries of config/ itself
+    gts = []
+    config_path = cmssw_path + "src/DQM/Integration/python/config/"
+    for fname in _find_files(config_path, "*"):
+        if fname[len(config_path) :].startswith("."):
+            continue
+
+        for line in _scan_file(fname, _grep_lines, b"GlobalTag.globaltag = "):
+            gts.append(fname + ":" + line.rstrip("\n"))
+
+    if not gts:
         return answer
     answer += "\nGTs:\n"
-    for line in gts_raw.split("\n"):
+    for line in gts:
         if "autoCond" in line:
             continue
         answer += line + "\n"
 
-    return answer
+    # grep output used to end with an empty line
+    return answer + "\n"
 
 
 def get_dqm_clients(host: str, cmssw_path: str, clients_path: str) -> list:
@@ -129,11 +393,15 @@ def get_dqm_clients(host: str, cmssw_path: str, clients_path: str) -> list:
         return "host argument not defined"
     if not cmssw_path:
         return "cmssw_path argument not defined"
-    available = popen_timeout(
-        ["ssh " + host + ' "find ' + cmssw_path + ' -type f -name *_cfg.py"'], 15
-    )
-    activated = popen_timeout(
-        ["ssh " + host + ' "find ' + clients_path + ' -type l"'], 15
+    available, activated = map(
+        ssh_answer,
+        ssh_run_all(
+            [
+                (host, "find " + cmssw_path + " -type f -name *_cfg.py"),
+                (host, "find " + clients_path + " -type l"),
+            ],
+            15,
+        ),
     )
 
     available = [os.path.basename(a) for a in available.split("\n") if a]
@@ -148,23 +416,17 @@ def change_dqm_client(
 ) -> str:
     answer = None
     if state == "0":
-        answer = popen_timeout(
-            [
-                "ssh "
-                + host
-                + ' "sudo find '
-                + clients_path
-                + " -type l -name "
-                + client
-                + ' -delete"'
-            ],
-            15,
+        answer = ssh_answer(
+            ssh_run(
+                host,
+                "sudo find " + clients_path + " -type l -name " + client + " -delete",
+                15,
+            )
         )
     else:
         inp = os.path.join(cmssw_path, client)
-        answer = popen_timeout(
-            ["ssh " + host + ' "cd ' + clients_path + "/idle; sudo ln -s " + inp + '"'],
-            15,
+        answer = ssh_answer(
+            ssh_run(host, "cd " + clients_path + "/idle; sudo ln -s " + inp, 15)
         )
 
     if not answer:
@@ -180,7 +442,7 @@ def get_simulator_config(opts: dict, this_host: str, simulator_host: str) -> str
     if this_host == simulator_host:
         cfg = popen_timeout(["cat " + path], 5)
     else:
-        cfg = popen_timeout(["ssh " + simulator_host + ' "cat ' + path + '"'], 5)
+        cfg = ssh_answer(ssh_run(simulator_host, "cat " + path, 5))
     return cfg
 
 
@@ -215,9 +477,7 @@ def get_simulator_runs(opts: dict, this_host: str, simulator_host: str) -> list:
     if this_host == simulator_host:
         runs_raw = popen_timeout(["ls -1d " + path + "/run*"], 5)
     else:
-        runs_raw = popen_timeout(
-            ["ssh " + simulator_host + ' "ls -1d ' + path + '/run*"'], 5
-        )
+        runs_raw = ssh_answer(ssh_run(simulator_host, "ls -1d " + path + "/run*", 5))
     runs = []
     for run in runs_raw.split("\n"):
         runs += [os.path.basename(run)]
@@ -227,13 +487,12 @@ def get_simulator_runs(opts: dict, this_host: str, simulator_host: str) -> list:
 def restart_hltd(host: str) -> str:
     if not host:
         return "host argument not defined"
-    answer = popen_timeout(
-        [
-            "ssh "
-            + host
-            + ' "sudo -i /sbin/service hltd stop; sudo -i /sbin/service hltd start"'
-        ],
-        15,
+    answer = ssh_answer(
+        ssh_run(
+            host,
+            "sudo -i /sbin/service hltd stop; sudo -i /sbin/service hltd start",
+            15,
+        )
     )
     if not answer:
         return "Ok"
@@ -243,8 +502,8 @@ def restart_hltd(host: str) -> str:
 def restart_fff(host: str) -> str:
     if not host:
         return "host argument not defined"
-    answer = popen_timeout(
-        ["ssh " + host + ' "sudo systemctl restart fff_dqmtools.service"'], 15
+    answer = ssh_answer(
+        ssh_run(host, "sudo systemctl restart fff_dqmtools.service", 15)
     )
     if not answer:
         return "Ok"
@@ -256,7 +515,7 @@ def get_txt_file(host: str, path: str, timeout=30):
         return "host argument not defined"
     if not path:
         return "path argument not defined"
-    return popen_timeout(["ssh " + host + ' "cat ' + path + '"'], timeout)
+    return ssh_answer(ssh_run(host, "cat " + path, timeout))
 
 
 def get_host() -> str:
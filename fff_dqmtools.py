@@ -462,6 +462,14 @@ if __name__ == "__main__":
         "hltd_logfile": "/var/log/hltd/hltd.log",
         "anelastic_logfile": "/var/log/hltd/anelastic.log",
         "web.db": "/var/lib/fff_dqmtools/db.20171027.sqlite3",
+        "web.db_wal": False,
+        "web.db_zdict": False,
+        # see DatabaseRetention, the databases created before it
+        # need a 'utils/compress_db.py vacuum' to shrink
+        "web.db_retention": "",
+        "web.ws_deflate": True,
+        "web.ws_deflate_no_context_takeover": False,
+        "web.ws_max_message_size": 16 * 1024 * 1024,
         "web.port": 9215,
         "web.secret": config_web_secret,
         "web.secret_name": "selenium-secret-secret",
@@ -482,6 +490,12 @@ if __name__ == "__main__":
         "anelastic_logfile": str,
         "web.port": int,
         "web.db": str,
+        "web.db_wal": bool,
+        "web.db_zdict": bool,
+        "web.db_retention": str,
+        "web.ws_deflate": bool,
+        "web.ws_deflate_no_context_takeover": bool,
+        "web.ws_max_message_size": int,
         "web.secret": str,
         "web.secret_name": str,
         "deleter.ramdisk": str,
@@ -8,6 +8,7 @@ import ssl
 from ws4py import WS_KEY, WS_VERSION
 from ws4py.exc import HandshakeError
 from ws4py.websocket import WebSocket
+from ws4py.compression import PerMessageDeflate
 from ws4py.compat import urlsplit
 
 __all__ = ["WebSocketBaseClient"]
@@ -262,6 +263,11 @@ class WebSocketBaseClient(WebSocket):
             self.close_connection()
             raise
 
+        if self.extensions:
+            self.stream.compression = PerMessageDeflate.accept(
+                b", ".join(self.extensions)
+            )
+
         self.handshake_ok()
         if body:
             self.process(body)
@@ -283,6 +289,9 @@ class WebSocketBaseClient(WebSocket):
         if self.protocols:
             headers.append(("Sec-WebSocket-Protocol", ",".join(self.protocols)))
 
+        if self.extensions:
+            headers.append(("Sec-WebSocket-Extensions", ", ".join(self.extensions)))
+
         if self.extra_headers:
             headers.extend(self.extra_headers)
 
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+__doc__ = """
+Compression Extensions for WebSocket as defined by :rfc:`7692`
+(the ``permessage-deflate`` extension).
+
+The server side negotiates the extension with
+:meth:`PerMessageDeflate.negotiate` and the client side accepts
+the server's response with :meth:`PerMessageDeflate.accept`.
+The negotiated instance is then attached to the
+:class:`ws4py.streaming.Stream` as its ``compression`` attribute.
+"""
+import zlib
+
+from ws4py.exc import MessageTooBigException
+
+__all__ = ["PerMessageDeflate", "parse_extensions"]
+
+EXTENSION_NAME = "permessage-deflate"
+
+# appended by Z_SYNC_FLUSH, stripped from the wire (rfc7692 section 7.2.1)
+_DEFLATE_TAIL = b"\x00\x00\xff\xff"
+
+
+def parse_extensions(value):
+    """
+    Parses a ``Sec-WebSocket-Extensions`` header value
+    into a list of ``(name, params)`` tuples.
+    Params without a value are set to ``None``.
+    """
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+
+    extensions = []
+    for ext in value.split(","):
+        parts = [p.strip() for p in ext.split(";")]
+        if not parts[0]:
+            continue
+
+        params = {}
+        for p in parts[1:]:
+            if not p:
+                continue
+
+            k, _, v = p.partition("=")
+            v = v.strip().strip('"')
+            params[k.strip().lower()] = v if v else None
+
+        extensions.append((parts[0].lower(), params))
+
+    return extensions
+
+
+class PerMessageDeflate(object):
+    def __init__(
+        self,
+        is_server=True,
+        server_no_context_takeover=False,
+        client_no_context_takeover=False,
+        server_max_window_bits=15,
+        client_max_window_bits=15,
+        compress_level=6,
+        min_size=64,
+        max_message_size=None,
+    ):
+        """
+        Negotiated ``permessage-deflate`` state for one connection.
+
+        ``is_server`` tells which of the ``server_*`` and ``client_*``
+        parameters apply to our outgoing messages.
+
+        Messages smaller than ``min_size`` bytes are sent
+        uncompressed, the extension allows it per message.
+
+        Incoming messages inflating to more than ``max_message_size``
+        bytes (``None`` for no limit) raise
+        :exc:`ws4py.exc.MessageTooBigException`, a few kilobytes
+        of deflate stream can inflate to gigabytes.
+        """
+        self.is_server = is_server
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.compress_level = compress_level
+        self.min_size = min_size
+        self.max_message_size = max_message_size
+
+        if is_server:
+            self.local_no_context_takeover = server_no_context_takeover
+            self.local_max_window_bits = server_max_window_bits
+            self.remote_no_context_takeover = client_no_context_takeover
+            self.remote_max_window_bits = client_max_window_bits
+        else:
+            self.local_no_context_takeover = client_no_context_takeover
+            self.local_max_window_bits = client_max_window_bits
+            self.remote_no_context_takeover = server_no_context_takeover
+            self.remote_max_window_bits = server_max_window_bits
+
+        self._compressor = None
+        self._decompressor = None
+        self._message_size = 0
+
+    @classmethod
+    def negotiate(cls, header, **options):
+        """
+        Server side: picks the first acceptable ``permessage-deflate``
+        offer from the client's ``Sec-WebSocket-Extensions`` header.
+
+        The ``options`` are the server preferences (the constructor
+        arguments). Returns a tuple ``(instance, response)`` where
+        ``response`` is the extension string for the handshake reply,
+        or ``(None, None)`` if nothing acceptable was offered.
+        """
+        want_server_nct = options.get("server_no_context_takeover", False)
+        want_client_nct = options.get("client_no_context_takeover", False)
+        want_server_bits = options.get("server_max_window_bits", 15)
+        want_client_bits = options.get("client_max_window_bits", 15)
+
+        for name, params in parse_extensions(header):
+            if name != EXTENSION_NAME:
+                continue
+
+            known = set(
+                [
+                    "server_no_context_takeover",
+                    "client_no_context_takeover",
+                    "server_max_window_bits",
+                    "client_max_window_bits",
+                ]
+            )
+            if not set(params.keys()).issubset(known):
+                continue
+
+            response = [EXTENSION_NAME]
+
+            server_nct = want_server_nct or "server_no_context_takeover" in params
+            if server_nct:
+                response.append("server_no_context_takeover")
+
+            client_nct = want_client_nct or "client_no_context_takeover" in params
+            if client_nct:
+                response.append("client_no_context_takeover")
+
+            server_bits = want_server_bits
+            if "server_max_window_bits" in params:
+                try:
+                    requested = int(params["server_max_window_bits"])
+                except (TypeError, ValueError):
+                    continue
+
+                # zlib can't produce raw deflate streams with 8 bit windows
+                if not (9 <= requested <= 15):
+                    continue
+
+                server_bits = min(server_bits, requested)
+
+            if server_bits < 15:
+                response.append("server_max_window_bits=%d" % server_bits)
+
+            client_bits = 15
+            if "client_max_window_bits" in params:
+                client_bits = want_client_bits
+                if params["client_max_window_bits"] is not None:
+                    try:
+                        offered = int(params["client_max_window_bits"])
+                    except ValueError:
+                        continue
+
+                    if not (8 <= offered <= 15):
+                        continue
+
+                    client_bits = min(client_bits, offered)
+
+                if client_bits < 15:
+                    response.append("client_max_window_bits=%d" % client_bits)
+
+            ext = cls(
+                is_server=True,
+                server_no_context_takeover=server_nct,
+                client_no_context_takeover=client_nct,
+                server_max_window_bits=server_bits,
+                client_max_window_bits=client_bits,
+                compress_level=options.get("compress_level", 6),
+                min_size=options.get("min_size", 64),
+                max_message_size=options.get("max_message_size", None),
+            )
+            return ext, "; ".join(response)
+
+        return None, None
+
+    @classmethod
+    def offer(cls, client_no_context_takeover=False):
+        """
+        Client side: the extension string to put in the handshake request.
+        """
+        if client_no_context_takeover:
+            return "%s; client_no_context_takeover" % EXTENSION_NAME
+
+        return "%s; client_max_window_bits" % EXTENSION_NAME
+
+    @classmethod
+    def accept(cls, header, **options):
+        """
+        Client side: builds the instance from the server's response,
+        returns ``None`` if the server did not enable the extension.
+        """
+        for name, params in parse_extensions(header):
+            if name != EXTENSION_NAME:
+                continue
+
+            def bits(key):
+                v = params.get(key, None)
+                return int(v) if v else 15
+
+            return cls(
+                is_server=False,
+                server_no_context_takeover="server_no_context_takeover" in params,
+                client_no_context_takeover=(
+                    "client_no_context_takeover" in params
+                    or options.get("client_no_context_takeover", False)
+                ),
+                server_max_window_bits=bits("server_max_window_bits"),
+                client_max_window_bits=bits("client_max_window_bits"),
+                compress_level=options.get("compress_level", 6),
+                min_size=options.get("min_size", 64),
+                max_message_size=options.get("max_message_size", None),
+            )
+
+        return None
+
+    def should_compress(self, data):
+        return len(data) >= self.min_size
+
+    def compress(self, data, last=True):
+        """
+        Compresses (a fragment of) an outgoing message.
+        The deflate tail is stripped from the last fragment.
+        """
+        if self._compressor is None:
+            # zlib does not support 8 bit windows for raw deflate
+            wbits = max(self.local_max_window_bits, 9)
+            self._compressor = zlib.compressobj(
+                self.compress_level, zlib.DEFLATED, -wbits
+            )
+
+        body = self._compressor.compress(bytes(data))
+        body += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        if last:
+            if body.endswith(_DEFLATE_TAIL):
+                body = body[: -len(_DEFLATE_TAIL)]
+
+            if self.local_no_context_takeover:
+                self._compressor = None
+
+        return body
+
+    def decompress(self, data, last=True):
+        """
+        Decompresses (a fragment of) an incoming message.
+        """
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj(-self.remote_max_window_bits)
+
+        body = self._inflate(bytes(data))
+        if last:
+            body += self._inflate(_DEFLATE_TAIL)
+            self._message_size = 0
+
+            if self.remote_no_context_takeover:
+                self._decompressor = None
+
+        return body
+
+    def _inflate(self, data):
+        if self.max_message_size is None:
+            return self._decompressor.decompress(data)
+
+        # one byte more than what is left tells an oversized message
+        room = self.max_message_size - self._message_size
+        body = self._decompressor.decompress(data, room + 1)
+
+        self._message_size += len(body)
+        if self._message_size > self.max_message_size:
+            raise MessageTooBigException(
+                "Message inflates to more than %d bytes" % self.max_message_size
+            )
+
+        return body
@@ -3,6 +3,7 @@
 __all__ = [
     "WebSocketException",
     "FrameTooLargeException",
+    "MessageTooBigException",
     "ProtocolException",
     "UnsupportedFrameTypeException",
     "TextFrameEncodingException",
@@ -26,6 +27,10 @@ class FrameTooLargeException(WebSocketException):
     pass
 
 
+class MessageTooBigException(WebSocketException):
+    pass
+
+
 class UnsupportedFrameTypeException(WebSocketException):
     pass
 
@@ -4,6 +4,14 @@ from struct import pack, unpack
 from ws4py.exc import FrameTooLargeException, ProtocolException
 from ws4py.compat import py3k, ord, range
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# below this size the integer xor is faster than numpy's setup
+NUMPY_MASK_THRESHOLD = 1024
+
 # Frame opcodes defined in the spec.
 OPCODE_CONTINUATION = 0x0
 OPCODE_TEXT = 0x1
@@ -50,6 +58,9 @@ class Frame(object):
         self.rsv3 = rsv3
         self.payload_length = len(body)
 
+        # set when an extension (permessage-deflate) has been negotiated
+        self.allow_rsv1 = False
+
         self._parser = None
 
     @property
@@ -159,7 +170,11 @@ class Frame(object):
         # frame-rsv1 = %x0 ; 1 bit, MUST be 0 unless negotiated otherwise
         # frame-rsv2 = %x0 ; 1 bit, MUST be 0 unless negotiated otherwise
         # frame-rsv3 = %x0 ; 1 bit, MUST be 0 unless negotiated otherwise
-        if self.rsv1 or self.rsv2 or self.rsv3:
+        if self.rsv2 or self.rsv3:
+            raise ProtocolException()
+
+        # rsv1 marks compressed data messages (rfc7692)
+        if self.rsv1 and (not self.allow_rsv1 or self.opcode > 0x7):
             raise ProtocolException()
 
         # control frames between 3 and 7 as well as above 0xA are currently reserved
@@ -275,14 +290,36 @@ class Frame(object):
            j                   = i MOD 4
            transformed-octet-i = original-octet-i XOR masking-key-octet-j
 
+        The key is repeated over the whole payload and XORed
+        in a single operation (as a big integer, or with numpy
+        for large payloads if it is available).
         """
-        masked = bytearray(data)
-        if py3k:
-            key = self.masking_key
-        else:
+        if not py3k:
+            masked = bytearray(data)
             key = map(ord, self.masking_key)
-        for i in range(len(data)):
-            masked[i] = masked[i] ^ key[i % 4]
-        return masked
+            for i in range(len(data)):
+                masked[i] = masked[i] ^ key[i % 4]
+            return masked
+
+        # the parser can leave more than 4 bytes in masking_key
+        key = bytes(self.masking_key[:4])
+        length = len(data)
+        if length == 0:
+            return bytearray()
+
+        if numpy is not None and length >= NUMPY_MASK_THRESHOLD:
+            # xor in place, four bytes at a time, then the leftover
+            masked = bytearray(data)
+            words = numpy.frombuffer(masked, dtype=numpy.uint32, count=length // 4)
+            words ^= numpy.frombuffer(key, dtype=numpy.uint32)[0]
+            for i in range(length - length % 4, length):
+                masked[i] ^= key[i % 4]
+            return masked
+
+        full_key = key * (length // 4 + 1)
+        masked = int.from_bytes(data, "little") ^ int.from_bytes(
+            full_key[:length], "little"
+        )
+        return bytearray(masked.to_bytes(length, "little"))
 
     unmask = mask
@@ -57,19 +57,32 @@ class Message(object):
 
         self.data = data
 
-    def single(self, mask=False):
+    def single(self, mask=False, compression=None):
         """
         Returns a frame bytes with the fin bit set and a random mask.
 
         If ``mask`` is set, automatically mask the frame
         using a generated 4-byte token.
+
+        If ``compression`` (a negotiated
+        :class:`ws4py.compression.PerMessageDeflate`) is set,
+        data messages are compressed and the frame's ``rsv1`` bit is set.
         """
         mask = os.urandom(4) if mask else None
+
+        body, rsv1 = self.data, 0
+        if (
+            compression is not None
+            and self.opcode in (OPCODE_TEXT, OPCODE_BINARY)
+            and compression.should_compress(body)
+        ):
+            body, rsv1 = compression.compress(body), 1
+
         return Frame(
-            body=self.data, opcode=self.opcode, masking_key=mask, fin=1
+            body=body, opcode=self.opcode, masking_key=mask, fin=1, rsv1=rsv1
         ).build()
 
-    def fragment(self, first=False, last=False, mask=False):
+    def fragment(self, first=False, last=False, mask=False, compression=None):
         """
         Returns a :class:`ws4py.framing.Frame` bytes.
 
@@ -78,11 +91,21 @@ class Message(object):
         * ``first``: the frame uses ``self.opcode`` else a continuation opcode
         * ``last``: the frame has its ``fin`` bit set
         * ``mask``: the frame is masked using a automatically generated 4-byte token
+        * ``compression``: all the fragments of a data message are compressed
+          as a single deflate stream, ``rsv1`` is set on the first frame only
         """
         fin = 1 if last is True else 0
         opcode = self.opcode if first is True else OPCODE_CONTINUATION
         mask = os.urandom(4) if mask else None
-        return Frame(body=self.data, opcode=opcode, masking_key=mask, fin=fin).build()
+
+        body, rsv1 = self.data, 0
+        if compression is not None and self.opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            body = compression.compress(body, last=last is True)
+            rsv1 = 1 if first is True else 0
+
+        return Frame(
+            body=body, opcode=opcode, masking_key=mask, fin=fin, rsv1=rsv1
+        ).build()
 
     @property
     def completed(self):
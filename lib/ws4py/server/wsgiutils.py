@@ -52,6 +52,7 @@ import logging
 import sys
 
 from ws4py.websocket import WebSocket
+from ws4py.compression import PerMessageDeflate, EXTENSION_NAME
 from ws4py.exc import HandshakeError
 from ws4py.compat import unicode, py3k
 from ws4py import WS_VERSION, WS_KEY, format_addresses
@@ -62,12 +63,23 @@ __all__ = ["WebSocketWSGIApplication"]
 
 
 class WebSocketWSGIApplication(object):
-    def __init__(self, protocols=None, extensions=None, handler_cls=WebSocket):
+    def __init__(
+        self,
+        protocols=None,
+        extensions=None,
+        handler_cls=WebSocket,
+        deflate_options=None,
+    ):
         """
         WSGI application usable to complete the upgrade handshake
         by validating the requested protocols and extensions as
         well as the websocket version.
 
+        If `'permessage-deflate'` is listed in `extensions`, it is
+        negotiated as per :rfc:`7692`, `deflate_options` are passed to
+        :meth:`ws4py.compression.PerMessageDeflate.negotiate`
+        (ie. `server_no_context_takeover`, `compress_level`).
+
         If the upgrade validates, the `handler_cls` class
         is instanciated and stored inside the WSGI `environ`
         under the `'ws4py.websocket'` key to make it
@@ -76,6 +88,7 @@ class WebSocketWSGIApplication(object):
         self.protocols = protocols
         self.extensions = extensions
         self.handler_cls = handler_cls
+        self.deflate_options = deflate_options or {}
 
     def make_websocket(self, sock, protocols, extensions, environ):
         """
@@ -139,12 +152,20 @@ class WebSocketWSGIApplication(object):
                     ws_protocols.append(s)
 
         ws_extensions = []
+        ws_deflate = None
         exts = self.extensions or []
         extensions = environ.get("HTTP_SEC_WEBSOCKET_EXTENSIONS")
         if extensions:
+            if EXTENSION_NAME in exts:
+                ws_deflate, response = PerMessageDeflate.negotiate(
+                    extensions, **self.deflate_options
+                )
+                if ws_deflate is not None:
+                    ws_extensions.append(response)
+
             for ext in extensions.split(","):
                 ext = ext.strip()
-                if ext in exts:
+                if ext in exts and ext != EXTENSION_NAME:
                     ws_extensions.append(ext)
 
         accept_value = base64.b64encode(sha1(key.encode("utf-8") + WS_KEY).digest())
@@ -165,8 +186,9 @@ class WebSocketWSGIApplication(object):
 
         start_response("101 Switching Protocols", upgrade_headers)
 
-        self.make_websocket(
+        websocket = self.make_websocket(
             environ["ws4py.socket"], ws_protocols, ws_extensions, environ
         )
+        websocket.stream.compression = ws_deflate
 
         return []
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import struct
+import zlib
 from struct import unpack
 
 from ws4py.utf8validator import Utf8Validator
@@ -21,6 +22,7 @@ from ws4py.framing import (
 )
 from ws4py.exc import (
     FrameTooLargeException,
+    MessageTooBigException,
     ProtocolException,
     InvalidBytesError,
     TextFrameEncodingException,
@@ -100,6 +102,12 @@ class Stream(object):
         self.always_mask = always_mask
         self.expect_masking = expect_masking
 
+        self.compression = None
+        """
+        Negotiated :class:`ws4py.compression.PerMessageDeflate`
+        instance, if any. Set right after the handshake.
+        """
+
     @property
     def parser(self):
         if self._parser is None:
@@ -196,8 +204,10 @@ class Stream(object):
         utf8validator = Utf8Validator()
         running = True
         frame = None
+        compressed = False
         while running:
             frame = Frame()
+            frame.allow_rsv1 = self.compression is not None
             while 1:
                 try:
                     some_bytes = yield next(frame.parser)
@@ -236,6 +246,35 @@ class Stream(object):
                             # string to a bytearray.
                             some_bytes = bytearray(some_bytes)
 
+                    # decompress data frames (rfc7692)
+                    # rsv1 is only set on the first frame of a message
+                    if frame.opcode in (OPCODE_TEXT, OPCODE_BINARY):
+                        compressed = frame.rsv1 == 1
+                    elif frame.opcode == OPCODE_CONTINUATION and frame.rsv1:
+                        msg = CloseControlMessage(
+                            code=1002, reason="RSV1 set on a continuation frame"
+                        )
+                        self.errors.append(msg)
+                        break
+
+                    if compressed and frame.opcode <= OPCODE_BINARY:
+                        try:
+                            some_bytes = self.compression.decompress(
+                                some_bytes, last=frame.fin == 1
+                            )
+                        except zlib.error:
+                            msg = CloseControlMessage(
+                                code=1002, reason="Invalid compressed data"
+                            )
+                            self.errors.append(msg)
+                            break
+                        except MessageTooBigException:
+                            msg = CloseControlMessage(
+                                code=1009, reason="Message too big"
+                            )
+                            self.errors.append(msg)
+                            break
+
                     if frame.opcode == OPCODE_TEXT:
                         if self.message and not self.message.completed:
                             # We got a text frame before we completed the previous one
@@ -487,17 +487,49 @@ class Utf8Validator(object):
         index within the total consumed sequence that was the point of bail out.
         When valid? == True, currentIndex will be len(ba) and totalIndex the
         total amount of consumed bytes.
+
+        Whole code point runs are checked with the C-level decoder,
+        the DFA only runs over a code point split by the previous chunk
+        and from the first invalid (or incomplete) sequence onwards.
         """
+        if not isinstance(ba, (bytes, bytearray)):
+            ba = bytes(ba)
+
         state = self.state
         DFA = Utf8Validator.UTF8VALIDATOR_DFA
-        i = 0  # make sure 'i' is set if when 'ba' is empty
-        for i, b in enumerate(ba):
+        length = len(ba)
+
+        # finish the code point started in the previous chunk
+        start = 0
+        while start < length and state != Utf8Validator.UTF8_ACCEPT:
+            state = DFA[256 + (state << 4) + DFA[ba[start]]]
+            if state == Utf8Validator.UTF8_REJECT:
+                self.i += start
+                self.state = state
+                return False, False, start, self.i
+            start += 1
+
+        if state == Utf8Validator.UTF8_ACCEPT and start < length:
+            chunk = ba[start:] if start else ba
+            if chunk.isascii():
+                start = length
+            else:
+                try:
+                    chunk.decode("utf-8")
+                    start = length
+                except UnicodeDecodeError as e:
+                    # everything before e.start is valid
+                    start += e.start
+
+        for i in range(start, length):
             ## optimized version of decode(), since we are not interested in actual code points
-            state = DFA[256 + (state << 4) + DFA[b]]
+            state = DFA[256 + (state << 4) + DFA[ba[i]]]
             if state == Utf8Validator.UTF8_REJECT:
                 self.i += i
                 self.state = state
                 return False, False, i, self.i
+
+        i = max(length - 1, 0)  # same as the index of the last byte consumed
         self.i += i
         self.state = state
         return True, state == Utf8Validator.UTF8_ACCEPT, i, self.i
@@ -105,7 +105,8 @@ class WebSocket(object):
         self.extensions = extensions
         """
         List of extensions supported by this endpoint.
-        Unused for now.
+        Only ``permessage-deflate`` is implemented, see
+        :class:`ws4py.compression.PerMessageDeflate`.
         """
 
         self.sock = sock
@@ -308,13 +309,15 @@ class WebSocket(object):
         message_sender = (
             self.stream.binary_message if binary else self.stream.text_message
         )
+        mask = self.stream.always_mask
+        compression = self.stream.compression
 
         if isinstance(payload, basestring) or isinstance(payload, bytearray):
-            m = message_sender(payload).single(mask=self.stream.always_mask)
+            m = message_sender(payload).single(mask=mask, compression=compression)
             self._write(m)
 
         elif isinstance(payload, Message):
-            data = payload.single(mask=self.stream.always_mask)
+            data = payload.single(mask=mask, compression=compression)
             self._write(data)
 
         elif type(payload) == types.GeneratorType:
@@ -323,7 +326,7 @@ class WebSocket(object):
             for chunk in payload:
                 self._write(
                     message_sender(bytes).fragment(
-                        first=first, mask=self.stream.always_mask
+                        first=first, mask=mask, compression=compression
                     )
                 )
                 bytes = chunk
@@ -331,7 +334,7 @@ class WebSocket(object):
 
             self._write(
                 message_sender(bytes).fragment(
-                    first=first, last=True, mask=self.stream.always_mask
+                    first=first, last=True, mask=mask, compression=compression
                 )
             )
 
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+import os, sys, time
+import json
+import tempfile
+
+cd = os.path.dirname(__file__)
+sys.path.append(os.path.join(cd, "../"))
+
+import fff_dqmtools
+import applets.fff_web as fff_web
+
+import gevent
+
+
+def make_doc(host, i):
+    return {
+        "_id": "dqm-stats-%s-%d" % (host, i % 50),
+        "type": "dqm-stats",
+        "hostname": host,
+        "tag": "benchmark",
+        "run": 300000 + i // 100,
+        "timestamp": time.time(),
+        "extra": {"payload": "x" * 2048, "sequence": i},
+    }
+
+
+def bench_uploads(db, n_uploads, n_readers, batch_size=20):
+    """
+    Replays n_uploads uploads while n_readers keep syncing,
+    half of them full syncs (served from the header index), the other half
+    document reads (the database itself, ie. the read pool in WAL mode).
+    """
+    latencies = []
+    read_latencies = []
+    reads = [0]
+    stalls = []
+    running = [True]
+
+    def uploader(k):
+        for i in range(k, n_uploads, 4):
+            docs = [
+                make_doc("host%02d" % k, i * batch_size + j) for j in range(batch_size)
+            ]
+            t = time.time()
+            db.direct_transactional_upload(docs)
+            latencies.append(time.time() - t)
+            gevent.sleep(0)
+
+    def ticker():
+        # how long the event loop (ie. websockets) is blocked
+        while running[0]:
+            t = time.time()
+            gevent.sleep(0.001)
+            stalls.append(time.time() - t)
+
+    def reader():
+        while running[0]:
+            db.get_headers(from_rev=None)
+            reads[0] += 1
+            gevent.sleep(0)
+
+    def document_reader(k):
+        i = 0
+        while running[0]:
+            # the ids written by the uploaders (see make_doc)
+            ids = ["dqm-stats-host%02d-%d" % ((i + j) % 4, j) for j in range(50)]
+            i += 1
+
+            t = time.time()
+            db.get_documents(ids)
+            db.get_stored_document(ids[k % len(ids)])
+            read_latencies.append(time.time() - t)
+            gevent.sleep(0)
+
+    readers = [gevent.spawn(reader) for x in range(n_readers - n_readers // 2)]
+    readers += [gevent.spawn(document_reader, x) for x in range(n_readers // 2)]
+    readers.append(gevent.spawn(ticker))
+    t = time.time()
+    gevent.joinall([gevent.spawn(uploader, k) for k in range(4)], raise_error=True)
+    elapsed = time.time() - t
+    running[0] = False
+    gevent.joinall(readers)
+
+    latencies.sort()
+    read_latencies.sort()
+    r = {
+        "elapsed": elapsed,
+        "uploads/s": n_uploads / elapsed,
+        "latency_p50": latencies[len(latencies) // 2],
+        "latency_p99": latencies[int(len(latencies) * 0.99)],
+        "full_syncs": reads[0],
+        "max_loop_stall": max(stalls),
+    }
+
+    if read_latencies:
+        r["document_reads"] = len(read_latencies)
+        r["read_latency_p50"] = read_latencies[len(read_latencies) // 2]
+        r["read_latency_p99"] = read_latencies[int(len(read_latencies) * 0.99)]
+
+    return r
+
+
+def bench_full_sync(db, n_headers, repeat=5):
+    """CPU time of a full sync (known_rev=None), uncached vs cached frames."""
+    batch = []
+    for i in range(n_headers):
+        doc = make_doc("host%02d" % (i % 40), i)
+        doc["_id"] = "dqm-bench-%d" % i
+        doc["extra"] = {}
+        batch.append(doc)
+
+        if len(batch) == 1000:
+            db.direct_transactional_upload(batch)
+            batch = []
+    db.direct_transactional_upload(batch)
+
+    class Sink(fff_web.SyncSocket):
+        def __init__(self):
+            self.sent = 0
+
+        def send(self, msg, binary=False):
+            self.sent += len(msg)
+
+        @property
+        def peer_address(self):
+            return "benchmark"
+
+    fff_web.SyncSocket.db = db
+    fff_web.log.setLevel("WARNING")
+    request = json.dumps({"event": "sync_request", "known_rev": None})
+
+    class Message(object):
+        data = request
+
+    def uncached():
+        s = Sink()
+        s.sendHeaders(db.get_headers(from_rev=None))
+        return s.sent
+
+    def cached():
+        s = Sink()
+        s.opened()
+        s.received_message(Message())
+        s.closed(1000, output_log=False)
+        return s.sent
+
+    r = {}
+    for name, f in [("uncached", uncached), ("cached", cached)]:
+        cpu = []
+        for x in range(repeat):
+            t = time.process_time()
+            size = f()
+            cpu.append(time.process_time() - t)
+
+        r[name] = {"cpu_min": min(cpu), "cpu_first": cpu[0], "bytes": size}
+
+    return r
+
+
+def make_header_rows(n_headers, now):
+    for i in range(n_headers):
+        yield (
+            "dqm-bench-%d" % i,
+            i + 1,
+            now - n_headers + i,
+            "host%02d" % (i % 40),
+            ["dqm-stats", "dqm-files", "dqm-diskspace"][i % 3],
+            "benchmark",
+            300000 + i // 1000,
+        )
+
+
+# the Headers indexes for the lookups by field, see Database.migrate_indexes()
+INDEX_VARIANTS = {
+    "none": None,
+    "field_rev": lambda column: [column, "rev"],
+    "covering": lambda column: [column]
+    + [
+        c
+        for c in ("rev", "id", "timestamp") + fff_web.HeaderFilter.FIELDS
+        if c != column
+    ],
+}
+
+
+def bench_run_lookups(path, variant, n_headers, n_lookups=200, batch_size=1000):
+    """
+    Per-run header lookups with one of the INDEX_VARIANTS, and what the
+    indexes cost: the time to insert the headers (in upload sized
+    transactions) and the size of the database.
+    """
+    db = fff_web.Database(db=path)
+
+    with db.conn as conn:
+        for column in fff_web.HeaderFilter.FIELDS:
+            conn.execute("DROP INDEX M_%s_rev_index" % column)
+
+            columns = INDEX_VARIANTS[variant]
+            if columns is not None:
+                conn.execute(
+                    "CREATE INDEX M_%s_rev_index ON Headers (%s)"
+                    % (column, ", ".join(columns(column)))
+                )
+
+    rows = list(make_header_rows(n_headers, time.time()))
+    t = time.time()
+    for i in range(0, len(rows), batch_size):
+        with db.conn as conn:
+            conn.executemany(
+                "INSERT INTO Headers (id, rev, timestamp, hostname, type, tag, run) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows[i : i + batch_size],
+            )
+    insert = time.time() - t
+    del rows
+
+    runs = [300000 + (i * 7919) % (n_headers // 1000 or 1) for i in range(n_lookups)]
+
+    t = time.time()
+    found = 0
+    for run in runs:
+        found += len(db.get_filtered_headers(fff_web.HeaderFilter(run=run)))
+
+    return {
+        "lookup": (time.time() - t) / n_lookups,
+        "headers_per_run": found // n_lookups,
+        "insert_per_1k": insert / (n_headers / 1000.0),
+        "db_bytes": db.get_size(),
+        "plan": db.check_query_plans()["run"]["plan"],
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ["upload", "sync", "runs"]:
+        print("Usage: %s upload <n_uploads> <n_readers>" % sys.argv[0])
+        print("or")
+        print("Usage: %s sync|runs <n_headers>" % sys.argv[0])
+        sys.exit(1)
+
+    if sys.argv[1] == "runs":
+        n_headers = int(sys.argv[2])
+
+        for variant in sorted(INDEX_VARIANTS):
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "db.sqlite3")
+                r = bench_run_lookups(path, variant, n_headers)
+                print("%s: %s" % (variant, json.dumps(r, sort_keys=True)))
+
+        sys.exit(0)
+
+    if sys.argv[1] == "sync":
+        n_headers = int(sys.argv[2])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db = fff_web.Database(db=os.path.join(tmp, "db.sqlite3"))
+            r = bench_full_sync(db, n_headers)
+            print("full sync: %s" % json.dumps(r, sort_keys=True))
+
+        sys.exit(0)
+
+    n_uploads = int(sys.argv[2])
+    n_readers = int(sys.argv[3])
+
+    for wal in [False, True]:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = fff_web.Database(db=os.path.join(tmp, "db.sqlite3"), wal=wal)
+            r = bench_uploads(db, n_uploads, n_readers)
+            print("wal=%s: %s" % (wal, json.dumps(r, sort_keys=True)))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import os, sys, time
+
+cd = os.path.dirname(__file__)
+sys.path.append(os.path.join(cd, "../"))
+
+import fff_dqmtools
+import ws4py.framing as framing
+from ws4py.utf8validator import Utf8Validator
+
+
+def reference_mask(key, data):
+    # the original byte-by-byte implementation
+    masked = bytearray(data)
+    for i in range(len(data)):
+        masked[i] = masked[i] ^ key[i % 4]
+    return masked
+
+
+def timeit(f, min_time=0.2):
+    n, start = 0, time.perf_counter()
+    while True:
+        f()
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / n
+
+
+def reference_validate(ba):
+    # the original per-byte DFA walk
+    v = Utf8Validator()
+    DFA = v.UTF8VALIDATOR_DFA
+    state = v.state
+    for b in ba:
+        state = DFA[256 + (state << 4) + DFA[b]]
+        if state == v.UTF8_REJECT:
+            return False
+    return state == v.UTF8_ACCEPT
+
+
+def bench_utf8(sizes):
+    sample = '{"_id": "dqm-stats-dqmfu", "tag": "héllo wörld", "value": 1}, '
+    for size in sizes:
+        text = (sample * (size // len(sample) + 1)).encode("utf-8")[:size]
+
+        # split in the middle of a code point, like a fragmented frame would
+        cut = text.index("ö".encode("utf-8")) + 1
+        chunks = [text[:cut], text[cut:]]
+
+        def validate():
+            v = Utf8Validator()
+            for chunk in chunks:
+                r = v.validate(chunk)
+            return r
+
+        assert validate()[0] == reference_validate(text)
+
+        t_ref = timeit(lambda: reference_validate(text))
+        t_new = timeit(validate)
+
+        print(
+            "utf8 %9d bytes: dfa %10.3f ms, fast %8.3f ms (%6.1fx)"
+            % (size, t_ref * 1e3, t_new * 1e3, t_ref / t_new)
+        )
+
+
+def bench_mask(sizes):
+    for size in sizes:
+        data = os.urandom(size)
+        frame = framing.Frame(masking_key=os.urandom(4))
+        key = frame.masking_key
+
+        assert frame.mask(data) == reference_mask(key, data)
+        assert frame.unmask(frame.mask(data)) == data
+
+        t_ref = timeit(lambda: reference_mask(key, data))
+        t_int = timeit(lambda: frame.mask(data))
+
+        line = "mask %9d bytes: loop %10.3f ms, fast %8.3f ms (%6.1fx)" % (
+            size,
+            t_ref * 1e3,
+            t_int * 1e3,
+            t_ref / t_int,
+        )
+
+        if framing.numpy is not None:
+            # force the integer path
+            numpy, framing.numpy = framing.numpy, None
+            t_nonp = timeit(lambda: frame.mask(data))
+            framing.numpy = numpy
+
+            line += ", without numpy %8.3f ms" % (t_nonp * 1e3)
+
+        print(line)
+
+
+if __name__ == "__main__":
+    sizes = [1024 * 4**i for i in range(8)]  # 1 KB - 16 MB
+    if len(sys.argv) > 1:
+        sizes = [int(x) for x in sys.argv[1:]]
+
+    bench_mask(sizes)
+    bench_utf8(sizes)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import os, sys, time
+import tempfile
+
+cd = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(cd, "../"))
+
+# the ssh calls of fff_cluster against utils/fake_ssh.py
+os.environ["FFF_SSH"] = os.path.join(cd, "fake_ssh.py")
+os.environ["FAKE_SSH_STATE"] = tempfile.mkdtemp(prefix="fake_ssh.")
+os.environ["FAKE_SSH_DELAY"] = "0.5"
+
+import fff_cluster
+
+# the fake masters stay around (holding their fds) this long
+fff_cluster.SSH_PERSIST = 10
+
+
+def read_handshakes():
+    try:
+        with open(os.path.join(os.environ["FAKE_SSH_STATE"], "handshakes")) as f:
+            return [l.split() for l in f.readlines()]
+    except OSError:
+        return []
+
+
+def handshakes():
+    return len(read_handshakes())
+
+
+def max_overlap(since):
+    # the most handshakes in progress at the same time
+    events = []
+    for host, start, end in read_handshakes()[since:]:
+        events.append((float(start), 1))
+        events.append((float(end), -1))
+
+    n, m = 0, 0
+    for t, d in sorted(events):
+        n += d
+        m = max(m, n)
+    return m
+
+
+def check(name, ok, result=None):
+    print("%-6s %-55s %s" % ("ok" if ok else "FAILED", name, result or ""))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    failed = 0
+
+    # a background master must not hold the first command's output
+    r = fff_cluster.ssh_run("node1", "echo hello; echo oops >&2; exit 3", timeout=5)
+    failed += check(
+        "first command (new master)",
+        r.returncode == 3 and r.stdout == "hello\n" and r.stderr == "oops\n",
+        "%.2fs" % r.elapsed,
+    )
+
+    r = fff_cluster.ssh_run("node1", "echo again", timeout=5)
+    failed += check(
+        "second command (reused master)",
+        r.stdout == "again\n" and r.elapsed < 0.4,
+        "%.2fs" % r.elapsed,
+    )
+
+    # the cache is not trusted forever, the master is checked again
+    fff_cluster._ssh_masters.clear()
+    r = fff_cluster.ssh_run("node1", "echo checked", timeout=5)
+    failed += check(
+        "command after the master check",
+        r.stdout == "checked\n" and handshakes() == 1,
+        "%.2fs" % r.elapsed,
+    )
+
+    hosts = ["node%d" % i for i in range(2, 9)]
+    before = handshakes()
+    start = time.time()
+    results = fff_cluster.ssh_run_all([(h, "hostname") for h in hosts * 3], timeout=5)
+    elapsed = time.time() - start
+    failed += check(
+        "21 commands to 7 new hosts in parallel",
+        all(r.returncode == 0 and r.stdout for r in results)
+        and handshakes() - before == len(hosts)
+        and max_overlap(before) > 1,
+        "%.2fs, %d handshakes, at most %d at once"
+        % (elapsed, handshakes() - before, max_overlap(before)),
+    )
+
+    r = fff_cluster.ssh_run("dead1", "hostname", timeout=15)
+    failed += check(
+        "unreachable host",
+        r.returncode == 255 and "timed out" in r.stderr and r.elapsed < 7,
+        "%.2fs: %s" % (r.elapsed, r.stderr.strip()),
+    )
+
+    r = fff_cluster.ssh_run("dead2", "hostname", timeout=2)
+    failed += check(
+        "unreachable host, shorter timeout",
+        r.returncode == -1 and r.elapsed < 3,
+        "%.2fs: %s" % (r.elapsed, r.stderr.strip()),
+    )
+
+    print("%s" % ("All checks passed." if not failed else "%d failed." % failed))
+    sys.exit(1 if failed else 0)
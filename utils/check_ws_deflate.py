@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import os, sys
+import json
+import queue
+import threading
+
+cd = os.path.dirname(__file__)
+sys.path.append(os.path.join(cd, "../"))
+
+import fff_dqmtools
+
+import gevent
+from ws4py.websocket import WebSocket
+from ws4py.messaging import TextMessage, BinaryMessage, PingControlMessage
+from ws4py.compression import PerMessageDeflate
+from ws4py.client.threadedclient import WebSocketClient
+from ws4py.server.geventserver import WSGIServer
+from ws4py.server.wsgiutils import WebSocketWSGIApplication
+
+# round trip check of permessage-deflate between our server
+# (the same setup as fff_web /sync) and the bundled threaded client
+
+
+class EchoServer(WebSocket):
+    def received_message(self, message):
+        data = message.data
+
+        if message.is_text and data.startswith(b"fragments:"):
+            # answer with a fragmented message
+            n = int(data.split(b":")[1])
+            self.send(make_payload(i, 4096) for i in range(n))
+            return
+
+        if message.is_text and data == b"negotiated":
+            c = self.stream.compression
+            self.send(json.dumps(describe(c)))
+            return
+
+        self.send(data, message.is_binary)
+
+
+class CheckClient(WebSocketClient):
+    def __init__(self, url, **kwargs):
+        WebSocketClient.__init__(self, url, **kwargs)
+        self.messages = queue.Queue()
+        self.pongs = queue.Queue()
+        self.close_codes = queue.Queue()
+        self.wire_bytes = 0
+
+    def process(self, bytes):
+        self.wire_bytes += len(bytes)
+        return WebSocketClient.process(self, bytes)
+
+    def received_message(self, message):
+        self.messages.put((message.is_binary, bytes(message.data)))
+
+    def ponged(self, pong):
+        self.pongs.put(bytes(pong.data))
+
+    def closed(self, code, reason=None):
+        self.close_codes.put(code)
+
+    def receive(self, timeout=5):
+        return self.messages.get(timeout=timeout)
+
+
+def describe(c):
+    if c is None:
+        return None
+
+    return {
+        "server_no_context_takeover": c.server_no_context_takeover,
+        "client_no_context_takeover": c.client_no_context_takeover,
+        "server_max_window_bits": c.server_max_window_bits,
+        "client_max_window_bits": c.client_max_window_bits,
+    }
+
+
+def make_payload(i, size):
+    # compressible, but different for every message
+    line = '{"_id": "dqm-stats-%d", "_rev": %d, "type": "dqm-stats"}, ' % (i, i * 7)
+    return (line * (size // len(line) + 1))[:size].encode("utf-8")
+
+
+def check_roundtrip(url, offer):
+    ws = CheckClient(url, extensions=[offer] if offer else None)
+    ws.connect()
+
+    try:
+        # both ends have to agree on the parameters
+        ws.send("negotiated")
+        _, server_side = ws.receive()
+        server_side = json.loads(server_side.decode("utf-8"))
+        client_side = describe(ws.stream.compression)
+        assert server_side == client_side, (server_side, client_side)
+
+        # repeated messages exercise the context takeover (or its reset)
+        for i, size in enumerate([10, 100, 4096, 4096, 65536, 1 << 20, 100, 4096]):
+            data = make_payload(i, size)
+            ws.send(data.decode("utf-8"))
+            assert ws.receive() == (False, data), "text message %d" % i
+
+            ws.send(os.urandom(size), binary=True)
+            is_binary, echo = ws.receive()
+            assert is_binary and len(echo) == size, "binary message %d" % i
+
+        # the echo of a compressible message has to be smaller on the wire
+        data = make_payload(0, 1 << 20)
+        before = ws.wire_bytes
+        ws.send(data.decode("utf-8"))
+        assert ws.receive() == (False, data), "large message"
+        wire = ws.wire_bytes - before
+        if client_side is not None:
+            assert wire < len(data) // 10, "not compressed: %d bytes" % wire
+
+        # fragmented message, both directions
+        chunks = [make_payload(100 + i, 4096) for i in range(5)]
+        ws.send(c.decode("utf-8") for c in chunks)
+        assert ws.receive() == (False, b"".join(chunks)), "fragmented echo"
+
+        ws.send("fragments:5")
+        expected = b"".join([make_payload(i, 4096) for i in range(5)])
+        assert ws.receive() == (False, expected), "fragmented reply"
+
+        # control frames are never compressed,
+        # a ping in the middle of a fragmented message
+        compression = ws.stream.compression
+        ws._write(
+            TextMessage(chunks[0]).fragment(
+                first=True, mask=True, compression=compression
+            )
+        )
+        ws._write(PingControlMessage(b"in-between").single(mask=True))
+        ws._write(
+            TextMessage(chunks[1]).fragment(
+                last=True, mask=True, compression=compression
+            )
+        )
+        assert ws.pongs.get(timeout=5) == b"in-between", "pong"
+        assert ws.receive() == (False, chunks[0] + chunks[1]), "interleaved ping"
+
+        ws.ping("plain")
+        assert ws.pongs.get(timeout=5) == b"plain", "pong"
+
+        return client_side
+    finally:
+        ws.close()
+        ws.run_forever()
+
+
+def check_bomb(url):
+    # a message inflating past max_message_size closes the connection
+    ws = CheckClient(url, extensions=[PerMessageDeflate.offer()])
+    ws.connect()
+
+    try:
+        data = b"\0" * (MAX_MESSAGE_SIZE * 16)
+        frame = BinaryMessage(data).single(mask=True, compression=ws.stream.compression)
+        assert len(frame) < MAX_MESSAGE_SIZE // 10, "bomb: %d bytes" % len(frame)
+
+        ws._write(frame)
+        code = ws.close_codes.get(timeout=5)
+        assert code == 1009, "closed with %r" % code
+        assert ws.messages.empty(), "bomb delivered"
+    finally:
+        ws.close()
+        ws.run_forever()
+
+
+def run_checks(port):
+    failed = 0
+    cases = [
+        ({}, None),
+        ({}, "permessage-deflate"),
+        ({}, PerMessageDeflate.offer()),
+        ({}, PerMessageDeflate.offer(client_no_context_takeover=True)),
+        ({"server_no_context_takeover": True}, PerMessageDeflate.offer()),
+        (
+            {"server_no_context_takeover": True},
+            PerMessageDeflate.offer(client_no_context_takeover=True),
+        ),
+        ({}, "permessage-deflate; server_no_context_takeover"),
+        ({}, "permessage-deflate; server_max_window_bits=10"),
+        ({}, "permessage-deflate; server_max_window_bits=9; client_max_window_bits"),
+        ({"client_max_window_bits": 11}, "permessage-deflate; client_max_window_bits"),
+        (
+            {"server_max_window_bits": 12},
+            "permessage-deflate; client_max_window_bits=9",
+        ),
+        # unusable offer first, the server has to pick the second one
+        ({}, "permessage-deflate; server_max_window_bits=8, permessage-deflate"),
+        ({}, "permessage-deflate; unknown_parameter, x-webkit-deflate-frame"),
+    ]
+
+    for i, (server_options, offer) in enumerate(cases):
+        url = "ws://127.0.0.1:%d/%d" % (port, i)
+        apps[i] = make_app(server_options)
+
+        try:
+            negotiated = check_roundtrip(url, offer)
+            print("ok     %-40s %-75s -> %s" % (server_options, offer, negotiated))
+        except Exception as e:
+            failed += 1
+            print("FAILED %-40s %-75s: %r" % (server_options, offer, e))
+
+    url = "ws://127.0.0.1:%d/%d" % (port, len(cases))
+    apps[len(cases)] = make_app({})
+
+    try:
+        check_bomb(url)
+        print("ok     %-40s" % "deflate bomb")
+    except Exception as e:
+        failed += 1
+        print("FAILED %-40s: %r" % ("deflate bomb", e))
+
+    return failed
+
+
+# fits the largest message of check_roundtrip()
+MAX_MESSAGE_SIZE = 2 * 1024 * 1024
+
+
+def make_app(server_options):
+    return WebSocketWSGIApplication(
+        extensions=["permessage-deflate"],
+        handler_cls=EchoServer,
+        deflate_options=dict(
+            server_options, min_size=64, max_message_size=MAX_MESSAGE_SIZE
+        ),
+    )
+
+
+# one websocket application per check, selected by the url
+apps = {}
+
+
+def dispatch(environ, start_response):
+    i = int(environ["PATH_INFO"].strip("/"))
+    return apps[i](environ, start_response)
+
+
+if __name__ == "__main__":
+    server = WSGIServer(("127.0.0.1", 0), dispatch, log=None)
+    server.start()
+
+    # the client blocks, so it has its own thread
+    result = []
+    t = threading.Thread(target=lambda: result.append(run_checks(server.server_port)))
+    t.daemon = True
+    t.start()
+
+    while t.is_alive():
+        gevent.sleep(0.05)
+
+    server.stop()
+
+    failed = result[0] if result else 1
+    print("%s" % ("All checks passed." if not failed else "%d failed." % failed))
+    sys.exit(1 if failed else 0)
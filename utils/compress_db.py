@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import os, sys, time
+import json
+
+cd = os.path.dirname(__file__)
+sys.path.append(os.path.join(cd, "../"))
+
+import fff_dqmtools
+import applets.fff_web as fff_web
+
+# types with less documents are not worth a dictionary
+MIN_SAMPLES = 16
+
+
+def train(db, n_samples=64):
+    """Trains a new dictionary for every document type (from the newest docs)."""
+
+    def read_types(conn):
+        c = conn.cursor()
+        c.execute(
+            "SELECT type, COUNT(*) FROM Headers WHERE type IS NOT NULL GROUP BY type"
+        )
+        r = c.fetchall()
+        c.close()
+        return r
+
+    def read_samples(conn, type):
+        c = conn.cursor()
+        c.execute(
+            "SELECT d.body, d.dict_version FROM Headers h JOIN Documents d ON d.id = h.id WHERE h.type = ? ORDER BY h.rev DESC LIMIT ?",
+            (type, n_samples),
+        )
+        rows = c.fetchall()
+        c.close()
+
+        rows.reverse()
+        return [db.codec.decompress(conn, body, version) for body, version in rows]
+
+    trained = {}
+    for type, count in db.execute_read(read_types):
+        if count < MIN_SAMPLES:
+            continue
+
+        samples = db.execute_read(read_samples, type)
+        zdict = fff_web.DocumentCodec.train(samples)
+        version = db.execute_write(db.codec.add_dictionary, type, zdict)
+
+        trained[type] = {"version": version, "size": len(zdict)}
+        print("Trained dictionary for %s: %s" % (type, json.dumps(trained[type])))
+
+    return trained
+
+
+def migrate(db, batch_size=500, delay=0.05):
+    """
+    Recompresses all the documents not using the latest dictionary
+    of their type. Every batch is a separate (short) transaction,
+    so this can run next to a live fff_web.
+    """
+    stats = {"rows": 0, "changed": 0, "bytes_before": 0, "bytes_after": 0}
+    codec = db.codec
+
+    def recompress(conn, after):
+        c = conn.cursor()
+        c.execute(
+            "SELECT d.rowid, d.rev, d.body, d.dict_version, h.type FROM Documents d LEFT JOIN Headers h ON h.id = d.id WHERE d.rowid > ? ORDER BY d.rowid ASC LIMIT ?",
+            (after, batch_size),
+        )
+        rows = c.fetchall()
+
+        last = None
+        for rowid, rev, body, version, type in rows:
+            last = rowid
+            stats["rows"] += 1
+
+            if version == codec.current.get(type, None):
+                continue
+
+            plain = codec.decompress(conn, body, version)
+            new_body, new_version = codec.compress(plain, type=type)
+
+            # the document could have been replaced in the meantime
+            c.execute(
+                "UPDATE Documents SET body = ?, dict_version = ? WHERE rowid = ? AND rev = ?",
+                (new_body, new_version, rowid, rev),
+            )
+
+            stats["changed"] += 1
+            stats["bytes_before"] += len(body)
+            stats["bytes_after"] += len(new_body)
+
+        c.close()
+        return last
+
+    last = 0
+    while last is not None:
+        last = db.execute_write(recompress, last)
+        time.sleep(delay)
+
+    return stats
+
+
+def show_stats(db):
+    def read(conn):
+        c = conn.cursor()
+        c.execute(
+            "SELECT h.type, d.dict_version, COUNT(*), SUM(LENGTH(d.body)) FROM Documents d LEFT JOIN Headers h ON h.id = d.id GROUP BY h.type, d.dict_version ORDER BY h.type"
+        )
+        r = c.fetchall()
+        c.close()
+        return r
+
+    for type, version, count, size in db.execute_read(read):
+        print(
+            "%-20s dict_version=%-6s docs=%-8d bytes=%-10d avg=%d"
+            % (type, version, count, size or 0, (size or 0) // count)
+        )
+
+    print("Database size: %d" % db.get_size())
+
+
+if __name__ == "__main__":
+    commands = ["train", "migrate", "stats", "vacuum"]
+    if len(sys.argv) < 3 or sys.argv[1] not in commands:
+        print("Usage: %s train <database_file> [n_samples]" % sys.argv[0])
+        print("or")
+        print("Usage: %s migrate <database_file> [batch_size]" % sys.argv[0])
+        print("or")
+        print("Usage: %s stats|vacuum <database_file>" % sys.argv[0])
+        sys.exit(1)
+
+    cmd, path = sys.argv[1], sys.argv[2]
+    db = fff_web.Database(db=path, zdict=True)
+
+    if cmd == "train":
+        train(db, *map(int, sys.argv[3:4]))
+    elif cmd == "migrate":
+        stats = migrate(db, *map(int, sys.argv[3:4]))
+        print("Migrated: %s" % json.dumps(stats, sort_keys=True))
+        print("Run '%s vacuum' to shrink the file." % sys.argv[0])
+    elif cmd == "vacuum":
+        # also converts older databases, so the retention can shrink them
+        db.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.conn.execute("VACUUM")
+
+    show_stats(db)
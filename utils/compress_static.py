@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import os, sys
+import gzip
+import json
+
+# the rest (images, woff) is already compressed
+EXTENSIONS = [".js", ".css", ".html", ".map", ".svg", ".eot", ".ttf", ".json", ".txt"]
+MIN_SIZE = 1024
+
+
+def compress_file(fn):
+    """Writes fn.gz (if it's worth it), returns the saved bytes."""
+    with open(fn, "rb") as f:
+        body = f.read()
+
+    # mtime=0: the same input gives the same file (and rpm)
+    zbody = gzip.compress(body, compresslevel=9, mtime=0)
+    if len(zbody) >= len(body) * 0.9:
+        if os.path.exists(fn + ".gz"):
+            os.unlink(fn + ".gz")
+        return 0
+
+    tmp = fn + ".gz.tmp"
+    with open(tmp, "wb") as f:
+        f.write(zbody)
+
+    # fff_web only uses the .gz if it is not older than the original
+    st = os.stat(fn)
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.rename(tmp, fn + ".gz")
+
+    return len(body) - len(zbody)
+
+
+def compress_tree(root):
+    stats = {"files": 0, "compressed": 0, "saved_bytes": 0}
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in sorted(filenames):
+            fn = os.path.join(dirpath, name)
+            if os.path.splitext(name)[1] not in EXTENSIONS:
+                continue
+            if os.path.getsize(fn) < MIN_SIZE:
+                continue
+
+            stats["files"] += 1
+            saved = compress_file(fn)
+            if saved:
+                stats["compressed"] += 1
+                stats["saved_bytes"] += saved
+
+    return stats
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: %s <web.static directory>" % sys.argv[0])
+        sys.exit(1)
+
+    stats = compress_tree(sys.argv[1])
+    print("Precompressed: %s" % json.dumps(stats, sort_keys=True))
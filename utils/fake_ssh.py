@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import os, sys, time
+import subprocess
+
+# A stand-in for ssh (see FFF_SSH in fff_cluster.py), it runs the commands
+# locally. Every new connection takes FAKE_SSH_DELAY seconds, unless
+# a master connection is running, hosts named "dead*" never answer.
+#
+# Like older OpenSSH versions, the forked master connection keeps
+# the stdout and stderr it inherited open in the background.
+#
+# The masters and a log of the handshakes are kept in FAKE_SSH_STATE.
+
+STATE = os.environ.get("FAKE_SSH_STATE", "/tmp/fake_ssh")
+DELAY = float(os.environ.get("FAKE_SSH_DELAY", "0.5"))
+
+# the options followed by an argument
+WITH_ARGUMENT = "bcDEeFIiJLlmOopQRSWw"
+
+
+def parse(args):
+    flags, options, rest = set(), {}, []
+
+    i = 0
+    while i < len(args) and args[i].startswith("-"):
+        arg = args[i][1:]
+        i += 1
+
+        for j, c in enumerate(arg):
+            if c not in WITH_ARGUMENT:
+                flags.add(c)
+                continue
+
+            value = arg[j + 1 :]
+            if not value:
+                value = args[i]
+                i += 1
+
+            if c == "o":
+                k, _, v = value.partition("=")
+                options[k.lower()] = v
+            else:
+                options["-" + c] = value
+            break
+
+    return flags, options, args[i], args[i + 1 :]
+
+
+def master_file(host):
+    return os.path.join(STATE, "%s.master" % host)
+
+
+def master_alive(host):
+    try:
+        with open(master_file(host)) as f:
+            return float(f.read()) > time.time()
+    except (OSError, ValueError):
+        return False
+
+
+def connect(host, options):
+    if host.startswith("dead"):
+        time.sleep(float(options.get("connecttimeout", "5")))
+        sys.stderr.write(
+            "ssh: connect to host %s port 22: Connection timed out\n" % host
+        )
+        sys.exit(255)
+
+    start = time.time()
+    time.sleep(DELAY)
+    with open(os.path.join(STATE, "handshakes"), "a") as f:
+        f.write("%s %f %f\n" % (host, start, time.time()))
+
+
+def start_master(host, persist):
+    with open(master_file(host), "w") as f:
+        f.write("%f" % (time.time() + persist))
+
+    if os.fork() == 0:
+        # the background master, stdout and stderr are left open
+        os.setsid()
+        time.sleep(persist)
+        os._exit(0)
+
+
+if __name__ == "__main__":
+    os.makedirs(STATE, exist_ok=True)
+    flags, options, host, command = parse(sys.argv[1:])
+    persist = float(options.get("controlpersist", "0") or "0")
+
+    if options.get("-O") == "check":
+        sys.exit(0 if master_alive(host) else 255)
+
+    if "M" in flags:
+        if not master_alive(host):
+            connect(host, options)
+            start_master(host, persist)
+
+        sys.exit(0)
+
+    if not master_alive(host):
+        connect(host, options)
+
+        if options.get("controlmaster") == "auto" and persist:
+            start_master(host, persist)
+
+    if "N" in flags:
+        sys.exit(0)
+
+    sys.stdout.flush()
+    sys.exit(subprocess.call(["sh", "-c", " ".join(command)]))
@@ -55,6 +55,7 @@ install -m 644 $SCRIPTDIR/applets/*.py -t \$RPM_BUILD_ROOT/opt/fff_dqmtools/appl
 cp -r $SCRIPTDIR/misc -t \$RPM_BUILD_ROOT/opt/fff_dqmtools/
 cp -r $SCRIPTDIR/utils -t \$RPM_BUILD_ROOT/opt/fff_dqmtools/
 cp -r $SCRIPTDIR/web.static -t \$RPM_BUILD_ROOT/opt/fff_dqmtools/
+python3 $SCRIPTDIR/utils/compress_static.py \$RPM_BUILD_ROOT/opt/fff_dqmtools/web.static
 cp -r $SCRIPTDIR/lib/ws4py -t \$RPM_BUILD_ROOT/opt/fff_dqmtools/lib/
 
 install -m 755 $SCRIPTDIR/misc/fff_dqmtools -t \$RPM_BUILD_ROOT/etc/init.d/
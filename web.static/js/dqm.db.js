@@ -151,16 +151,22 @@ Connection.make_http_proxy = function (uri) {
         else me.make_state("open", "http mode");
     };
 
-    me.send = function (msg) {
-        me.update_state(1);
+    // server side session, "" asks for a new one
+    // after the first reply, updates are long-polled (see ProxySession)
+    me.session = "";
+    me.polling = false;
+
+    me.request = function (messages, wait, callback) {
+        var sent_session = me.session;
 
         jQuery.ajax({
             url: me.uri,
             method: 'POST',
             dataType: 'json',
-            data: angular.toJson({ 'messages': [msg] }),
+            data: angular.toJson({ 'messages': messages, 'session': me.session, 'wait': wait }),
             success: function (body) {
-                me.update_state(-1);
+                me.session = body.session;
+
                 _.each(body.messages, function (msg) {
                     var fake_evt = { 'type': 'message', 'data': msg };
                     me.x_onmessage(fake_evt);
@@ -168,13 +174,41 @@ Connection.make_http_proxy = function (uri) {
                 });
 
                 me.x_onevent({ 'type': 'notify' });
+
+                // the session expired, whatever was in it is lost, sync again
+                if (body.new_session && sent_session !== "") {
+                    var fake_evt = { 'type': 'open' };
+                    me.x_onopen(fake_evt);
+                }
+
+                callback(true);
             },
             error: function () {
-                me.update_state(-1);
                 console.log("http2websocket proxy failed", arguments);
 
                 me.x_onerror({ 'type': 'error' });
                 me.x_onevent({ 'type': 'error' });
+
+                callback(false);
+            }
+        });
+    };
+
+    me.poll = function () {
+        me.request([], 25, function (ok) {
+            setTimeout(me.poll, ok ? 0 : 5000);
+        });
+    };
+
+    me.send = function (msg) {
+        me.update_state(1);
+
+        me.request([msg], 0, function (ok) {
+            me.update_state(-1);
+
+            if (ok && !me.polling) {
+                me.polling = true;
+                me.poll();
             }
         });
     };
@@ -208,10 +242,16 @@ mod.factory('SyncPool', ['$http', '$window', '$rootScope', '$timeout', function
 
     // interfaces for the Connection
     factory._handle_connection = function (conn, evt) {
-        conn.send(angular.toJson({
+        var req = {
             'event': 'sync_request',
             'known_rev': conn._sync_last_rev,
-        }));
+        };
+
+        // optional, see HeaderFilter in fff_web.py
+        if (conn._sync_filter)
+            req['filter'] = conn._sync_filter;
+
+        conn.send(angular.toJson(req));
     };
 
     factory._handle_message = function (conn, evt) {
@@ -253,7 +293,7 @@ mod.factory('SyncPool', ['$http', '$window', '$rootScope', '$timeout', function
     };
 
     factory.Connection = Connection;
-    factory.connect = function (uri) {
+    factory.connect = function (uri, filter) {
         var conn;
 
         if (uri.slice(0, 4) === "http") {
@@ -263,6 +303,7 @@ mod.factory('SyncPool', ['$http', '$window', '$rootScope', '$timeout', function
         }
 
         conn._sync_last_rev = null;
+        conn._sync_filter = filter || null;
         conn.x_onopen = function (evt) { return factory._handle_connection(conn, evt); };
         conn.x_onmessage = function (evt) { return factory._handle_message(conn, evt); };
         conn.x_onevent = function (evt) { return factory._handle_evt(conn, evt); };